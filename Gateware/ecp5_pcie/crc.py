@@ -1,5 +1,95 @@
 from nmigen import *
 from nmigen.build import *
+from math import ceil
+
+
+__all__ = ["CRC", "ParallelCRC", "PipelinedCRC", "LCRC", "crc_matrix", "crc_next", "crc_update"]
+
+
+def crc_matrix(polynomial, crc_size, data_size):
+    """
+    Calculates the GF(2) next-state matrix of a CRC which processes data_size bits at once.
+
+    The CRC is stepped bit by bit like in CRC, but instead of values every bit is tracked as a mask
+    of which CRC state bits (bits 0 to crc_size - 1) and input data bits (bits crc_size onwards)
+    it depends on.
+
+    Parameters
+    ----------
+    polynomial : int
+        CRC polynomial
+    crc_size : int
+        CRC size, for example 16 for CRC16.
+    data_size : int
+        Number of data bits processed per step
+
+    Returns: list of int
+        One mask per bit of the next CRC value, the bit is the XOR of all bits set in the mask
+    """
+    last = [1 << j for j in range(crc_size)]
+    for i in range(data_size):
+        # The input value is the input data XORed with the last bit of the CRC
+        in_val = (1 << (crc_size + i)) ^ last[crc_size - 1]
+
+        # Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
+        current = [0] + last[:crc_size - 1]
+        for j in range(crc_size):
+            if polynomial & (1 << j):
+                current[j] ^= in_val
+        last = current
+    return last
+
+
+def crc_next(state, data, polynomial, crc_size):
+    """
+    Next CRC value after processing data, as one flat XOR tree per output bit
+
+    Parameters
+    ----------
+    state : Value
+        Current CRC value, can also be a Const, for example the initial value
+    data : Value
+        Data input, bit 0 is processed first
+    polynomial : int
+        CRC polynomial
+    crc_size : int
+        CRC size, for example 16 for CRC16.
+
+    Returns: Value(crc_size)
+    """
+    bits = Cat(state, data)
+    result = []
+    for mask in crc_matrix(polynomial, crc_size, len(data)):
+        terms = [bits[k] for k in range(len(bits)) if mask & (1 << k)]
+        result.append(Cat(terms).xor() if terms else Const(0, 1))
+    return Cat(result)
+
+
+def crc_update(state, data, data_size, polynomial, crc_size):
+    """
+    Next CRC value after processing data, calculated in Python
+
+    Parameters
+    ----------
+    state : int
+        Current CRC value
+    data : int
+        Data, bit 0 is processed first
+    data_size : int
+        Number of data bits
+    polynomial : int
+        CRC polynomial
+    crc_size : int
+        CRC size, for example 16 for CRC16.
+
+    Returns: int
+    """
+    bits = state | (data << crc_size)
+    result = 0
+    for j, mask in enumerate(crc_matrix(polynomial, crc_size, data_size)):
+        result |= (bin(bits & mask).count("1") & 1) << j
+    return result
+
 
 class CRC(Elaboratable):
 
@@ -20,6 +110,8 @@ class CRC(Elaboratable):
         CRC size, for example 16 for CRC16.
     reset : Signal()
         Reset CRC Generator
+    latency : int
+        Clock cycles until the input affects the output
     """
     def __init__(self, input, init, polynomial, crc_size, reset = Signal()):
         self.input      = input
@@ -28,6 +120,7 @@ class CRC(Elaboratable):
         self.reset      = reset
         self.polynomial = polynomial
         self.crc_size   = crc_size
+        self.latency    = 1
     
     def elaborate(self, platform):
         m = Module()
@@ -59,3 +152,206 @@ class CRC(Elaboratable):
             m.d.sync += self.output.eq(last)
 
         return m
+
+
+class ParallelCRC(Elaboratable):
+    """
+    CRC generator for a variable number of data bits, the next CRC value is calculated with the
+    GF(2) next-state matrix from crc_matrix. Unlike CRC, this gives one flat XOR tree per output bit
+    instead of a chain which is len(input) XORs deep.
+
+    Parameters
+    ----------
+    input : Signal()
+        Data input
+    output : Signal()
+        Data output
+    next : Signal()
+        Next CRC value, the value output has after the next clock cycle if reset is not asserted
+    init : int
+        Initial CRC value
+    polynomial : int
+        CRC polynomial
+    crc_size : int
+        CRC size, for example 16 for CRC16.
+    reset : Signal()
+        Reset CRC Generator
+    latency : int
+        Clock cycles until the input affects the output
+    """
+    def __init__(self, input, init, polynomial, crc_size, reset = None):
+        self.input      = input
+        self.output     = Signal(crc_size, reset = init)
+        self.next       = Signal(crc_size)
+        self.init       = init
+        self.reset      = Signal() if reset is None else reset
+        self.polynomial = polynomial
+        self.crc_size   = crc_size
+        self.latency    = 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.d.comb += self.next.eq(crc_next(self.output, self.input, self.polynomial, self.crc_size))
+
+        # Setting the output to the initial value resets it
+        with m.If(self.reset):
+            m.d.sync += self.output.eq(self.init)
+        with m.Else():
+            m.d.sync += self.output.eq(self.next)
+
+        return m
+
+
+class PipelinedCRC(Elaboratable):
+    """
+    CRC generator for wide data inputs, which splits the calculation over multiple register stages.
+    The data part of the next-state matrix is XORed together in stages - 1 register stages,
+    the last stage XORs the result with the part depending on the last CRC value.
+    It accepts one input word per clock cycle.
+
+    Parameters
+    ----------
+    input : Signal()
+        Data input
+    output : Signal()
+        Data output
+    init : int
+        Initial CRC value
+    polynomial : int
+        CRC polynomial
+    crc_size : int
+        CRC size, for example 16 for CRC16.
+    stages : int
+        Number of register stages, with 1 it is the same as ParallelCRC
+    reset : Signal()
+        Reset CRC Generator, gets delayed together with the input
+    latency : int
+        Clock cycles until the input affects the output, same as stages
+    """
+    def __init__(self, input, init, polynomial, crc_size, stages = 2, reset = None):
+        assert stages >= 1
+        self.input      = input
+        self.output     = Signal(crc_size, reset = init)
+        self.init       = init
+        self.reset      = Signal() if reset is None else reset
+        self.polynomial = polynomial
+        self.crc_size   = crc_size
+        self.stages     = stages
+        self.latency    = stages
+
+    def elaborate(self, platform):
+        m = Module()
+
+        matrix = crc_matrix(self.polynomial, self.crc_size, len(self.input))
+
+        # Input data bits which need to be XORed for every bit of the next CRC value. Every term is a signal and the mask
+        # of the input bits it is the XOR of, its row in the GF(2) matrix.
+        terms = [[(1 << k, self.input[k]) for k in range(len(self.input)) if (mask >> self.crc_size) & (1 << k)]
+            for mask in matrix]
+
+        # XOR up to fan_in terms per register, such that only about one term per bit is left for the last stage
+        fan_in = max(2, ceil(max(len(bit_terms) for bit_terms in terms) ** (1 / max(1, self.stages - 1))))
+
+        reset = self.reset
+        for stage in range(self.stages - 1):
+            # Registers which XOR the same input bits get shared between CRC bits
+            partials = {}
+            for j in range(self.crc_size):
+                stage_terms = []
+                for i in range(0, len(terms[j]), fan_in):
+                    group = terms[j][i:i + fan_in]
+                    mask = 0
+                    for term_mask, _ in group:
+                        mask ^= term_mask
+                    if mask not in partials:
+                        partials[mask] = Signal(name="partial_{}_{}".format(stage, len(partials)))
+                        m.d.sync += partials[mask].eq(Cat(term for _, term in group).xor())
+                    stage_terms.append((mask, partials[mask]))
+                terms[j] = stage_terms
+
+            # Delay the reset such that it arrives together with the data
+            delayed_reset = Signal(name="reset_{}".format(stage))
+            m.d.sync += delayed_reset.eq(reset)
+            reset = delayed_reset
+
+        # Last stage, XOR the remaining data terms with the last CRC value
+        next = []
+        for j in range(self.crc_size):
+            bit_terms = [self.output[k] for k in range(self.crc_size) if matrix[j] & (1 << k)] + [term for _, term in terms[j]]
+            next.append(Cat(bit_terms).xor() if bit_terms else Const(0, 1))
+
+        # Setting the output to the initial value resets it
+        with m.If(reset):
+            m.d.sync += self.output.eq(self.init)
+        with m.Else():
+            m.d.sync += self.output.eq(Cat(next))
+
+        return m
+
+
+class LCRC(Elaboratable):
+    """
+    PCIe LCRC generator and checker for TLPs, processes len(input) // 8 bytes per clock cycle.
+    The last word of a TLP doesn't need to be full, it still gets processed in one clock cycle.
+
+    Parameters
+    ----------
+    input : Signal(8 * n)
+        Data input, n bytes, byte 0 being the first one
+    valid : Signal(n)
+        Which bytes of the input are valid, only the lowest bytes can be valid. If it is 0, the input is ignored.
+    start : Signal()
+        Assert with the first word of a TLP. The CRC restarts from the initial value without a reset cycle,
+        so TLPs can follow each other without a gap.
+    output : Signal(32)
+        CRC value, available one clock cycle after the last word
+    lcrc : Signal(32)
+        LCRC to transmit, byte 0 gets transmitted first
+    check : Signal()
+        Asserted if the LCRC received with the TLP is correct, when the LCRC got processed together with the TLP.
+    nullified : Signal()
+        Asserted if the LCRC received with the TLP is the inverted correct one, which marks a nullified TLP.
+    latency : int
+        Clock cycles until the input affects the output
+    """
+    def __init__(self, input, valid = None, start = Signal()):
+        assert len(input) % 8 == 0
+        self.input      = input
+        self.valid      = Signal(len(input) // 8, reset = 2 ** (len(input) // 8) - 1) if valid is None else valid
+        self.start      = start
+        self.init       = 0xFFFFFFFF
+        self.polynomial = 0x04C11DB7
+        self.crc_size   = 32
+        self.output     = Signal(32, reset = self.init)
+        self.lcrc       = Signal(32)
+        self.check      = Signal()
+        self.nullified  = Signal()
+        self.latency    = 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Complemented and bit reversed, like the DLLP CRC
+        m.d.comb += self.lcrc.eq(~Cat(self.output[::-1]))
+
+        # When the data is followed by its LCRC, the CRC always has the same value
+        lcrc = ~int("{:032b}".format(self.init)[::-1], 2) & 0xFFFFFFFF
+        residue = crc_update(self.init, lcrc, 32, self.polynomial, self.crc_size)
+        m.d.comb += self.check.eq(self.output == residue)
+
+        # A nullified TLP is followed by the inverted LCRC, which leaves another constant value
+        nullified_residue = crc_update(self.init, ~lcrc & 0xFFFFFFFF, 32, self.polynomial, self.crc_size)
+        m.d.comb += self.nullified.eq(self.output == nullified_residue)
+
+        state = Mux(self.start, self.init, self.output)
+
+        # Next CRC value for every number of valid bytes
+        with m.Switch(self.valid):
+            for bytes in range(1, len(self.valid) + 1):
+                with m.Case("0" * (len(self.valid) - bytes) + "1" * bytes):
+                    m.d.sync += self.output.eq(crc_next(state, self.input[0:8 * bytes], self.polynomial, self.crc_size))
+            with m.Default():
+                m.d.sync += self.output.eq(state)
+
+        return m
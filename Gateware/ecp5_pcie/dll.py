@@ -4,8 +4,9 @@ from enum import IntEnum
 
 from .ltssm import PCIeLTSSM
 from .serdes import K, D, Ctrl
-from .layouts import dll_layout
-from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, DLLPType
+from .layouts import dll_layout, fc_request_layout
+from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, PCIeDLLPQueue, DLLPType, PMType
+from .tlp import PCIeTLPTransmitter, PCIeTLPReceiver, FCClass, ack_nak_latency, tlp_credits
 
 class State(IntEnum):
     DL_Inactive = 0
@@ -21,14 +22,102 @@ class FCType(IntEnum):
 class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
     """
     PCIe Data Link Layer
+
+    Received TLPs get acknowledged with Ack DLLPs, a TLP which needs to be sent again with a Nak DLLP. Only one Nak gets
+    sent until the TLP with the expected sequence number is received (NAK_SCHEDULED). Received Acks and Naks go to the
+    TLP transmitter, which retrains the link through the LTSSM when REPLAY_NUM rolls over.
+
+    Acks get coalesced, one Ack acknowledges all TLPs received since the last one. It gets sent once ack_count TLPs are
+    waiting for it or when the AckNak latency timer expires, whichever comes first. The timer starts with the first
+    unacknowledged TLP, its limit is the Ack latency for Max_Payload_Size and the link width (PCIe 1.1 page 156). Acks
+    and Naks get queued before any other DLLPs and go out at the next packet boundary.
+
+    Flow control (PCIe 1.1 page 106): The link partner's CREDIT_LIMIT for each type is in credits_rx, the credits used by
+    sent TLPs since the initialization are counted in credits_consumed. Header credits are counted modulo 256, data
+    credits modulo 4096. The transaction layer puts the credits of its next TLP into fc_request and may only start the
+    TLP while may_send is asserted. The credits of received TLPs get returned to the link partner by UpdateFCs once the
+    transaction layer took them out of the receive buffer.
+
+    An UpdateFC for a type gets sent as soon as the credits freed since the last one reach update_header_threshold or
+    update_data_threshold. Otherwise it gets refreshed every 30 µs, the maximum interval (PCIe 1.1 page 113), which can
+    be delayed by up to 50 % while TLPs are being sent. Types with infinite credits don't get UpdateFCs.
+
+    Parameters
+    ----------
+    tlp_tx : PCIeTLPTransmitter
+        TLP transmitter with the replay buffer, TLPs can be sent while the link is up
+    tlp_rx : PCIeTLPReceiver
+        TLP receiver
+    enter_l1 : Signal()
+        Request L1. PM_Enter_L1 DLLPs get sent until the link partner answers with PM_Request_Ack, then the LTSSM
+        gets directed to L1. Deassert to leave L1 again. A PM_Enter_L1 from the link partner gets answered with
+        PM_Request_Ack DLLPs until it sent an EIOS. New TLPs are blocked from the start of the handshake until L1 has
+        been left, the PM DLLPs only get sent once all sent TLPs have been acknowledged.
+    l1 : Signal()
+        Asserted while the link is in L1
+    acks_sent : Signal(32)
+        Number of Ack DLLPs sent
+    tlps_acked : Signal(32)
+        Number of received TLPs acknowledged by Acks and Naks
+    credits_tx : Record(dll_layout)
+        Credits advertised in the InitFCs, they need to fit into the receive buffer. 0 means infinite credits.
+    credits_allocated : Record(dll_layout)
+        CREDITS_ALLOCATED, credits_tx plus the credits of the received TLPs taken by the transaction layer, for UpdateFCs
+    credits_rx : Record(dll_layout)
+        CREDIT_LIMIT, credits advertised by the link partner
+    credits_consumed : Record(dll_layout)
+        CREDITS_CONSUMED, credits used by the TLPs sent since the flow control initialization
+    fc_request : Record(fc_request_layout)
+        Flow control type and data credits of the TLP the transaction layer wants to send next, one header credit is
+        needed as well. It needs to be valid together with the first word of the TLP.
+    may_send : Signal()
+        Asserted when the link partner has enough credits for fc_request and no power management handshake is going on
+    clk_freq : float
+        Frequency of the "rx" clock in Hz, 250 MHz divided by the gearing ratio by default
+    time_scale : float
+        Factor the UpdateFC interval gets multiplied with, like for PCIeLTSSM
+    max_payload_size : int
+        Max_Payload_Size in bytes, for the AckNak latency timer
+    lanes : int
+        Link width, for the AckNak latency timer
+    ack_count : int
+        Number of received TLPs after which an Ack gets sent without waiting for the AckNak latency timer
+    update_header_threshold : int
+        Number of freed header credits of a type after which an UpdateFC gets sent without waiting for the interval
+    update_data_threshold : int
+        Number of freed data credits of a type after which an UpdateFC gets sent without waiting for the interval
     """
-    def __init__(self, ltssm : PCIeLTSSM, tx : PCIeDLLPTransmitter, rx : PCIeDLLPReceiver):
+    def __init__(self, ltssm : PCIeLTSSM, tx : PCIeDLLPTransmitter, rx : PCIeDLLPReceiver, tlp_tx : PCIeTLPTransmitter,
+                 tlp_rx : PCIeTLPReceiver, clk_freq = None, time_scale = 1, max_payload_size = 128, lanes = 1,
+                 ack_count = 8, update_header_threshold = 2, update_data_threshold = 16):
+        assert time_scale > 0
+        assert 1 <= ack_count < 2048
+        assert 1 <= update_header_threshold < 128
+        assert 1 <= update_data_threshold < 2048
+        self.clk_freq = 250e6 / tx.ratio if clk_freq is None else clk_freq
+        self.time_scale = time_scale
         self.up = Signal()
+        self.enter_l1 = Signal()
+        self.l1 = Signal()
+        self.acks_sent = Signal(32)
+        self.tlps_acked = Signal(32)
+        self.ack_count = ack_count
+        self.update_header_threshold = update_header_threshold
+        self.update_data_threshold = update_data_threshold
+
+        # Symbol times are 1 / ratio clock cycles at both speeds, like for the REPLAY_TIMER
+        self.ack_latency = ack_nak_latency(max_payload_size, lanes) // tx.ratio
         self.ltssm = ltssm
         self.tx = tx
         self.rx = rx
+        self.tlp_tx = tlp_tx
+        self.tlp_rx = tlp_rx
         self.credits_tx = Record(dll_layout)
+        self.credits_allocated = Record(dll_layout)
         self.credits_rx = Record(dll_layout)
+        self.credits_consumed = Record(dll_layout)
+        self.fc_request = Record(fc_request_layout)
+        self.may_send = Signal()
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
@@ -43,8 +132,105 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
         transmit_dllps = Signal()
         done_dllp_transmission = Signal()
 
-        # For later use
+        # The InitFCs of a round are sent for each type in turn, done_dllp_transmission gets set after every round
+        init_sent = Signal(3)
+        init_taken = Signal(3)
+
+        # UpdateFCs to send for each type, and the ones which got started
+        update_pending = Signal(3)
+        update_sent = Signal(3)
+
+        # DLLPs get posted to the queue in the order of priority, Acks and Naks first so the link partner can free its
+        # replay buffer, then InitFCs and UpdateFCs for P, NP and Cpl, then power management
+        m.submodules.dllp_queue = dllp_queue = PCIeDLLPQueue(self.tx, 5)
+        acknak_entry = dllp_queue.inputs[0]
+        fc_entries = dllp_queue.inputs[1:4]
+        pm_entry = dllp_queue.inputs[4]
+
+        # Refreshing UpdateFCs wait while the TLP transmitter has something to send, DLLPs would starve it otherwise
         sending_tlp = Signal()
+        m.d.comb += sending_tlp.eq(self.tlp_tx.out_symbols.valid)
+
+        # Power management DLLP to transmit
+        pm_send = Signal()
+        pm_type = Signal(3)
+
+        # Whether no power management handshake is going on and the link isn't in L1
+        pm_idle = Signal()
+
+        # Received Acks and Naks go to the TLP transmitter, TLPs are only sent and received while the link is up
+        m.d.comb += [
+            self.tlp_tx.enable.eq(self.up),
+            self.tlp_tx.hold.eq(~self.ltssm.tx.ready),
+            self.tlp_tx.block.eq(~pm_idle),
+            self.tlp_tx.acknak.valid.eq(self.rx.dllp.valid &
+                ((self.rx.dllp.type == DLLPType.Ack) | (self.rx.dllp.type == DLLPType.Nak))),
+            self.tlp_tx.acknak.nak.eq(self.rx.dllp.type == DLLPType.Nak),
+            self.tlp_tx.acknak.seq.eq(self.rx.dllp.data),
+            self.ltssm.retrain.eq(self.tlp_tx.retrain),
+            self.tlp_rx.enable.eq(self.up),
+        ]
+
+        # AckNak_Seq_Num of the last sent Ack or Nak, an Ack is needed when NEXT_RCV_SEQ moved on since then
+        # or when a duplicate TLP got received
+        ack_seq = Signal(12, reset=4095)
+        duplicate_pending = Signal()
+        nak_pending = Signal()
+        nak_scheduled = Signal()
+        acknak_seq = Signal(12)
+        m.d.comb += acknak_seq.eq(self.tlp_rx.next_rcv_seq - 1)
+
+        # Number of received TLPs which weren't acknowledged yet, the AckNak latency timer runs while there are any.
+        # Naks and Acks for duplicate TLPs don't wait.
+        unacked = Signal(12)
+        m.d.comb += unacked.eq(acknak_seq - ack_seq)
+        ack_timer = Signal(range(self.ack_latency + 1))
+        with m.If((unacked != 0) & (ack_timer < self.ack_latency)):
+            m.d.rx += ack_timer.eq(ack_timer + 1)
+        ack_due = (unacked != 0) & ((unacked >= self.ack_count) | (ack_timer == self.ack_latency))
+        acknak_send = self.up & (ack_due | duplicate_pending | nak_pending)
+        acknak_sent = Signal()
+
+        # AckNak_Seq_Num is NEXT_RCV_SEQ - 1, the last TLP received correctly
+        m.d.comb += [
+            acknak_entry.type.eq(Mux(nak_pending, DLLPType.Nak, DLLPType.Ack)),
+            acknak_entry.data.eq(acknak_seq),
+            acknak_entry.valid.eq(acknak_send),
+            acknak_sent.eq(acknak_entry.valid & acknak_entry.ready),
+        ]
+        with m.If(acknak_sent):
+            m.d.rx += [
+                ack_seq.eq(acknak_seq),
+                ack_timer.eq(0),
+                duplicate_pending.eq(0),
+                self.tlps_acked.eq(self.tlps_acked + unacked),
+            ]
+            with m.If(nak_pending):
+                m.d.rx += nak_pending.eq(0)
+            with m.Else():
+                m.d.rx += self.acks_sent.eq(self.acks_sent + 1)
+
+        with m.If(self.tlp_rx.ack):
+            m.d.rx += [
+                nak_scheduled.eq(0),
+                nak_pending.eq(0),
+            ]
+        with m.If(self.tlp_rx.duplicate):
+            m.d.rx += duplicate_pending.eq(1)
+        with m.If(self.tlp_rx.nak & ~nak_scheduled):
+            m.d.rx += [
+                nak_scheduled.eq(1),
+                nak_pending.eq(1),
+            ]
+
+        with m.If(~self.up):
+            m.d.rx += [
+                ack_seq.eq(4095),
+                ack_timer.eq(0),
+                duplicate_pending.eq(0),
+                nak_pending.eq(0),
+                nak_scheduled.eq(0),
+            ]
 
         # Get update DLLPs
         with m.If(~self.ltssm.status.link.up):
@@ -61,6 +247,138 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
             m.d.rx += self.credits_rx.CPLH.eq(self.rx.dllp.header)
             m.d.rx += self.credits_rx.CPLD.eq(self.rx.dllp.data)
 
+        # Flow control for the transmitted TLPs, the credits of each type are counted separately
+        classes = [("PH", "PD"), ("NPH", "NPD"), ("CPLH", "CPLD")]
+        limit = self.credits_rx
+        consumed = self.credits_consumed
+        request = self.fc_request
+
+        # InitFC1 values of 0 mean infinite credits, then the UpdateFCs for them carry 0 as well
+        infinite = {name: Signal(name="infinite_" + name) for name, _ in dll_layout}
+        for i, (header, data) in enumerate(classes):
+            with m.If(~self.up & self.rx.dllp.valid & (self.rx.dllp.type == DLLPType.InitFC1_P + i)):
+                m.d.rx += [
+                    infinite[header].eq(self.rx.dllp.header == 0),
+                    infinite[data].eq(self.rx.dllp.data == 0),
+                ]
+
+        # A TLP may be sent if CREDIT_LIMIT - (CREDITS_CONSUMED + needed credits), modulo 256 or 4096,
+        # is at most half of that
+        for i, (header, data) in enumerate(classes):
+            header_left = Signal(8, name="%s_left" % header)
+            data_left = Signal(12, name="%s_left" % data)
+            m.d.comb += [
+                header_left.eq(limit[header] - consumed[header] - 1),
+                data_left.eq(limit[data] - consumed[data] - request.data),
+            ]
+            with m.If(request.type == i):
+                m.d.comb += self.may_send.eq(self.up & pm_idle &
+                    (infinite[header] | (header_left <= 128)) & (infinite[data] | (data_left <= 2048)))
+
+        # A TLP consumes its credits when the TLP transmitter takes its first word
+        tlp = self.tlp_tx.tlp
+        with m.If(tlp.valid & tlp.ready & tlp.first):
+            for i, (header, data) in enumerate(classes):
+                with m.If(request.type == i):
+                    m.d.rx += [
+                        consumed[header].eq((consumed[header] + 1)[:8]),
+                        consumed[data].eq(consumed[data] + request.data),
+                    ]
+
+        # The credits of a received TLP get freed when the transaction layer took it out of the receive buffer. Its
+        # type and size are in the first DW of the header, which takes two words with 1:2 gearing.
+        freed = Record(dll_layout)
+        rx_tlp = self.tlp_rx.tlp
+        ratio = len(rx_tlp.data) // 8
+        rx_header = Signal(32)
+        with m.If(rx_tlp.valid & rx_tlp.ready & rx_tlp.first):
+            m.d.rx += rx_header[:8 * ratio].eq(rx_tlp.data)
+        if ratio == 2:
+            second_word = Signal()
+            with m.If(rx_tlp.valid & rx_tlp.ready):
+                m.d.rx += second_word.eq(rx_tlp.first)
+                with m.If(second_word):
+                    m.d.rx += rx_header[16:32].eq(rx_tlp.data)
+
+        rx_type, rx_data = tlp_credits(rx_header)
+        with m.If(rx_tlp.valid & rx_tlp.ready & rx_tlp.last):
+            for i, (header, data) in enumerate(classes):
+                with m.If(rx_type == i):
+                    m.d.rx += [
+                        freed[header].eq((freed[header] + 1)[:8]),
+                        freed[data].eq(freed[data] + rx_data),
+                    ]
+
+        # Infinite credits stay infinite
+        for name, _ in dll_layout:
+            bits = 8 if name.endswith("H") else 12
+            m.d.comb += self.credits_allocated[name].eq(
+                Mux(self.credits_tx[name] == 0, 0, (self.credits_tx[name] + freed[name])[:bits]))
+
+        # UpdateFCs, each type has its own interval timer and remembers the credits it advertised last
+        refresh_cycles = max(1, int(30e-6 * self.clk_freq * self.time_scale))
+        deadline_cycles = refresh_cycles * 3 // 2
+        for i, ((header, data), fc_entry) in enumerate(zip(classes, fc_entries)):
+            advertised_header = Signal(8, name="advertised_%s" % header)
+            advertised_data = Signal(12, name="advertised_%s" % data)
+            update_timer = Signal(range(deadline_cycles + 1), name="update_timer_%s" % header[:-1])
+            freed_header = Signal(8, name="freed_%s" % header)
+            freed_data = Signal(12, name="freed_%s" % data)
+            m.d.comb += [
+                freed_header.eq(self.credits_allocated[header] - advertised_header),
+                freed_data.eq(self.credits_allocated[data] - advertised_data),
+            ]
+
+            with m.If(update_timer < deadline_cycles):
+                m.d.rx += update_timer.eq(update_timer + 1)
+
+            # No UpdateFCs get sent during the power management handshake or in L1
+            needed = (self.credits_tx[header] != 0) | (self.credits_tx[data] != 0)
+            threshold = (freed_header >= self.update_header_threshold) | (freed_data >= self.update_data_threshold)
+            refresh = ((update_timer >= refresh_cycles) & ~sending_tlp) | (update_timer == deadline_cycles)
+            with m.If(self.up & needed & pm_idle & (threshold | refresh)):
+                m.d.rx += update_pending[i].eq(1)
+
+            # The FCs advertise the credits allocated in the clock cycle in which they get taken
+            m.d.comb += [
+                fc_entry.type.eq(Cat(Const(i, 2), Mux(transmit_dllps, fc_type, FCType.UpdateFC))),
+                fc_entry.header.eq(self.credits_allocated[header]),
+                fc_entry.data.eq(self.credits_allocated[data]),
+                fc_entry.valid.eq((transmit_dllps & ~init_sent[i]) | update_pending[i]),
+                init_taken[i].eq(fc_entry.valid & fc_entry.ready & transmit_dllps),
+                update_sent[i].eq(fc_entry.valid & fc_entry.ready & ~transmit_dllps),
+            ]
+
+            with m.If(update_sent[i]):
+                m.d.rx += [
+                    update_pending[i].eq(0),
+                    update_timer.eq(0),
+                    advertised_header.eq(self.credits_allocated[header]),
+                    advertised_data.eq(self.credits_allocated[data]),
+                ]
+
+            # The InitFCs advertised the credits without any freed ones
+            with m.If(~self.up):
+                m.d.rx += [
+                    update_pending[i].eq(0),
+                    update_timer.eq(0),
+                    advertised_header.eq(self.credits_allocated[header]),
+                    advertised_data.eq(self.credits_allocated[data]),
+                ]
+
+        with m.If(~transmit_dllps):
+            m.d.rx += [
+                init_sent.eq(0),
+                done_dllp_transmission.eq(0),
+            ]
+        with m.Elif((init_sent | init_taken).all()):
+            m.d.rx += [
+                init_sent.eq(0),
+                done_dllp_transmission.eq(1),
+            ]
+        with m.Else():
+            m.d.rx += init_sent.eq(init_sent | init_taken)
+
         # Data Link Layer State Machine, Page 129 in PCIe 1.1
         with m.FSM(domain="rx"):
             with m.State(State.DL_Inactive):
@@ -71,6 +389,8 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
                     got_cpl.eq(0),
                     done_dllp_transmission.eq(0),
                     transmit_dllps.eq(0),
+                    consumed.eq(0),
+                    freed.eq(0),
                 ]
                 with m.If(self.ltssm.status.link.up): # TODO: link on transaction layer must not be disabled
                     m.next = State.DL_Init_FC1
@@ -111,84 +431,70 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
                 # This is supposed to be in the above state, but does it matter?
                 m.d.rx += self.up.eq(1)
 
-                # Send DLLP UpdateFC packets often enough, assumes 125 MHz clock, tranmits every 25 µs if there is no other ongoing transmission
-                clk = 125E6
-                min_delay = 25E-6
-                update_timer =  Signal(range(int(min_delay * clk + 1)))
+        def pm_received(type):
+            return self.rx.dllp.valid & (self.rx.dllp.type == DLLPType.PM) & (self.rx.dllp.type_meta == type)
 
-                m.d.rx += update_timer.eq(update_timer + 1)
+        # Whether this side requested L1, otherwise it's in L1 because the link partner requested it
+        pm_requester = Signal()
 
-                with m.If((update_timer >= int(min_delay * clk)) & ~sending_tlp):
-                    m.d.rx += fc_type.eq(FCType.UpdateFC)
-                    m.d.rx += transmit_dllps.eq(1)
-                    m.d.rx += done_dllp_transmission.eq(0)
-                    m.d.rx += update_timer.eq(0)
-                with m.Elif(done_dllp_transmission):
-                    m.d.rx += transmit_dllps.eq(0)
-                    
-                pass
-        
-        # DLLP sending FSM
-        # TODO: It transmits the first packet twice. This doesn't break it but it unnecessarily takes up bandwidth.
-        with m.FSM(domain="rx"):
-            with m.State("Idle"):
-                m.d.rx += self.tx.send.eq(0)
-                with m.If(transmit_dllps):
-                    m.next = "P"
-
-            # Const(n, 2) means n = 0: P, n = 1: NP, n = 2: CPL
-            with m.State("P"):
-                with m.If(~transmit_dllps):
-                    m.d.rx += done_dllp_transmission.eq(0)
-                    m.next = "Idle"
+        # L1 handshake, page 275 in PCIe 1.1. The requester sends PM_Enter_L1 until the link partner answers with
+        # PM_Request_Ack, then sends an EIOS. The link partner keeps sending PM_Request_Ack until it receives the EIOS.
+        # Both sides block new TLPs and wait for the Acks of their sent TLPs before sending their PM DLLPs.
+        all_acked = Signal()
+        m.d.comb += all_acked.eq(self.tlp_tx.outstanding == 0)
+        with m.FSM(domain="rx", name="pm_fsm"):
+            with m.State("L0"):
+                m.d.comb += pm_idle.eq(1)
+                with m.If(self.up & self.enter_l1):
+                    m.next = "Enter_L1"
+                with m.Elif(self.up & pm_received(PMType.Enter_L1)):
+                    m.next = "Request_Ack"
 
-                m.d.rx += [
-                    self.tx.dllp.type.eq(Cat(Const(0, 2), fc_type)),
-                    self.tx.dllp.header.eq(self.credits_tx.PH),
-                    self.tx.dllp.data.eq(self.credits_tx.PD),
-                    self.tx.dllp.valid.eq(1),
-                    self.tx.send.eq(1),
-                ]
+            with m.State("Enter_L1"):
+                m.d.comb += pm_send.eq(all_acked)
+                m.d.comb += pm_type.eq(PMType.Enter_L1)
+                with m.If(~self.up | ~self.enter_l1):
+                    m.next = "L0"
+                with m.Elif(pm_received(PMType.Request_Ack)):
+                    m.d.rx += pm_requester.eq(1)
+                    m.next = "L1.Flush"
 
-                with m.If(self.tx.started_sending):
-                    m.d.rx += self.tx.send.eq(0)
-                    m.next = "NP"
+            with m.State("Request_Ack"):
+                m.d.comb += pm_send.eq(all_acked)
+                m.d.comb += pm_type.eq(PMType.Request_Ack)
+                with m.If(~self.up):
+                    m.next = "L0"
+                with m.Elif(self.ltssm.status.rx_l0s):
+                    m.d.rx += pm_requester.eq(0)
+                    m.next = "L1.Flush"
 
-            with m.State("NP"):
-                with m.If(~transmit_dllps):
-                    m.d.rx += done_dllp_transmission.eq(0)
-                    m.next = "Idle"
-                    
-                m.d.rx += [
-                    self.tx.dllp.type.eq(Cat(Const(1, 2), fc_type)),
-                    self.tx.dllp.header.eq(self.credits_tx.NPH),
-                    self.tx.dllp.data.eq(self.credits_tx.NPD),
-                    self.tx.dllp.valid.eq(1),
-                    self.tx.send.eq(1),
-                ]
-                with m.If(self.tx.started_sending):
-                    m.d.rx += self.tx.send.eq(0)
-                    m.next = "CPL"
+            # Wait until the queued DLLPs have been sent, they would get sent after leaving L1 otherwise
+            with m.State("L1.Flush"):
+                with m.If(~self.up):
+                    m.next = "L0"
+                with m.Elif(self.tx.empty & ~self.tx.send):
+                    m.next = "L1.Entry"
 
-            with m.State("CPL"):
-                with m.If(~transmit_dllps):
-                    m.d.rx += done_dllp_transmission.eq(0)
-                    m.next = "Idle"
-                    
-                m.d.rx += [
-                    self.tx.dllp.type.eq(Cat(Const(2, 2), fc_type)),
-                    self.tx.dllp.header.eq(self.credits_tx.CPLH),
-                    self.tx.dllp.data.eq(self.credits_tx.CPLD),
-                    self.tx.dllp.valid.eq(1),
-                    self.tx.send.eq(1),
-                ]
-                with m.If(self.tx.started_sending):
-                    m.d.rx += self.tx.send.eq(0)
-                    # This is kind of a hack to ensure that it doesn't toggle to 1 when it isn't supposed to transmit (but still finishing a transmission)
-                    m.d.rx += done_dllp_transmission.eq(transmit_dllps)
-                    with m.If(transmit_dllps):
-                        m.next = "P"
-                    with m.Else():
-                        m.next = "Idle"
+            # The LTSSM sends an EIOS and goes to L1 once the link partner sent one as well
+            with m.State("L1.Entry"):
+                m.d.comb += self.ltssm.enter_l1.eq(1)
+                with m.If(~self.up):
+                    m.next = "L0"
+                with m.Elif(self.ltssm.status.l1):
+                    m.next = "L1"
+
+            # The requester leaves L1 when it isn't requested anymore, the link partner when the requester leaves it
+            with m.State("L1"):
+                m.d.comb += self.l1.eq(1)
+                m.d.comb += self.ltssm.enter_l1.eq(~pm_requester | self.enter_l1)
+                with m.If(~self.ltssm.status.l1):
+                    m.next = "L0"
+
+        # Only one power management DLLP gets posted at a time, such that none are left over after L1
+        m.d.comb += [
+            pm_entry.type.eq(DLLPType.PM),
+            pm_entry.type_meta.eq(pm_type),
+            pm_entry.valid.eq(pm_send & self.tx.empty),
+        ]
 
         return m
\ No newline at end of file
@@ -3,9 +3,9 @@ from nmigen.build import *
 from nmigen.lib.fifo import SyncFIFOBuffered
 
 from enum import IntEnum
-from .layouts import dllp_layout
+from .layouts import dllp_layout, dllp_request_layout, symbol_stream_layout, packet_stream_layout
 from .serdes import K, D, Ctrl, PCIeScrambler
-from .crc import CRC
+from .crc import ParallelCRC, PipelinedCRC
 
 # Page 137 in PCIe 1.1
 class DLLPType(IntEnum):
@@ -22,160 +22,331 @@ class DLLPType(IntEnum):
     UpdateFC_NP = 9,
     UpdateFC_Cpl= 10,
 
+# Power management DLLP types in type_meta, page 139 in PCIe 1.1
+class PMType(IntEnum):
+    Enter_L1    = 0,
+    Enter_L23   = 1,
+    Active_State_Request_L1 = 3,
+    Request_Ack = 4,
+
 class PCIeDLLPTransmitter(Elaboratable):
     """
-    PCIe Data Link Layer Packet transmitter
+    PCIe Data Link Layer Packet transmitter for 1:2 or 1:4 gearing
 
     Parameters
     ----------
-    out_symbols : Signal(18)
-        Symbols to TX Phy
+    out_symbols : Record(symbol_stream_layout(2)) or Record(symbol_stream_layout(4))
+        Symbol stream to TX Phy, every DLLP is a packet
     send : Signal()
         True when sending DLLPs
+    ready : Signal()
+        Asserted when a DLLP gets started in this clock cycle if send and dllp.valid are asserted, the next DLLP can be
+        started in the last clock cycle of the current one
+    started_sending : Signal()
+        Asserted for one clock cycle after a DLLP got started
+    crc_stages : int
+        Number of register stages of the CRC generator, the output gets delayed to match its latency
+    fifo_depth : int
+        Depth of the FIFO for the transmitted words, a DLLP only gets started when it fits into the FIFO,
+        so it can wait while the TX Phy isn't ready
+    empty : Signal()
+        Asserted when all started DLLPs have been passed to the TX Phy
     """
-    def __init__(self, out_symbols : Signal):
+    def __init__(self, out_symbols : Record, crc_stages = 1, fifo_depth = 16):
         self.dllp = Record(dllp_layout)
         self.out_symbols = out_symbols
         self.send = Signal()
+        self.ready = Signal()
         self.started_sending = Signal()
-        self.enable = Signal(reset = 1)
-        assert len(out_symbols) == 18
+        self.empty = Signal()
+        self.crc_stages = crc_stages
+        self.ratio = len(out_symbols.data) // 9
+        assert self.ratio in [2, 4]
+        self.fifo = DomainRenamer("rx")(SyncFIFOBuffered(width=9 * self.ratio + 2, depth=fifo_depth))
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        dllp = Record(dllp_layout) # self.dllp
+        dllp = Record(dllp_layout) # Copy of self.dllp taken when the DLLP gets started
 
-        # TODO: Maybe rethink CRC implementation to make this unnecessary.
-        symbols = [Signal(9), Signal(9)]
-        out_symbols = [Signal(9), Signal(9)]
-        last_symbol = Signal(9)
+        # A DLLP has 4 data bytes, which take 4 / ratio words, and takes 8 symbols to transmit
+        ratio = self.ratio
+        data_words = 4 // ratio
+        words = 8 // ratio
+
+        # DLLP data, ratio symbols per clock cycle, and whether they are the first or the last data word
+        symbols = [Signal(9, name="symbol_%d" % i) for i in range(ratio)]
+        first = Signal()
+        last = Signal()
+
+        def dllp_bytes(dllp):
+            return [
+                Cat(dllp.type_meta, Const(0, 1), dllp.type),
+                dllp.header[2:8],
+                Cat(dllp.data[8:12], Const(0, 2), dllp.header[0:2]),
+                dllp.data[0:8],
+            ]
 
         # Set up CRC (PCIe 1.1 page 167)
-        m.submodules.crc = crc = DomainRenamer("rx")(CRC(Cat(symbols[0][0:8], symbols[1][0:8]), 0xFFFF, 0x100B, 16, Signal()))
-
-        with m.If(1): #self.enable): TODO: revisit this if necessary
-            m.d.rx += last_symbol.eq(out_symbols[1])
-            m.d.rx += self.out_symbols.eq(Cat(last_symbol, out_symbols[0]))
-
-            # Delay 1 clock cycle for CRC calculation
-            m.d.rx += out_symbols[0].eq(symbols[0])
-            m.d.rx += out_symbols[1].eq(symbols[1])
-
-            # See figure 3-11.
-            crc_out = ~Cat(crc.output[::-1])
-            m.d.rx += crc.reset.eq(0)
-
-            # TODO: Do it properly instead of guessing around.
-            # It does work but it is very hacky
-            with m.FSM(domain="rx"):
-                with m.State("Idle"):
-                    with m.If(self.dllp.valid):
-                        m.d.rx += dllp.eq(self.dllp)
-                    m.d.rx += crc.reset.eq(0)
-                    with m.If(dllp.valid & self.send):
-                        m.d.rx += symbols[0].eq(Cat(dllp.type_meta, Const(0, 1), dllp.type))
-                        m.d.rx += symbols[1].eq(dllp.header[2:8])
-                        m.d.rx += self.started_sending.eq(1)
-                        m.next = "tx-1"
-                    #with m.Else():
-                    m.d.rx += out_symbols[0].eq(0)
-                    m.d.rx += last_symbol.eq(0)
-                with m.State("tx-1"):
-                    m.d.rx += symbols[0].eq(Cat(dllp.data[8:12], Const(0, 2), dllp.header[0:2]))
-                    m.d.rx += symbols[1].eq(dllp.data[0:8])
-                    m.d.rx += last_symbol.eq(Ctrl.SDP)
-                    m.d.rx += self.started_sending.eq(0)
-                    m.next = "tx-2"
-                with m.State("tx-2"):
-                    m.next = "tx-3"
-                with m.State("tx-3"):
-                    m.d.rx += out_symbols[0].eq(crc_out[0:8])
-                    m.d.rx += out_symbols[1].eq(crc_out[8:16])
-                    m.d.rx += crc.reset.eq(1)
-                    m.next = "tx-4"
-                with m.State("tx-4"):
-                    m.d.rx += out_symbols[0].eq(Ctrl.END)
-                    with m.If(self.dllp.valid):
-                        m.d.rx += dllp.eq(self.dllp)
-                    with m.If(dllp.valid & self.send):
-                        m.d.rx += symbols[0].eq(Cat(dllp.type_meta, Const(0, 1), dllp.type))
-                        m.d.rx += symbols[1].eq(dllp.header[2:8])
-                        m.d.rx += crc.reset.eq(0)
-                        m.d.rx += self.started_sending.eq(1)
-                        m.next = "tx-1"
-                    with m.Else():
-                        m.d.rx += crc.reset.eq(1)
-                        m.next = "Idle"
+        m.submodules.crc = crc = DomainRenamer("rx")(PipelinedCRC(Cat(symbol[0:8] for symbol in symbols), 0xFFFF, 0x100B, 16, self.crc_stages, Signal()))
+
+        # The CRC is reset unless it gets DLLP data
+        m.d.comb += crc.reset.eq(~(first | last))
+
+        # Delay the DLLP data such that the CRC is ready right after the last data word.
+        # That is crc.latency - 1 clock cycles, since the CRC is transmitted in the cycle after the last data word.
+        delayed = [Cat(symbols)] + [Signal(9 * ratio, name="delayed_symbols_%d" % i) for i in range(1, crc.latency)]
+        delayed_first = [first] + [Signal(name="delayed_first_%d" % i) for i in range(1, crc.latency)]
+        delayed_last = [last] + [Signal(name="delayed_last_%d" % i) for i in range(1, crc.latency + 2)]
+        for i in range(1, crc.latency):
+            m.d.rx += delayed[i].eq(delayed[i - 1])
+            m.d.rx += delayed_first[i].eq(delayed_first[i - 1])
+        for i in range(1, crc.latency + 2):
+            m.d.rx += delayed_last[i].eq(delayed_last[i - 1])
+
+        data = delayed[-1]
+        data_first = delayed_first[-1]
+        data_last = delayed_last[crc.latency - 1]
+        crc_ready = delayed_last[crc.latency]
+        end_ready = delayed_last[crc.latency + 1]
+
+        # See figure 3-11.
+        crc_out = ~Cat(crc.output[::-1])
+
+        # Words in the order [x SDP] [0 1] [2 3] [CRC0 CRC1] [END x], the transmitted symbols are
+        # shifted by one symbol, giving [SDP 0] [1 2] [3 CRC0] [CRC1 END].
+        # With 1:4 gearing the END fits into the CRC word, [x x x SDP] [0 1 2 3] [CRC0 CRC1 END x] gives
+        # [SDP 0 1 2] [3 CRC0 CRC1 END].
+        word = Signal(9 * ratio)
+        crc_word = Cat(crc_out[0:8], Const(0, 1), crc_out[8:16], Const(0, 1))
+        with m.If(data_first | data_last):
+            m.d.comb += word.eq(data)
+        with m.Elif(crc_ready):
+            m.d.comb += word.eq(crc_word if ratio == 2 else Cat(crc_word, Const(Ctrl.END, 9)))
+        if ratio == 2:
+            with m.Elif(end_ready):
+                m.d.comb += word.eq(Ctrl.END)
+
+        # Which words are part of the DLLP
+        word_valid = data_first | data_last | crc_ready
+        word_last = crc_ready
+        if ratio == 2:
+            word_valid |= end_ready
+            word_last = end_ready
+
+        # Transmitted words go through a FIFO, such that the CRC pipeline never needs to wait
+        m.submodules.fifo = fifo = self.fifo
+        out = self.out_symbols
+        m.d.comb += [
+            out.data.eq(fifo.r_data[:9 * ratio]),
+            out.first.eq(fifo.r_data[9 * ratio]),
+            out.last.eq(fifo.r_data[9 * ratio + 1]),
+            out.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(out.ready),
+        ]
+
+        # A DLLP can be started when all words in the pipeline and the new DLLP fit into the FIFO
+        room = fifo.level + 2 * words + crc.latency + 1 <= fifo.depth
+
+        last_symbol = Signal(9)
+        m.d.rx += last_symbol.eq(word[9 * (ratio - 1):])
+        m.d.rx += fifo.w_data.eq(Cat(Mux(data_first, Ctrl.SDP, last_symbol), word[:9 * (ratio - 1)], data_first, word_last))
+        m.d.rx += fifo.w_en.eq(word_valid)
+
+        # Number of DLLPs which got started and weren't completely passed on yet
+        starting = Signal()
+        pending = Signal(range(fifo.depth + 1))
+        done = out.valid & out.ready & out.last
+        with m.If(starting & ~done):
+            m.d.rx += pending.eq(pending + 1)
+        with m.Elif(~starting & done):
+            m.d.rx += pending.eq(pending - 1)
+        m.d.comb += self.empty.eq(pending == 0)
+
+        def load(index, source = dllp):
+            m.d.rx += [symbols[i].eq(dllp_bytes(source)[index * ratio + i]) for i in range(ratio)]
+            m.d.rx += first.eq(index == 0)
+            m.d.rx += last.eq(index == data_words - 1)
+
+        def start(otherwise = None):
+            # The first word comes from self.dllp directly, so a DLLP changed together with send gets sent as it is
+            m.d.comb += self.ready.eq(room)
+            with m.If(self.dllp.valid & self.send & room):
+                m.d.rx += dllp.eq(self.dllp)
+                load(0, self.dllp)
+                m.d.comb += starting.eq(1)
+                m.d.rx += self.started_sending.eq(1)
+                m.next = "tx-1"
+            if otherwise is not None:
+                with m.Else():
+                    m.next = otherwise
+
+        # A DLLP takes 8 / ratio clock cycles, the first 4 / ratio of them are DLLP data
+        with m.FSM(domain="rx"):
+            with m.State("Idle"):
+                m.d.rx += first.eq(0)
+                m.d.rx += last.eq(0)
+                start()
+            for i in range(1, words + 1):
+                with m.State("tx-%d" % i):
+                    if i < data_words:
+                        load(i)
+                    elif i == data_words:
+                        m.d.rx += first.eq(0)
+                        m.d.rx += last.eq(0)
+                    if i == 1:
+                        m.d.rx += self.started_sending.eq(0)
+                    if i < words:
+                        m.next = "tx-%d" % (i + 1)
+                    else:
+                        start(otherwise = "Idle")
+
+        return m
+
+class PCIeDLLPQueue(Elaboratable):
+    """
+    Prioritized DLLP queue in front of a PCIeDLLPTransmitter
+
+    Every producer of DLLPs, like the Ack/Nak, UpdateFC and power management logic, has its own entry, which it posts a
+    DLLP to by asserting valid. Of the posted entries, the one with the lowest index gets passed to the transmitter and
+    its ready gets asserted in the clock cycle in which the transmitter takes the DLLP. The producer keeps its DLLP
+    posted until then, the fields only get taken in that cycle, so for example an Ack always has the latest sequence
+    number. Since the transmitter can take the next DLLP in the last clock cycle of the current one, posted DLLPs get
+    sent back to back, and several producers can post in the same clock cycle.
+
+    Parameters
+    ----------
+    tx : PCIeDLLPTransmitter
+        DLLP transmitter, the queue drives its dllp and send
+    count : int
+        Number of entries
+    inputs : list of Record(dllp_request_layout)
+        Entries of the producers, highest priority first
+    """
+    def __init__(self, tx : PCIeDLLPTransmitter, count = 3):
+        self.tx = tx
+        self.inputs = [Record(dllp_request_layout, name="entry_%d" % i) for i in range(count)]
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        tx = self.tx
+
+        # The posted entry with the lowest index gets selected
+        selected = Signal(range(len(self.inputs)))
+        for i in reversed(range(len(self.inputs))):
+            with m.If(self.inputs[i].valid):
+                m.d.comb += selected.eq(i)
+
+        with m.Switch(selected):
+            for i, entry in enumerate(self.inputs):
+                with m.Case(i):
+                    m.d.comb += [tx.dllp[name].eq(entry[name]) for name, _ in dllp_layout]
+                    m.d.comb += entry.ready.eq(tx.ready)
+
+        m.d.comb += tx.send.eq(Cat(entry.valid for entry in self.inputs).any())
 
         return m
 
 class PCIeDLLPReceiver(Elaboratable):
     """
-    PCIe Data Link Layer Packet receiver
+    PCIe Data Link Layer Packet receiver for 1:2 or 1:4 gearing
+
+    Parameters
+    ----------
+    packets : Record(packet_stream_layout(2)) or Record(packet_stream_layout(4))
+        Received packets from the RX Phy, TLPs get ignored
+    dllp : Record(dllp_layout)
+        Last received DLLP, dllp.valid is asserted for one clock cycle when it was received without errors
+    fifo_depth : int
+        Depth of the FIFO for received DLLPs
     """
-    def __init__(self, lane : PCIeScrambler, fifo_depth = 8):
+    def __init__(self, packets : Record, fifo_depth = 8):
+        self.ratio  = len(packets.data) // 8
+        assert self.ratio in [2, 4]
         self.dllp   = Record(dllp_layout)
         self.fifo   = DomainRenamer("rx")(SyncFIFOBuffered(width=len(self.dllp), depth=fifo_depth))
-        self.__lane = lane
+        self.__packets = packets
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        new_symbols = Signal(18)
-        m.d.rx += new_symbols.eq(self.__lane.rx_symbol)
-        symbols = [new_symbols[0:9], new_symbols[9:18]]
+        ratio = self.ratio
+        packets = self.__packets
+        data = [packets.data.word_select(i, 8) for i in range(ratio)]
 
-        # Align such that symbols are [0 1] [2 3] [4 5]
-        last_symbol = Signal(9)
-        m.d.rx += last_symbol.eq(symbols[1])
-        aligned_symbols = Cat(last_symbol[0:8], symbols[0][0:8])
+        # The DLLP is [0 1 2 3 CRC0 CRC1] without the framing symbols, byte n is in word n // ratio.
+        last_word = 5 // ratio
 
-        # Set up CRC (PCIe 1.1 page 167)
-        m.submodules.crc = crc = DomainRenamer("rx")(CRC(aligned_symbols, 0xFFFF, 0x100B, 16, Signal()))
+        # Set up CRC (PCIe 1.1 page 167), the first 4 bytes are in the words before the last one.
+        # It gets reset outside of them, so it starts from the initial value with the first word of the next DLLP.
+        m.submodules.crc = crc = DomainRenamer("rx")(ParallelCRC(packets.data, 0xFFFF, 0x100B, 16, Signal()))
         m.submodules.fifo = self.fifo
 
-        # See figure 3-11.
+        # See figure 3-11
         crc_out = ~Cat(crc.output[::-1])
+        crc_received = Cat(data[0], data[1])
 
-        m.d.rx += crc.reset.eq(self.__lane.rx_symbol[0:9] == Ctrl.SDP)
         m.d.comb += self.fifo.w_data.eq(self.dllp)
+        m.d.rx += self.fifo.w_en.eq(0)
+        m.d.rx += self.dllp.valid.eq(0)
+
+        # Store the DLLP fields of the bytes in the current word
+        def receive(word):
+            for n in range(word * ratio, min((word + 1) * ratio, 4)):
+                symbol = data[n % ratio]
+                if n == 0:
+                    m.d.rx += self.dllp.type.eq(symbol[4:8])
+                    m.d.rx += self.dllp.type_meta.eq(symbol[0:3])
+                elif n == 1:
+                    m.d.rx += self.dllp.header[2:8].eq(symbol[0:6])
+                elif n == 2:
+                    m.d.rx += self.dllp.header[0:2].eq(symbol[6:8])
+                    m.d.rx += Cat(self.dllp.data[8:12]).eq(symbol[0:4])
+                elif n == 3:
+                    m.d.rx += Cat(self.dllp.data[0:8]).eq(symbol[0:8])
+
+        full_word = packets.count == ratio
+
+        # The CRC only keeps running while the first 4 bytes of a DLLP are received
+        m.d.comb += crc.reset.eq(1)
+
+        # Packets always start with a new word, a DLLP which doesn't have the right length gets dropped
+        def start():
+            with m.If(packets.dllp & ~packets.last & full_word):
+                m.d.comb += crc.reset.eq(0)
+                m.d.rx += self.dllp.eq(0)
+                receive(0)
+                m.next = "rx-1"
+            with m.Else():
+                m.next = "Idle"
 
         with m.FSM(domain="rx"):
             with m.State("Idle"):
-                m.d.rx += self.fifo.w_en.eq(0)
-                m.d.rx += self.dllp.eq(0)
-                with m.If(symbols[0] == Ctrl.SDP):
-                    m.d.rx += self.dllp.type.eq(symbols[1][4:8])
-                    m.d.rx += self.dllp.type_meta.eq(symbols[1][0:3])
-                    m.next = "rx-1"
-
-            with m.State("rx-1"):
-                m.d.rx += self.dllp.header.eq(Cat(symbols[1][6:8], symbols[0][0:6]))
-                m.d.rx += Cat(self.dllp.data[8:12]).eq(symbols[1][0:4])
-
-                # Just in case there's some bad symbols in there, abort. Checking for the first symbol should be sufficient.
-                # DLLPs are transmitted every few dozen microseconds anyway.
-                with m.If(symbols[0][8]):
-                    m.next = "Idle"
-                with m.Else():
-                    m.next = "rx-2"
+                with m.If(packets.valid & packets.first):
+                    start()
 
-            with m.State("rx-2"):
-                m.d.rx += Cat(self.dllp.data[0:8]).eq(symbols[0][0:8])
+            for i in range(1, last_word + 1):
+                with m.State("rx-%d" % i):
+                    with m.If(packets.valid & packets.first):
+                        start()
 
-                with m.If(symbols[0][8]):
-                    m.next = "Idle"
-                with m.Else():
-                    m.next = "rx-3"
+                    # The RX Phy outputs the words of a packet without gaps
+                    with m.Elif(~packets.valid):
+                        m.next = "Idle"
 
-            with m.State("rx-3"):
-                with m.If(symbols[0][8]):
-                    m.next = "Idle"
-                with m.Else():
-                    # CRC input is just the lane data
-                    m.d.rx += self.dllp.valid.eq((symbols[1] == Ctrl.END) & (crc_out == crc.input))
-                    m.d.rx += self.fifo.w_en.eq(1)
-                    m.next = "Idle"
+                    if i < last_word:
+                        with m.Elif(packets.last | ~full_word):
+                            m.next = "Idle"
+                        with m.Else():
+                            m.d.comb += crc.reset.eq(0)
+                            receive(i)
+                            m.next = "rx-%d" % (i + 1)
+                    else:
+                        with m.Else():
+                            m.d.rx += self.dllp.valid.eq(packets.last & ~packets.bad & (packets.count == 2) &
+                                (crc_out == crc_received))
+                            m.d.rx += self.fifo.w_en.eq(1)
+                            m.next = "Idle"
 
-        return m
\ No newline at end of file
+        return m
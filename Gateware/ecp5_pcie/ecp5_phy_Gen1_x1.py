@@ -1,19 +1,37 @@
 from nmigen import *
 from nmigen.build import *
 from .ecp5_serdes_geared_x2 import LatticeECP5PCIeSERDESx2
+from .ecp5_serdes_geared_x4 import LatticeECP5PCIeSERDESx4
 from .ecp5_serdes import LatticeECP5PCIeSERDES
 from .serdes import PCIeSERDESAligner
 from .phy import PCIePhy
 
 class LatticeECP5PCIePhy(Elaboratable):
     """
-    A PCIe Phy for the ECP5 for PCIe Gen1 x1
+    A PCIe Phy for the ECP5 for PCIe Gen1 x1, optionally changing to 5 GT/s on an ECP5-5G
+
+    Parameters
+    ----------
+    gen2 : bool
+        Whether to support 5 GT/s, see LatticeECP5PCIeSERDES
+    ref_clk_freq : float
+        Frequency of the SERDES reference clock in Hz
+    ratio : int
+        Symbols per clock cycle, 2 for 1:2 gearing at 125 MHz or 4 for 1:4 gearing at 62.5 MHz with LatticeECP5PCIeSERDESx4
+    skp_interval : int
+        Symbol times between SKP ordered sets, see PCIePhyTX
+    n_fts : int
+        Number of FTSs needed to leave L0s, see PCIeLTSSM
     """
-    def __init__(self):
+    def __init__(self, gen2 = False, ref_clk_freq = 100e6, ratio = 2, skp_interval = 1300, n_fts = 255):
+        assert ratio == 2 or ratio == 4
         #self.__serdes = LatticeECP5PCIeSERDESx2() # Declare SERDES module with 1:2 gearing
-        self.__serdes = LatticeECP5PCIeSERDES(2) # Declare SERDES module with 1:2 gearing
+        if ratio == 2:
+            self.__serdes = LatticeECP5PCIeSERDES(2, gen2=gen2, ref_clk_freq=ref_clk_freq) # Declare SERDES module with 1:2 gearing
+        else:
+            self.__serdes = LatticeECP5PCIeSERDESx4(gen2=gen2, ref_clk_freq=ref_clk_freq) # Declare SERDES module with 1:4 gearing
         self.__aligner = DomainRenamer("rx")(PCIeSERDESAligner(self.__serdes.lane)) # Aligner for aligning COM symbols
-        self.phy = PCIePhy(self.__aligner)
+        self.phy = PCIePhy(self.__aligner, gen2, skp_interval, n_fts)
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
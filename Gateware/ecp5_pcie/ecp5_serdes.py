@@ -14,7 +14,11 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
     input pair. Only provides a single lane.
     Uses 1:1 or 1:2 gearing.
 
-    Clock frequencies are 250 MHz for 1:1 and 125 MHz for 1:2.
+    Clock frequencies are 250 MHz for 1:1 and 125 MHz for 1:2 at 2.5 GT/s and twice that at 5 GT/s.
+
+    With gen2 set, the PLLs run at 5 GT/s and the speed of the lane can be changed at runtime with its speed signal,
+    using the half rate mode of the channel for 2.5 GT/s. This needs an ECP5-5G and a reference clock of 200 or 250 MHz,
+    since the TX PLL multiplies the reference clock by at most 25.
 
     Parameters
     ----------
@@ -34,10 +38,21 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
         Which DCU to use
     CH : int
         Which channel within the DCU to use
+    gen2 : bool
+        Whether to support 5 GT/s
+    ref_clk_freq : float
+        Frequency of the reference clock in Hz
     """
-    def __init__(self, gearing, DCU=0, CH=0):
+    def __init__(self, gearing, DCU=0, CH=0, gen2=False, ref_clk_freq=100e6):
         assert gearing == 1 or gearing == 2
 
+        # The TX PLL generates the fastest bit clock, multiplying the reference clock
+        self.max_rate = 5e9 if gen2 else 2.5e9
+        self.gen2 = gen2
+        multiplier = self.max_rate / ref_clk_freq
+        assert multiplier in [8, 10, 16, 20, 25], "The reference clock needs to be 1/8, 1/10, 1/16, 1/20 or 1/25 of the bit rate"
+        self.multiplier = int(multiplier)
+
         self.ref_clk = Signal() # reference clock
 
         self.rx_clk = Signal()  # recovered word clock
@@ -71,8 +86,8 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
         lane = self.lane
         m.submodules += lane # Add the PCIe Lane as a submodule
 
-        platform.add_clock_constraint(self.rx_clk, 250e6 / self.gearing) # For NextPNR, set the maximum clock frequency such that errors are given
-        platform.add_clock_constraint(self.tx_clk, 250e6 / self.gearing)
+        platform.add_clock_constraint(self.rx_clk, self.max_rate / 10 / self.gearing) # For NextPNR, set the maximum clock frequency such that errors are given
+        platform.add_clock_constraint(self.tx_clk, self.max_rate / 10 / self.gearing)
 
         # RX and TX clock input signals, these go to the SERDES.
         rx_clk_i = Signal()
@@ -141,6 +156,12 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
         serdes_rx_reset = Signal()
         pcs_reset       = Signal()
 
+        # Speed, with gen2 the channel runs at half rate for 2.5 GT/s
+        speed_s   = Signal()
+        half_rate = Signal(reset=1)
+        if self.gen2:
+            m.submodules += FFSynchronizer(lane.speed, speed_s, o_domain="rx")
+
         with m.FSM(domain="rx"): # Inspirations taken from LUNA
             with m.State("init"):
                 m.d.rx += [
@@ -174,6 +195,10 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
                     serdes_rx_reset.eq(0),
                     pcs_reset      .eq(0),
                 ]
+                # Reset the receiver and the PCS after changing the speed, the TX PLL keeps running
+                with m.If(half_rate != ~speed_s):
+                    m.d.rx += half_rate.eq(~speed_s)
+                    m.next = "start-tx"
 
 
         # Clock domain crossing for status signals and tx data
@@ -281,8 +306,8 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
             # DCU — clocking
             "i_D_REFCLKI"             :self.ref_clk,
             "o_D_FFS_PLOL"            :tx_lol,
-            "p_D_REFCK_MODE"          :"0b100",   # 25x ref_clk
-            "p_D_TX_MAX_RATE"         :"2.5",     # 2.5 Gbps
+            "p_D_REFCK_MODE"          :{25: "0b100", 20: "0b000", 16: "0b010", 10: "0b001", 8: "0b011"}[self.multiplier], # 25x ref_clk for 2.5 Gbps from 100 MHz, TX_MAX_RATE / ref_clk in general
+            "p_D_TX_MAX_RATE"         :"5.0" if self.gen2 else "2.5", # 5 or 2.5 Gbps
             "p_D_TX_VCO_CK_DIV"       :"0b000",   # DIV/1
             "p_D_BITCLK_LOCAL_EN"     :"0b1",     # undocumented (PCIe sample code used)
             "p_D_SYNC_LOCAL_EN"       :"0b1",
@@ -330,6 +355,9 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
             "i_CHx_FFC_RRST"          :serdes_rx_reset,
             "i_CHx_FFC_LANE_RX_RST"   :0,
 
+            # RX CH — rate
+            "i_CHx_FFC_RATE_MODE_RX"  :half_rate if self.gen2 else 0,
+
             # RX CH ­— input
             "i_CHx_FFC_SB_INV_RX"     :rx_inv,
     
@@ -353,7 +381,7 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
             "p_CHx_AUTO_FACQ_EN"      :"0b1",     # undocumented (wizard value used)
             "p_CHx_AUTO_CALIB_EN"     :"0b1",     # undocumented (wizard value used)
             #"p_CHx_BAND_THRESHOLD"    :"0b00",
-            "p_CHx_CDR_MAX_RATE"      :"2.5",     # 2.5 Gbps
+            "p_CHx_CDR_MAX_RATE"      :"5.0" if self.gen2 else "2.5", # 5 or 2.5 Gbps
             "p_CHx_RX_DCO_CK_DIV"     :"0b000",   # DIV/1
             "p_CHx_PDEN_SEL"          :"0b1",     # phase detector disabled on ~LOS
             #"p_CHx_SEL_SD_RX_CLK"     :"0b1",     # FIFO driven by recovered clock
@@ -426,11 +454,14 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
             # TX CH — power management
             #"p_CHx_TPWDNB"           :"0b1",
             "p_CHx_TPWDNB"            :"0b0",
-            "i_CHx_FFC_TXPWDNB"       :1,
+            "i_CHx_FFC_TXPWDNB"       :~lane.power_down,
 
             # TX CH ­— reset
             "i_CHx_FFC_LANE_TX_RST"   :pcs_reset,
 
+            # TX CH — rate
+            "i_CHx_FFC_RATE_MODE_TX"  :half_rate if self.gen2 else 0,
+
             # TX CH ­— output
 
             "p_CHx_TXAMPLITUDE"       :"0d1000",  # 1000 mV
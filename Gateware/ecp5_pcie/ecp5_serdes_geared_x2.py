@@ -2,7 +2,7 @@ from nmigen import *
 from nmigen.build import *
 from nmigen.lib.cdc import FFSynchronizer, AsyncFFSynchronizer
 from nmigen.lib.fifo import AsyncFIFOBuffered, AsyncFIFO
-from .serdes import PCIeSERDESInterface, K, Ctrl
+from .serdes import PCIeSERDESInterface, PCIeElasticBuffer, K, Ctrl
 from .ecp5_serdes import LatticeECP5PCIeSERDES
 
 
@@ -21,6 +21,10 @@ class LatticeECP5PCIeSERDESx2(Elaboratable): # Based on Yumewatari
 
         # Bit Slip
         self.slip = Signal()
+
+        # Elastic buffers for the clock domain crossings, their fill levels can be monitored
+        self.rx_buffer = PCIeElasticBuffer(2, 20, w_domain="rxf", r_domain="rx")
+        self.tx_buffer = PCIeElasticBuffer(2, 24, w_domain="tx", r_domain="txf")
     
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
@@ -79,14 +83,14 @@ class LatticeECP5PCIeSERDESx2(Elaboratable): # Based on Yumewatari
         m.d.txf += serdes.lane.tx_e_idle    .eq(Mux(self.tx_clk, lane.tx_e_idle[1],     lane.tx_e_idle[0]))
 
 
-        # CDC
-        rx_fifo = m.submodules.rx_fifo = AsyncFIFOBuffered(width=20, depth=4, r_domain="rx", w_domain="rxf")
+        # CDC, with elastic buffers which compensate for clock differences with SKP ordered sets
+        rx_fifo = m.submodules.rx_fifo = self.rx_buffer
         m.d.rxf += rx_fifo.w_data.eq(Cat(lane.rx_symbol, lane.rx_valid))
         m.d.comb += Cat(self.lane.rx_symbol, self.lane.rx_valid).eq(rx_fifo.r_data)
         m.d.comb += rx_fifo.r_en.eq(1)
         m.d.rxf += rx_fifo.w_en.eq(self.rx_clk)
 
-        tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=24, depth=4, r_domain="txf", w_domain="tx")
+        tx_fifo = m.submodules.tx_fifo = self.tx_buffer
         m.d.comb += tx_fifo.w_data.eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
         m.d.txf  += Cat(lane.tx_symbol, lane.tx_set_disp, lane.tx_disp, lane.tx_e_idle).eq(tx_fifo.r_data)
         m.d.txf  += tx_fifo.r_en.eq(self.tx_clk)
@@ -103,6 +107,7 @@ class LatticeECP5PCIeSERDESx2(Elaboratable): # Based on Yumewatari
         serdes.lane.det_enable    = self.lane.det_enable
         serdes.lane.det_valid     = self.lane.det_valid
         serdes.lane.det_status    = self.lane.det_status
+        serdes.lane.power_down    = self.lane.power_down
         serdes.slip               = self.slip
 
 
@@ -0,0 +1,134 @@
+from nmigen import *
+from nmigen.build import *
+from nmigen.lib.cdc import FFSynchronizer
+from .serdes import PCIeSERDESInterface, PCIeElasticBuffer
+from .ecp5_serdes import LatticeECP5PCIeSERDES
+
+
+__all__ = ["LatticeECP5PCIeSERDESx4"]
+
+
+class LatticeECP5PCIeSERDESx4(Elaboratable):
+    """
+    Lattice ECP5 DCU with 1:4 gearing, four symbols per clock cycle at 62.5 MHz (125 MHz at 5 GT/s).
+    Uses the DCU with 1:2 gearing in the "rxf" and "txf" domains and a gearbox in the fabric, like LatticeECP5PCIeSERDESx2.
+
+    Both the "rx" and the "tx" domain are driven by the halved TX clock of the DCU. Received symbols cross from the recovered
+    clock to the TX clock with 2 symbols per word, where the elastic buffer can still drop SKP symbols, and get combined into
+    words of 4 symbols afterwards. This way the RX to TX crossing after it doesn't need to compensate for a clock difference,
+    which with 4 symbols per word is only possible in one direction.
+
+    Parameters
+    ----------
+    gen2 : bool
+        Whether to support 5 GT/s, see LatticeECP5PCIeSERDES
+    ref_clk_freq : float
+        Frequency of the reference clock in Hz
+
+    Attributes
+    ----------
+    rx_clk : Signal
+        Word clock for the "rx" domain
+    tx_clk : Signal
+        Word clock for the "tx" domain, the same as rx_clk
+    lane : PCIeSERDESInterface(4)
+        The PCIe lane in the "rx" and "tx" domains
+    slip : Signal
+        Bit slip
+    """
+    def __init__(self, gen2 = False, ref_clk_freq = 100e6):
+        self.serdes = LatticeECP5PCIeSERDES(2, gen2=gen2, ref_clk_freq=ref_clk_freq)
+
+        self.rx_clk = Signal()
+        self.tx_clk = self.rx_clk
+
+        # The PCIe lane with all signals necessary to control it
+        self.lane = PCIeSERDESInterface(4)
+
+        # Bit Slip
+        self.slip = Signal()
+
+        # Elastic buffers for the clock domain crossings, their fill levels can be monitored
+        self.rx_buffer = PCIeElasticBuffer(2, 20, w_domain="rxf", r_domain="txf")
+        self.gear_buffer = PCIeElasticBuffer(4, 40, w_domain="txf", r_domain="rx")
+        self.tx_buffer = PCIeElasticBuffer(4, 48, w_domain="tx", r_domain="txf")
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        serdes = self.serdes
+        m.submodules.serdes = DomainRenamer({"rx": "rxf", "tx": "txf"})(serdes)
+        m.submodules.lane = self.lane
+
+        m.domains += [ClockDomain("rxf"), ClockDomain("txf")]
+        m.d.comb += [
+            ClockSignal("rxf").eq(serdes.rx_clk),
+            ClockSignal("txf").eq(serdes.tx_clk),
+        ]
+
+        platform.add_clock_constraint(self.rx_clk, serdes.max_rate / 10 / 4) # For NextPNR, set the maximum clock frequency such that errors are given
+
+        # The word clock toggles with the TX clock of the DCU, with the halves of a word being transferred in alternate cycles
+        m.d.txf += self.rx_clk.eq(~self.rx_clk)
+
+        # RX clock domain crossing into the TX clock of the DCU, the symbols come first so the buffer can find SKP ordered sets
+        rx_buffer = m.submodules.rx_buffer = self.rx_buffer
+        m.d.comb += [
+            rx_buffer.w_data.eq(Cat(serdes.lane.rx_symbol, serdes.lane.rx_valid)),
+            rx_buffer.w_en.eq(1),
+            rx_buffer.r_en.eq(1),
+        ]
+        rx_symbol = rx_buffer.r_data[0:18]
+        rx_valid = rx_buffer.r_data[18:20] & Repl(rx_buffer.r_rdy, 2)
+
+        # Combine two words into one
+        symbols = Signal(36)
+        valid = Signal(4)
+        with m.If(self.rx_clk):
+            m.d.txf += symbols[18:36].eq(rx_symbol)
+            m.d.txf += valid[2:4].eq(rx_valid)
+        with m.Else():
+            m.d.txf += symbols[0:18].eq(rx_symbol)
+            m.d.txf += valid[0:2].eq(rx_valid)
+
+        # Both clocks come from the same source, so this buffer never needs to drop or repeat anything
+        gear_buffer = m.submodules.gear_buffer = self.gear_buffer
+        m.d.comb += gear_buffer.w_data.eq(Cat(symbols, valid))
+        m.d.txf += gear_buffer.w_en.eq(self.rx_clk)
+        m.d.comb += [
+            gear_buffer.r_en.eq(1),
+            self.lane.rx_symbol.eq(gear_buffer.r_data[0:36]),
+            self.lane.rx_valid.eq(gear_buffer.r_data[36:40] & Repl(gear_buffer.r_rdy, 4)),
+        ]
+
+        # TX clock domain crossing, split every word into two
+        tx_buffer = m.submodules.tx_buffer = self.tx_buffer
+        tx_symbol = Signal(36)
+        tx_set_disp = Signal(4)
+        tx_disp = Signal(4)
+        tx_e_idle = Signal(4)
+        m.d.comb += tx_buffer.w_data.eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
+        m.d.comb += tx_buffer.w_en.eq(1)
+        m.d.txf  += Cat(tx_symbol, tx_set_disp, tx_disp, tx_e_idle).eq(tx_buffer.r_data)
+        m.d.txf  += tx_buffer.r_en.eq(self.rx_clk)
+
+        m.d.txf += serdes.lane.tx_symbol    .eq(Mux(self.rx_clk, tx_symbol[18:36],  tx_symbol[0:18]))
+        m.d.txf += serdes.lane.tx_set_disp  .eq(Mux(self.rx_clk, tx_set_disp[2:4],  tx_set_disp[0:2]))
+        m.d.txf += serdes.lane.tx_disp      .eq(Mux(self.rx_clk, tx_disp[2:4],      tx_disp[0:2]))
+        m.d.txf += serdes.lane.tx_e_idle    .eq(Mux(self.rx_clk, tx_e_idle[2:4],    tx_e_idle[0:2]))
+
+        # Control and status signals
+        m.d.comb += [
+            serdes.lane.rx_invert.eq(self.lane.rx_invert),
+            serdes.lane.rx_align.eq(self.lane.rx_align),
+            serdes.lane.det_enable.eq(self.lane.det_enable),
+            serdes.lane.power_down.eq(self.lane.power_down),
+            serdes.lane.speed.eq(self.lane.speed),
+            serdes.slip.eq(self.slip),
+        ]
+        m.submodules += FFSynchronizer(
+            Cat(serdes.lane.rx_present, serdes.lane.rx_locked, serdes.lane.rx_aligned, serdes.lane.tx_locked, serdes.lane.det_valid, serdes.lane.det_status),
+            Cat(self.lane.rx_present, self.lane.rx_locked, self.lane.rx_aligned, self.lane.tx_locked, self.lane.det_valid, self.lane.det_status),
+            o_domain="rx")
+
+        return m
@@ -0,0 +1,211 @@
+from nmigen import *
+from nmigen.build import *
+from .serdes import Ctrl, PCIeScrambler
+from .layouts import packet_stream_layout, symbol_stream_layout
+
+
+__all__ = ["PCIeRXFramer", "PCIeTXArbiter"]
+
+
+class PCIeRXFramer(Elaboratable):
+    """
+    Splits the received symbols into DLLPs and TLPs for 1:2 or 1:4 gearing.
+
+    The bytes between STP or SDP and END or EDB are tagged with the packet markers and packed together, ordered sets and
+    logical idle get dropped. Packets can start in any symbol slot. A packet ends at the first symbol which isn't a data
+    symbol, if that isn't END or if the symbol didn't decode properly, the packet is marked as bad. Packets ended by EDB
+    are additionally marked with edb, so that nullified TLPs can be told apart from framing errors. Since END is only known
+    after the last byte of a packet, the framer looks one word ahead, the data gets delayed by two clock cycles.
+
+    Packed bytes go into a buffer and every clock cycle up to ratio bytes of one packet are output from it. A word is only
+    output once it is full or ends the packet, so only the last word of a packet can have less than ratio bytes and the
+    words of a packet follow each other without gaps.
+    DLLPs and TLPs always are a multiple of 4 symbols long, so with this the buffer doesn't grow. If a malformed packet
+    fills it anyway, the bytes which don't fit get dropped and the CRC or LCRC check of the packet fails.
+
+    Parameters
+    ----------
+    lane : PCIeScrambler
+        Descrambled lane
+    enable : Signal()
+        Enable packet reception, the buffer gets cleared when deasserted
+    packets : Record(packet_stream_layout(lane.ratio))
+        Received packets
+    depth : int
+        Size of the buffer in bytes
+    """
+    def __init__(self, lane : PCIeScrambler, depth = None):
+        assert lane.ratio in [2, 4]
+        self.lane = lane
+        self.enable = Signal()
+        self.packets = Record(packet_stream_layout(lane.ratio))
+        self.depth = 3 * lane.ratio if depth is None else depth
+        assert self.depth >= 2 * lane.ratio
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        lane = self.lane
+        ratio = lane.ratio
+        depth = self.depth
+        packets = self.packets
+
+        # A buffered byte is Cat(data, first, last, bad, edb, dllp)
+        def byte(data, first, last, bad, edb, dllp):
+            return Cat(data[0:8], first, last, bad, edb, dllp)
+        FIRST, LAST, BAD, EDB, DLLP = 8, 9, 10, 11, 12
+
+        # The previous word gets framed, the first symbol of the current word is the one following its last symbol
+        last_symbols = Signal(9 * ratio)
+        last_valid = Signal(ratio)
+        m.d.rx += last_symbols.eq(lane.rx_symbol)
+        m.d.rx += last_valid.eq(lane.rx_valid)
+        symbols = [(last_symbols.word_select(i, 9), last_valid[i]) for i in range(ratio)]
+        symbols.append((lane.rx_symbol[0:9], lane.rx_valid[0]))
+
+        def is_data(symbol, valid):
+            return (symbol[8] == 0) & valid
+
+        # State after the last framed symbol
+        in_packet = Signal()
+        dllp = Signal()
+        after_start = Signal()
+
+        receiving = in_packet & self.enable
+        is_dllp = dllp
+        first = after_start
+        tagged = []
+        for i in range(ratio):
+            symbol, valid = symbols[i]
+            next_symbol, next_valid = symbols[i + 1]
+
+            start = self.enable & valid & ((symbol == Ctrl.STP) | (symbol == Ctrl.SDP))
+            data = receiving & is_data(symbol, valid)
+            last = ~is_data(next_symbol, next_valid)
+            bad = ~((next_symbol == Ctrl.END) & next_valid)
+            edb = (next_symbol == Ctrl.EDB) & next_valid
+            tagged.append((data, byte(symbol, first, last, last & bad, last & edb, is_dllp)))
+
+            receiving = start | data
+            is_dllp = Mux(start, symbol == Ctrl.SDP, is_dllp)
+            first = start
+
+        m.d.rx += [
+            in_packet.eq(receiving),
+            dllp.eq(is_dllp),
+            after_start.eq(first),
+        ]
+
+        # Pack the bytes of the word, they can belong to two different packets
+        new_bytes = [Signal(13, name="new_byte_%d" % i) for i in range(ratio)]
+        new_count = Signal(range(ratio + 1))
+        position = Const(0, range(ratio + 1))
+        for data, value in tagged:
+            for j in range(ratio):
+                with m.If(data & (position == j)):
+                    m.d.comb += new_bytes[j].eq(value)
+            position = position + data
+        m.d.comb += new_count.eq(position)
+
+        # Output the bytes at the start of the buffer up to the end of the packet, once there are enough for a full word
+        buffer = [Signal(13, name="buffer_%d" % i) for i in range(depth)]
+        count = Signal(range(depth + 1))
+
+        word_ready = (count >= ratio) | Cat((j < count) & buffer[j][LAST] for j in range(ratio)).any()
+        take = [Signal(name="take_%d" % j) for j in range(ratio)]
+        ended = Const(0)
+        for j in range(ratio):
+            m.d.comb += take[j].eq(word_ready & (j < count) & ~ended)
+            ended = ended | buffer[j][LAST]
+        taken = Signal(range(ratio + 1))
+        m.d.comb += taken.eq(sum(take))
+
+        m.d.comb += [
+            packets.data.eq(Cat(buffer[j][0:8] for j in range(ratio))),
+            packets.count.eq(taken),
+            packets.valid.eq(take[0]),
+            packets.first.eq(buffer[0][FIRST]),
+            packets.last.eq(Cat(take[j] & buffer[j][LAST] for j in range(ratio)).any()),
+            packets.bad.eq(Cat(take[j] & buffer[j][BAD] for j in range(ratio)).any()),
+            packets.edb.eq(Cat(take[j] & buffer[j][EDB] for j in range(ratio)).any()),
+            packets.dllp.eq(buffer[0][DLLP]),
+        ]
+
+        # Remove the output bytes and append the new ones
+        remaining = Signal(range(depth + 1))
+        m.d.comb += remaining.eq(count - taken)
+        for k in range(depth):
+            with m.Switch(taken):
+                for n in range(ratio + 1):
+                    with m.Case(n):
+                        m.d.rx += buffer[k].eq(buffer[k + n] if k + n < depth else 0)
+            for j in range(ratio):
+                with m.If((j < new_count) & (remaining + j == k)):
+                    m.d.rx += buffer[k].eq(new_bytes[j])
+
+        with m.If(~self.enable):
+            m.d.rx += count.eq(0)
+        with m.Elif(remaining + new_count > depth):
+            m.d.rx += count.eq(depth)
+        with m.Else():
+            m.d.rx += count.eq(remaining + new_count)
+
+        return m
+
+
+class PCIeTXArbiter(Elaboratable):
+    """
+    Merges the symbol streams of several packet sources, like the DLLP and TLP transmitters, into the one to the TX Phy.
+
+    The arbiter only switches between sources after the last word of a packet. Of the sources which have a packet to
+    send, the one with the lowest index gets it sent first.
+
+    Parameters
+    ----------
+    out_symbols : Record(symbol_stream_layout(ratio))
+        Symbol stream to the TX Phy
+    count : int
+        Number of sources
+    inputs : list of Record(symbol_stream_layout(ratio))
+        Symbol streams of the sources, highest priority first
+    """
+    def __init__(self, out_symbols : Record, count = 2):
+        self.ratio = len(out_symbols.data) // 9
+        self.out_symbols = out_symbols
+        self.inputs = [Record(symbol_stream_layout(self.ratio), name="input_%d" % i) for i in range(count)]
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        out = self.out_symbols
+
+        # Source whose packet is being sent
+        current = Signal(range(len(self.inputs)))
+        in_packet = Signal()
+
+        # Between packets, the source with the lowest index which has a word gets selected right away
+        selected = Signal(range(len(self.inputs)))
+        m.d.comb += selected.eq(current)
+        with m.If(~in_packet):
+            for i in reversed(range(len(self.inputs))):
+                with m.If(self.inputs[i].valid):
+                    m.d.comb += selected.eq(i)
+
+        with m.Switch(selected):
+            for i, source in enumerate(self.inputs):
+                with m.Case(i):
+                    m.d.comb += [
+                        out.data.eq(source.data),
+                        out.valid.eq(source.valid),
+                        out.first.eq(source.first),
+                        out.last.eq(source.last),
+                        source.ready.eq(out.ready),
+                    ]
+
+        with m.If(out.valid & out.ready):
+            m.d.rx += [
+                current.eq(selected),
+                in_packet.eq(~out.last),
+            ]
+
+        return m
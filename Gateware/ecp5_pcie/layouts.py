@@ -1,3 +1,5 @@
+from nmigen.utils import bits_for
+
 __all__ = ["ts_layout"]
 
 
@@ -40,6 +42,9 @@ ltssm_layout = [
     ("recv_err", 2),
     ("presence",1),
     ("idle_to_rlock_transitioned", 8),
+    ("tx_l0s", 1), # Transmitter is in L0s
+    ("rx_l0s", 1), # Receiver is in L0s
+    ("l1", 1), # Link is in L1
 ]
 
 dllp_layout = [
@@ -50,6 +55,16 @@ dllp_layout = [
     ("valid", 1),       # CRC valid
 ]
 
+dllp_request_layout = dllp_layout + [
+    ("ready", 1),       # The DLLP transmitter takes the DLLP in this clock cycle
+]
+
+acknak_layout = [
+    ("valid", 1),       # An Ack or Nak DLLP was received
+    ("nak", 1),         # 0: Ack, 1: Nak
+    ("seq", 12),        # AckNak_Seq_Num
+]
+
 dll_layout = [
     ("PH", 12),
     ("PD", 12),
@@ -57,4 +72,44 @@ dll_layout = [
     ("NPD", 12),
     ("CPLH", 12),
     ("CPLD", 12),
-]
\ No newline at end of file
+]
+
+# Flow control credits of a TLP, one header credit and the data credits
+fc_request_layout = [
+    ("type", 2),        # 0: Posted, 1: Non-Posted, 2: Completion
+    ("data", 9),        # Data credits, the payload in units of 4 DWs rounded up
+]
+
+# Stream of symbols between the PHY and the link layer, ratio symbols per word
+def symbol_stream_layout(ratio):
+    return [
+        ("data", 9 * ratio), # Symbols, the first one in the lowest bits
+        ("valid", 1),       # data is valid
+        ("ready", 1),       # Receiving side takes data in this cycle, driven by the receiving side
+        ("first", 1),       # First word of a packet
+        ("last", 1),        # Last word of a packet
+    ]
+
+# Stream of received packets, ratio bytes per word. Every word only has bytes of one packet, starting with the lowest bits.
+def packet_stream_layout(ratio):
+    return [
+        ("data", 8 * ratio), # Packet bytes without the framing symbols, the first one in the lowest bits
+        ("count", bits_for(ratio)), # Number of valid bytes in data
+        ("valid", 1),       # data is valid
+        ("first", 1),       # First word of a packet
+        ("last", 1),        # Last word of a packet
+        ("bad", 1),         # The packet ended with EDB or a framing error, only set together with last
+        ("edb", 1),         # The packet ended with EDB, only set together with bad
+        ("dllp", 1),        # 1: DLLP, started by SDP, 0: TLP, started by STP
+    ]
+
+# Stream of TLPs between the data link layer and the transaction layer, ratio bytes per word.
+# TLPs are a multiple of 4 bytes long, so every word is full.
+def tlp_stream_layout(ratio):
+    return [
+        ("data", 8 * ratio), # TLP bytes, the first one in the lowest bits
+        ("valid", 1),       # data is valid
+        ("ready", 1),       # Receiving side takes data in this cycle, driven by the receiving side
+        ("first", 1),       # First word of a TLP
+        ("last", 1),        # Last word of a TLP
+    ]
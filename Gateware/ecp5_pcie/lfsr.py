@@ -2,7 +2,25 @@ from nmigen import *
 from nmigen.build import *
 
 
-__all__ = ["PCIeLFSR"]
+__all__ = ["PCIeLFSR", "PCIeParallelLFSR", "PCIeKeystreamTable", "lfsr_advance"]
+
+
+def lfsr_advance(state, advances = 1):
+    """
+    State of the PCIe LFSR after advancing it
+
+    Parameters
+    ----------
+    state : int
+        Current state
+    advances : int
+        How often to advance the LFSR
+
+    Returns: int
+    """
+    for _ in range(advances):
+        state = ((state >> 8) | ((state & 0xFF) << 8)) ^ ((state & 0xFF00) >> 5) ^ ((state & 0xFF00) >> 4) ^ ((state & 0xFF00) >> 3)
+    return state
 
 
 class PCIeLFSR(Elaboratable):
@@ -75,4 +93,182 @@ class PCIeLFSR(Elaboratable):
         for i in range(self.__bytes):
             m.d.comb += self.output.word_select(i, 9).eq(states[i][15:7:-1])
 
-        return m
\ No newline at end of file
+        return m
+
+
+class PCIeParallelLFSR(Elaboratable):
+    """
+    PCIe Linear Feedback Shift Register for scrambling words of **ratio** symbols, COM and SKP can be in any symbol of a word.
+    The LFSR is linear, so advancing it by k symbols is a matrix multiplication. These matrices are precomputed for k = 0..ratio.
+
+    Parameters
+    ----------
+    ratio : int
+        Number of symbols per word
+    reset : Signal(ratio)
+        Reset LFSR after that symbol, should be 'symbol == Ctrl.COM' for each symbol
+    advance : Signal(ratio)
+        Advance LFSR after that symbol, should be 'symbol != Ctrl.SKP' for each symbol
+    
+    output : Signal(9 * ratio)
+        output data for scrambling. XOR symbols with this to scramble. 9th bit is 0
+    latency : int
+        Clock cycles by which the output is late
+    """
+    def __init__(self, ratio, reset = None, advance = None):
+        self.ratio = ratio
+        self.reset = Signal(ratio) if reset is None else reset
+        self.advance = Signal(ratio, reset = 2 ** ratio - 1) if advance is None else advance
+        self.output = Signal(9 * ratio)
+        self.latency = 0
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        state = Signal(16, reset=0xFFFF)
+
+        # Bit j of advanced[k][i] says whether bit j of the state contributes to bit i of the state advanced by k symbols
+        advanced = [[0] * 16 for _ in range(self.ratio + 1)]
+        for j in range(16):
+            for k in range(self.ratio + 1):
+                column = lfsr_advance(1 << j, k)
+                for i in range(16):
+                    if column & (1 << i):
+                        advanced[k][i] |= 1 << j
+
+        def advance_state(k):
+            return Cat(Cat(state[j] for j in range(16) if advanced[k][i] & (1 << j)).xor() if advanced[k][i] else Const(0, 1) for i in range(16))
+
+        advanced_states = Array(advance_state(k) for k in range(self.ratio + 1))
+
+        # State before each symbol and after the last symbol
+        states = [Signal(16, name="state_{}".format(i)) for i in range(self.ratio + 1)]
+        for i in range(self.ratio + 1):
+            m.d.comb += states[i].eq(advanced_states[sum(self.advance[j] for j in range(i)) if i > 0 else 0])
+
+            # After a COM, the LFSR starts at 0xFFFF and advances from there. The last COM takes priority.
+            for j in range(i):
+                with m.If(self.reset[j]):
+                    reset_states = Array(Const(lfsr_advance(0xFFFF, k), 16) for k in range(i - j))
+                    m.d.comb += states[i].eq(reset_states[sum(self.advance[l] for l in range(j + 1, i)) if i > j + 1 else 0])
+
+        m.d.rx += state.eq(states[self.ratio])
+
+        for i in range(self.ratio):
+            m.d.comb += self.output.word_select(i, 9).eq(states[i][15:7:-1])
+
+        return m
+
+
+class PCIeKeystreamTable(Elaboratable):
+    """
+    Replacement for PCIeParallelLFSR, which reads the scrambling data from a table in block RAM instead of calculating it.
+    The LFSR repeats after 65535 advances, so the table stores 65535 bytes (31 DP16KD for ratio 2), indexed by a pointer which counts the advances since the last COM.
+    The output is two clock cycles late, to give the block RAM and the multiplexer combining the block RAMs a full clock cycle each.
+
+    Parameters
+    ----------
+    ratio : int
+        Number of symbols per word, needs to be a power of 2
+    reset : Signal(ratio)
+        Reset LFSR after that symbol, should be 'symbol == Ctrl.COM' for each symbol
+    advance : Signal(ratio)
+        Advance LFSR after that symbol, should be 'symbol != Ctrl.SKP' for each symbol
+    period : int
+        Number of keys in the table after which the pointer wraps around. Only shorter than the period of the LFSR to
+        simulate the wrap-around, the table doesn't repeat the LFSR then.
+    
+    output : Signal(9 * ratio)
+        output data for scrambling the symbols of two clock cycles ago. XOR symbols with this to scramble. 9th bit is 0
+    latency : int
+        Clock cycles by which the output is late
+    """
+    def __init__(self, ratio, reset = None, advance = None, period = 2 ** 16 - 1):
+        assert ratio & (ratio - 1) == 0
+        assert ratio < period <= 2 ** 16 - 1
+        self.ratio = ratio
+        self.period = period
+        self.reset = Signal(ratio) if reset is None else reset
+        self.advance = Signal(ratio, reset = 2 ** ratio - 1) if advance is None else advance
+        self.output = Signal(9 * ratio)
+        self.latency = 2
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        ratio = self.ratio
+        period = self.period
+        shift = ratio.bit_length() - 1
+
+        # Same sequence as in Tests/generate_lfsr.py, but starting at 0xFFFF and with the output bit order of the LFSR
+        keys = []
+        state = 0xFFFF
+        for _ in range(period):
+            keys.append(int("{:08b}".format(state >> 8)[::-1], 2))
+            state = lfsr_advance(state)
+
+        # Each row holds **ratio** keys. The rows continue past the end of the period, so the two rows read at once never wrap around.
+        rows = (period + ratio - 1) // ratio + 1
+        init = [sum(keys[(row * ratio + i) % period] << (8 * i) for i in range(ratio)) for row in range(rows)]
+        table = Memory(width=8 * ratio, depth=rows, init=init)
+
+        # Index of the key for the first symbol of the current word
+        pointer = Signal(16)
+        next_pointer = Signal(16)
+
+        # Count of advances since the start of the word or since the last COM, for each symbol and after the last one
+        counts = [Signal(range(ratio + 1), name="count_{}".format(i)) for i in range(ratio + 1)]
+        after_reset = [Signal(name="after_reset_{}".format(i)) for i in range(ratio + 1)]
+        for i in range(ratio + 1):
+            m.d.comb += counts[i].eq(sum(self.advance[j] for j in range(i)) if i > 0 else 0)
+            for j in range(i):
+                with m.If(self.reset[j]):
+                    m.d.comb += counts[i].eq(sum(self.advance[l] for l in range(j + 1, i)) if i > j + 1 else 0)
+                    m.d.comb += after_reset[i].eq(1)
+
+        with m.If(after_reset[ratio]):
+            m.d.comb += next_pointer.eq(counts[ratio])
+        with m.Elif(pointer + counts[ratio] >= period):
+            m.d.comb += next_pointer.eq(pointer + counts[ratio] - period)
+        with m.Else():
+            m.d.comb += next_pointer.eq(pointer + counts[ratio])
+
+        m.d.rx += pointer.eq(next_pointer)
+
+        # The rows for the current word are read with the current pointer and are available in the next clock cycle
+        first_row = Signal(range(rows))
+        second_row = Signal(range(rows), reset=1)
+        m.d.rx += first_row.eq(next_pointer >> shift)
+        m.d.rx += second_row.eq((next_pointer >> shift) + 1)
+
+        m.submodules.read_first = read_first = table.read_port(domain="rx")
+        m.submodules.read_second = read_second = table.read_port(domain="rx")
+        m.d.comb += read_first.addr.eq(first_row)
+        m.d.comb += read_second.addr.eq(second_row)
+
+        # The block RAMs get combined by a large multiplexer, which gets its own clock cycle
+        window = Signal(16 * ratio)
+        m.d.rx += window.eq(Cat(read_first.data, read_second.data))
+
+        # Delay everything else by two clock cycles to match
+        def delay(signal):
+            for _ in range(self.latency):
+                delayed = Signal.like(signal)
+                m.d.rx += delayed.eq(signal)
+                signal = delayed
+            return signal
+
+        offset = delay(pointer[:shift]) if shift > 0 else 0
+
+        for i in range(ratio):
+            count = delay(counts[i])
+            reset = delay(after_reset[i])
+
+            # After a COM, the keys are the first ones of the table
+            reset_keys = Array(Const(keys[k], 8) for k in range(i + 1))
+            with m.If(reset):
+                m.d.comb += self.output.word_select(i, 9).eq(reset_keys[count])
+            with m.Else():
+                m.d.comb += self.output.word_select(i, 9).eq(window.word_select(offset + count, 8))
+
+        return m
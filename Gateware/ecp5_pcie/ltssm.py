@@ -31,22 +31,67 @@ class State(IntEnum):
     Recovery_RcvrCfg = 15
     Recovery_Idle = 16
     L0 = 17
+    Recovery_Speed = 18
+    L1_Entry = 19
+    L1 = 19
+    L1_Idle = 20
 
 class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
     """
-    PCIe Link Training and Status State Machine for 1:2 gearing
+    PCIe Link Training and Status State Machine for 1:2 or 1:4 gearing
+
+    With gen2, 5 GT/s gets advertised and once both sides support it, the link changes its speed through
+    Recovery.Speed after reaching L0, as soon as the first packet from the link partner shows that it is in L0 as well.
+    The clock frequency is assumed to double at 5 GT/s.
+
+    In L0, the transmitter and the receiver can enter L0s independently of each other. The transmitter leaves it
+    with as many FTSs as the link partner asked for, the receiver goes to Recovery if it doesn't get a SKP ordered set
+    after the FTSs in time.
+
+    L1 gets entered when the data link layer directs the LTSSM to it after the PM DLLP handshake. Both sides send an
+    EIOS, then the transmitter gets powered down. The link stays up in L1 and leaves it through Recovery, either when
+    the data link layer stops directing the LTSSM to L1 or when the link partner sends training sequences.
 
     Parameters
     ----------
     lane : PCIeSERDESInterface
         PCIe lane
+    gen2 : bool
+        Whether to support 5 GT/s
+    n_fts : int
+        Number of FTSs the link partner needs to send for the receiver to leave L0s
+    tx_l0s : Signal()
+        Put the transmitter into L0s while asserted and there is no data to send
+    enter_l1 : Signal()
+        Go to L1 once the link partner sent an EIOS and stay there while asserted, driven by the data link layer
+    retrain : Signal()
+        Go from L0 to Recovery, driven by the data link layer when REPLAY_NUM rolls over
+    clk_freq : float
+        Frequency of the "rx" clock at 2.5 GT/s in Hz, 250 MHz divided by the gearing ratio by default
+    time_scale : float
+        Factor all timeouts get multiplied with, for example 0.001 to make simulations reach them in reasonable time.
+        Every timeout takes at least one clock cycle.
+    upstream : bool
+        Whether this is the upstream component of the link, like a root port, which proposes the link and lane numbers
+        in Configuration. Endpoints are downstream components and accept the proposed numbers.
     """
-    def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX):
-        assert lane.ratio == 2
+    def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX, gen2 = False, n_fts = 255,
+                 clk_freq = None, time_scale = 1, upstream = False):
+        assert lane.ratio in [2, 4]
+        assert 0 <= n_fts <= 255
+        assert time_scale > 0
         self.lane = lane
         self.status = Record(ltssm_layout)
         self.tx = tx
         self.rx = rx
+        self.gen2 = gen2
+        self.n_fts = n_fts
+        self.clk_freq = 250e6 / lane.ratio if clk_freq is None else clk_freq
+        self.time_scale = time_scale
+        self.upstream = upstream
+        self.tx_l0s = Signal()
+        self.enter_l1 = Signal()
+        self.retrain = Signal()
 
         # Debug
         self.debug_state = Signal(8)
@@ -58,16 +103,15 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
         lane = self.lane
         status = self.status
-        clocks_per_ms = 125000 # TODO: Make this non hard coded maybe
-        #timer = Signal(range(64 * clocks_per_ms + 1))
+        clocks_per_ms = self.clk_freq / 1000 * self.time_scale
 
         # Number of Training Sequences received, usage depends on FSM state
         rx_ts_count = self.rx_ts_count
         tx_ts_count = self.tx_ts_count
 
-        # Counter for number of D0.0 symbols received
-        rx_idl_count = Signal(range(4 + 1))
-        tx_idl_count = Signal(range(8 + 1))
+        # Counter for number of words of D0.0 symbols received
+        rx_idl_count = Signal(range(8 // lane.ratio + 1))
+        tx_idl_count = Signal(range(16 // lane.ratio + 1))
 
         # Turn class variables to local variables, for easier code writing
         tx = self.tx
@@ -76,8 +120,47 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
         # Current FSM state, for debugging
         debug_state = self.debug_state
 
-        # Currently its Gen 1 only
+        # Advertise the supported speeds and the number of FTSs needed to leave L0s
         m.d.comb += tx.ts.rate.gen1.eq(1)
+        m.d.comb += tx.ts.rate.gen2.eq(self.gen2)
+        m.d.comb += tx.ts.n_fts.eq(self.n_fts)
+
+        # Speed change, PCIe 2.0 section 4.2.6.4
+        directed_speed_change = Signal()
+        successful_speed_negotiation = Signal()
+        changed_speed_recovery = Signal()
+        speed_change_failed = Signal() # Don't try to change the speed again after it failed once
+        partner_gen2 = Signal() # Whether the link partner advertised 5 GT/s in its last training sequence
+        partner_in_l0 = Signal() # Whether a packet was received in L0, the link partner can't be in Configuration then
+        m.d.comb += tx.ts.rate.speed_change.eq(directed_speed_change)
+
+        # Whether the speed change bit of received training sequences needs to match the transmitted one,
+        # otherwise it gets ignored like a 2.5 GT/s only device does
+        speed_change_matches = (rx.ts.rate.speed_change == directed_speed_change) | (not self.gen2) | speed_change_failed
+        m.d.comb += lane.speed.eq(status.link.speed)
+        partner_n_fts = Signal(8) # Number of FTSs the link partner needs
+        with m.If(rx.ts_received & rx.ts.valid):
+            m.d.rx += partner_gen2.eq(rx.ts.rate.gen2)
+            m.d.rx += partner_n_fts.eq(rx.ts.n_fts)
+
+        # L0s runs alongside L0, if the receiver couldn't leave L0s the LTSSM goes to Recovery
+        in_l0 = Signal()
+        rx_l0s_timeout = Signal()
+
+        def cycles(time_in_ms, scaled = True):
+            """
+            Returns the number of clock cycles in the given time at 2.5 GT/s, but at least one. Minimum times which the
+            link partner relies on, like how long to stay in electrical idle, don't get scaled with time_scale.
+            """
+            return max(1, int(time_in_ms * (clocks_per_ms if scaled else self.clk_freq / 1000)))
+
+        def clocks(time_in_ms, scaled = True):
+            """
+            Returns the number of clock cycles in the given time, at 5 GT/s the clock runs twice as fast
+            """
+            if self.gen2:
+                return Mux(status.link.speed, cycles(2 * time_in_ms, scaled), cycles(time_in_ms, scaled))
+            return cycles(time_in_ms, scaled)
         
         m.d.rx += tx.ts.ctrl.loopback.eq(0)
 
@@ -88,7 +171,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
         
         def reset_ts_count_and_jump(next_state):
             """
-            Goes to the next state and resets the TS counters
+            Goes to the next state and resets the TS and idle counters
 
             Parameters:
                 next_state:
@@ -96,14 +179,16 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
             """
             m.d.rx += rx_ts_count.eq(0)
             m.d.rx += tx_ts_count.eq(0)
+            m.d.rx += rx_idl_count.eq(0)
+            m.d.rx += tx_idl_count.eq(0)
             m.d.rx += timer.eq(0)
             m.next = next_state
 
 
         # Timer for the timeout function
-        timer = Signal(range(64 * clocks_per_ms + 1))
+        timer = Signal(range(cycles(128 if self.gen2 else 64) + 1))
 
-        def timeout(time_in_ms, next_state, or_conds=0):
+        def timeout(time_in_ms, next_state, or_conds=0, scaled=True):
             """
             Goes to the next state after a specified amount of time has passed
 
@@ -114,6 +199,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                     Next state of the FSM to go to
                 or_conds:
                     Other conditions which skip the timer
+                scaled: bool
+                    Whether the time gets scaled with time_scale
             
             Returns: Signal
                 Timer Signal in case it needs to be changed or reset
@@ -123,7 +210,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
             # Count down until t=0 or or_conds is true, then jump to the next state
             m.d.rx += timer.eq(timer + 1)
-            with m.If((timer == time_in_ms * clocks_per_ms) | or_conds):
+            with m.If((timer == clocks(time_in_ms, scaled)) | or_conds):
                 m.d.rx += timer.eq(0)
                 reset_ts_count_and_jump(next_state)
             return timer
@@ -136,10 +223,17 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
                 # The Link is now down and the TX SERDES is put into electrical idle
                 m.d.rx += status.link.up.eq(0)
-                m.d.rx += tx.eidle.eq(0b11)
+                m.d.rx += tx.eidle.eq((1 << lane.ratio) - 1)
                 m.d.rx += rx.ready.eq(0)
                 m.d.rx += tx.ready.eq(0)
 
+                # Start at 2.5 GT/s
+                m.d.rx += status.link.speed.eq(0)
+                m.d.rx += directed_speed_change.eq(0)
+                m.d.rx += changed_speed_recovery.eq(0)
+                m.d.rx += speed_change_failed.eq(0)
+                m.d.rx += partner_in_l0.eq(0)
+
                 # Enable scrambling
                 m.d.rx += scrambling.eq(1)
                 # But don't scramble TS
@@ -259,22 +353,37 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
             with m.State(State.Configuration_Linkwidth_Start): # Is missing Loopback and Disabled
                 m.d.rx += debug_state.eq(State.Configuration_Linkwidth_Start)
-                # Send TS1 ordered sets with Link and Lane set to PAD
-                m.d.rx += [
-                    tx.ts.valid.eq(1),
-                    tx.ts.ts_id.eq(0),
-                    tx.ts.link.valid.eq(0),
-                    tx.ts.lane.valid.eq(0),
-                ]
-
-                # Accept TS1s with Link=Upstream-Link Lane=PAD
-                # and set the link number of the TSs being sent to the received link number
-                # and go to Configuration.Linkwidth.Accept
-                with m.If(rx.consecutive & rx.ts.valid & (rx.ts.ts_id == 0)
-                & rx.ts.link.valid & ~rx.ts.lane.valid):
-                    m.d.rx += tx.ts.link.valid.eq(1)
-                    m.d.rx += tx.ts.link.number.eq(rx.ts.link.number)
-                    reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
+                if self.upstream:
+                    # Send TS1 ordered sets with the proposed Link number 0 and Lane set to PAD
+                    m.d.rx += [
+                        tx.ts.valid.eq(1),
+                        tx.ts.ts_id.eq(0),
+                        tx.ts.link.valid.eq(1),
+                        tx.ts.link.number.eq(0),
+                        tx.ts.lane.valid.eq(0),
+                    ]
+
+                    # Once the link partner sends the same Link number back with Lane=PAD, go to Configuration.Linkwidth.Accept
+                    with m.If(rx.consecutive & rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & ~rx.ts.lane.valid &
+                        (rx.ts.link.number == tx.ts.link.number)):
+                        reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
+                else:
+                    # Send TS1 ordered sets with Link and Lane set to PAD
+                    m.d.rx += [
+                        tx.ts.valid.eq(1),
+                        tx.ts.ts_id.eq(0),
+                        tx.ts.link.valid.eq(0),
+                        tx.ts.lane.valid.eq(0),
+                    ]
+
+                    # Accept TS1s with Link=Upstream-Link Lane=PAD
+                    # and set the link number of the TSs being sent to the received link number
+                    # and go to Configuration.Linkwidth.Accept
+                    with m.If(rx.consecutive & rx.ts.valid & (rx.ts.ts_id == 0)
+                    & rx.ts.link.valid & ~rx.ts.lane.valid):
+                        m.d.rx += tx.ts.link.valid.eq(1)
+                        m.d.rx += tx.ts.link.number.eq(rx.ts.link.number)
+                        reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
                 
                 timeout(24, State.Detect)
 
@@ -282,6 +391,12 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
             with m.State(State.Configuration_Linkwidth_Accept):
                 m.d.rx += debug_state.eq(State.Configuration_Linkwidth_Accept)
 
+                # The upstream component proposes lane number 0, in a x4 implementation it should be lane-dependent
+                if self.upstream:
+                    m.d.rx += tx.ts.lane.valid.eq(1)
+                    m.d.rx += tx.ts.lane.number.eq(0)
+                    reset_ts_count_and_jump(State.Configuration_Lanenum_Wait)
+
                 # Accept TS1 Link=Upstream-Link Lane=Upstream-Lane
                 # with the lane number 0, in a x4 implementation it should be lane-dependent.
                 # Report back that the received lane is valid.
@@ -310,6 +425,12 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                 # Accept TS2
                 with m.If(rx.ts.valid & (rx.ts.ts_id == 1) & rx.consecutive):
                     reset_ts_count_and_jump(State.Configuration_Lanenum_Accept)
+
+                # The upstream component accepts two consecutive TS1 with the Link and Lane numbers it proposed
+                if self.upstream:
+                    with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid & rx.consecutive &
+                        (rx.ts.link.number == tx.ts.link.number) & (rx.ts.lane.number == tx.ts.lane.number)):
+                        reset_ts_count_and_jump(State.Configuration_Lanenum_Accept)
                     
                 # After 2 milliseconds of invalid stuff being received or an invalid TS being received, go back.
                 timeout(2, State.Detect, (rx.ts.valid & (rx.ts.ts_id == 0) & ~rx.ts.link.valid & ~rx.ts.lane.valid))
@@ -318,8 +439,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
             with m.State(State.Configuration_Lanenum_Accept): # Revise for multiple lanes
                 m.d.rx += debug_state.eq(State.Configuration_Lanenum_Accept)
 
-                # Accept consecutive TS2 Link=Upstream-Link Lane=Upstream-Lane
-                with m.If(rx.ts.valid & (rx.ts.ts_id == 1) & rx.ts.link.valid & rx.ts.lane.valid):
+                # Accept consecutive TS2 Link=Upstream-Link Lane=Upstream-Lane, or TS1 for the upstream component
+                with m.If(rx.ts.valid & ((rx.ts.ts_id == 1) | self.upstream) & rx.ts.link.valid & rx.ts.lane.valid):
                     with m.If((rx.ts.link.number == tx.ts.link.number) & (rx.ts.lane.number == tx.ts.lane.number)):
                         with m.If(rx.consecutive):
                             reset_ts_count_and_jump(State.Configuration_Complete)
@@ -333,11 +454,10 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
             with m.State(State.Configuration_Complete):
                 m.d.rx += debug_state.eq(State.Configuration_Complete)
 
-                # Complete the configuration by sending TS1 packets with the configured values and request 255 fast training sequences for exiting L0s.
+                # Complete the configuration by sending TS2 packets with the configured values and n_fts fast training sequences for exiting L0s.
                 # And reset the TS counts.
                 m.d.rx += [
                     tx.ts.ts_id.eq(1),
-                    tx.ts.n_fts.eq(0xFF),
                     tx_ts_count.eq(0)
                 ]
                 m.d.rx += rx_ts_count.eq(0)
@@ -359,7 +479,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                     with m.If(rx.ts.valid & (rx.ts.ts_id == 1) & rx.ts.link.valid & rx.ts.lane.valid &
                         (rx.ts.link.number == tx.ts.link.number) &
                         (rx.ts.lane.number == tx.ts.lane.number) & rx.consecutive):
-                        with m.Elif(rx_ts_count < 8):
+                        with m.If(rx_ts_count < 8):
                             m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
                     with m.Else():
                         m.d.rx += rx_ts_count.eq(0)
@@ -382,20 +502,18 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                 m.d.rx += rx_ts_count.eq(0)
                 m.d.rx += status.link.scrambling.eq(scrambling)
 
-                # When 0x00 0x00 is received, wait until 8 have arrived and 16 sent after the first one has arrived.
-                with m.If(rx.idle):
-                    with m.If(rx_idl_count < 4):
+                # When 0x00 0x00 is received, wait until 8 have arrived in a row and 16 sent after that. The link partner
+                # may already be in L0 and send packets while the 16 are sent.
+                with m.If(rx_idl_count < 8 // lane.ratio):
+                    with m.If(rx.idle):
                         m.d.rx += rx_idl_count.eq(rx_idl_count + 1)
-                        m.d.rx += tx_idl_count.eq(0)
                     with m.Else():
-                        m.d.rx += tx_idl_count.eq(tx_idl_count + 1)
-                        with m.If(tx_idl_count >= 8):
-                            #m.d.rx += tx.idle.eq(0)
-                            m.d.rx += rx_idl_count.eq(0)
-                            m.d.rx += tx_idl_count.eq(0)
-                            reset_ts_count_and_jump(State.L0)
+                        m.d.rx += rx_idl_count.eq(0)
+                    m.d.rx += tx_idl_count.eq(0)
                 with m.Else():
-                    m.d.rx += rx_idl_count.eq(0)
+                    m.d.rx += tx_idl_count.eq(tx_idl_count + 1)
+                    with m.If(tx_idl_count >= 16 // lane.ratio):
+                        reset_ts_count_and_jump(State.L0)
 
                 # And the link should be configured!
                 #m.d.rx += status.link.up.eq(1)
@@ -421,24 +539,36 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                 m.d.rx += [
                     tx.ts.valid.eq(1),
                     tx.ts.ts_id.eq(0),
-                    status.link.up.eq(0), # Not sure if this is right
                     rx.ready.eq(0),
                     tx.ready.eq(0),
                 ]
 
                 # If a TS is received with the link and lane numbers matching the configured ones and 8 such have been received, go to Recovery.RcvrCfg
-                with m.If(rx.ts_received & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid &
-                    (rx.ts.link.number == tx.ts.link.number) &
-                    (rx.ts.lane.number == tx.ts.lane.number)):
+                # The speed change bit needs to match too, a link partner requesting a speed change gets followed if both support 5 GT/s.
+                ts_matches = rx.ts_received & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & \
+                    (rx.ts.link.number == tx.ts.link.number) & \
+                    (rx.ts.lane.number == tx.ts.lane.number)
+                with m.If(ts_matches & rx.ts.rate.speed_change & rx.ts.rate.gen2 & self.gen2 & ~speed_change_failed):
+                    m.d.rx += directed_speed_change.eq(1)
+                with m.If(ts_matches & speed_change_matches):
                     m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
                 with m.If(rx_ts_count == 8):
+                    m.d.rx += changed_speed_recovery.eq(status.link.speed)
                     reset_ts_count_and_jump(State.Recovery_RcvrCfg)
 
                 # If no TSn but something else was received, reset the RX counter
                 with m.If(~rx.recv_tsn): # Not consecutive, check if this works
                     m.d.rx += rx_ts_count.eq(0)
                 
-                timeout(24, State.Detect)
+                # If the link doesn't come up at 5 GT/s, change back to 2.5 GT/s, otherwise go to Detect
+                m.d.rx += timer.eq(timer + 1)
+                with m.If(timer == clocks(24)):
+                    with m.If(status.link.speed & ~changed_speed_recovery):
+                        m.d.rx += successful_speed_negotiation.eq(0)
+                        m.d.rx += speed_change_failed.eq(1)
+                        reset_ts_count_and_jump(State.Recovery_Speed)
+                    with m.Else():
+                        reset_ts_count_and_jump(State.Detect)
 
 
             with m.State(State.Recovery_RcvrCfg): # Revise when implementing 5 GT/s, page 290
@@ -461,16 +591,22 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                 with m.If(last_ts != rx.ts.ts_id):
                     m.d.rx += rx_ts_count.eq(0)
                 
-                # Count valid TS2s (valid link, lane, no speed change) and go to Recovery.Idle if so.
-                with m.If(rx.ts_received & (rx.ts.ts_id == 1) & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & (rx.ts.rate.speed_change == 0) &
+                # Count valid TS2s (valid link, lane, matching speed change) and go to Recovery.Idle if so,
+                # or to Recovery.Speed when changing the speed.
+                with m.If(rx.ts_received & (rx.ts.ts_id == 1) & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & speed_change_matches &
                     (rx.ts.link.number == tx.ts.link.number) &
                     (rx.ts.lane.number == tx.ts.lane.number)):
                     m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
-                with m.Else():
+                # ts_received is only asserted for one clock cycle per TS, only one that doesn't match resets the count
+                with m.Elif(rx.ts_received):
                     m.d.rx += rx_ts_count.eq(0)
                 with m.If((rx_ts_count == 8) & (last_ts == 1)):
                     m.d.rx += last_ts.eq(0)
-                    reset_ts_count_and_jump(State.Recovery_Idle)
+                    with m.If(directed_speed_change):
+                        m.d.rx += successful_speed_negotiation.eq(partner_gen2)
+                        reset_ts_count_and_jump(State.Recovery_Speed)
+                    with m.Else():
+                        reset_ts_count_and_jump(State.Recovery_Idle)
                 
                 # If 8 TS1s have been received and 16 TS2s sent, go back to Configuration
                 with m.If((rx_ts_count == 8) & (last_ts == 0) & (tx_ts_count == 16) & (rx.ts.rate.speed_change == 0)):
@@ -482,7 +618,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
             with m.State(State.Recovery_Idle):
                 m.d.rx += debug_state.eq(State.Recovery_Idle)
                 
-                # Set the transmitter to send IDL symbols
+                # Set the transmitter to send IDL symbols instead of TS2s
+                m.d.rx += tx.ts.valid.eq(0)
                 m.d.rx += tx.idle.eq(1)
 
                 # If two invalid lanes has been received, go back to Configuration
@@ -493,28 +630,27 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                     with m.Else():
                         reset_ts_count_and_jump(State.Configuration)
                 
-                # Wait for 8 D0.0 symbols, count 16 sent D0.0 symbols after first has been received, then go to L0 and reset idle_to_rlock_transitioned
-                with m.If(rx.idle):
-                    with m.If(rx_idl_count < 4):
+                # Wait for 8 D0.0 symbols in a row, count 16 sent D0.0 symbols after that, then go to L0 and reset
+                # idle_to_rlock_transitioned. Like in Configuration.Idle, the link partner may already send packets.
+                with m.If(rx_idl_count < 8 // lane.ratio):
+                    with m.If(rx.idle):
                         m.d.rx += rx_idl_count.eq(rx_idl_count + 1)
-                        m.d.rx += tx_idl_count.eq(0)
                     with m.Else():
-                        m.d.rx += tx_idl_count.eq(tx_idl_count + 1)
-                        with m.If(tx_idl_count >= 8):
-                            m.d.rx += status.idle_to_rlock_transitioned.eq(0)
-                            #m.d.rx += tx.idle.eq(0)
-                            m.d.rx += rx_idl_count.eq(0)
-                            m.d.rx += tx_idl_count.eq(0)
-                            reset_ts_count_and_jump(State.L0)
+                        m.d.rx += rx_idl_count.eq(0)
+                    m.d.rx += tx_idl_count.eq(0)
                 with m.Else():
-                    m.d.rx += rx_idl_count.eq(0)
+                    m.d.rx += tx_idl_count.eq(tx_idl_count + 1)
+                    with m.If(tx_idl_count >= 16 // lane.ratio):
+                        m.d.rx += status.idle_to_rlock_transitioned.eq(0)
+                        reset_ts_count_and_jump(State.L0)
                 
                 # After 2 ms go back to the beginning of Recovery if idle_to_rlock_transitioned is less than 255, otherwise to Detect.
-                timer = Signal(range(2 * clocks_per_ms + 1), reset = 2 * clocks_per_ms)
-                m.d.rx += timer.eq(timer - 1)
-                with m.If(timer == 0):
+                # This uses the shared timer, which the jumps into this state reset.
+                m.d.rx += timer.eq(timer + 1)
+                with m.If(timer == clocks(2)):
                     m.d.rx += tx.idle.eq(0)
                     with m.If(status.idle_to_rlock_transitioned < 0xFF):
+                        m.d.rx += status.idle_to_rlock_transitioned.eq(status.idle_to_rlock_transitioned + 1)
                         reset_ts_count_and_jump(State.Recovery_RcvrLock)
                     with m.Else():
                         reset_ts_count_and_jump(State.Detect)
@@ -522,6 +658,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
             with m.State(State.L0): # Page 297, implementation for 5 GT/s and higher lane counts missing
                 m.d.rx += debug_state.eq(State.L0)
+                m.d.comb += in_l0.eq(1)
                 # TBD
                 m.d.rx += status.link.up.eq(1)
                 m.d.rx += rx.ready.eq(1)
@@ -529,9 +666,169 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
                 
                 with m.If(rx.has_symbol(Ctrl.STP) | rx.has_symbol(Ctrl.SDP)):
                     m.d.rx += status.idle_to_rlock_transitioned.eq(0)
+                    m.d.rx += partner_in_l0.eq(1)
                 
-                with m.If(rx.ts_received):
+                m.d.rx += changed_speed_recovery.eq(0)
+
+                with m.If(rx.ts_received | rx_l0s_timeout | self.retrain):
                     m.next = State.Recovery
 
+                # Send an EIOS when directed to L1, once the link partner sent one too its receiver is in electrical
+                # idle and the link goes to L1
+                with m.Elif(self.enter_l1):
+                    m.d.comb += tx.send_eios.eq(1)
+                    m.d.rx += tx.ready.eq(0)
+                    with m.If(tx.electrical_idle & status.rx_l0s):
+                        m.d.rx += timer.eq(0)
+                        reset_ts_count_and_jump(State.L1_Entry)
+
+                # Change to 5 GT/s when both sides support it. The link partner may still be in Configuration.Idle when
+                # this side reaches L0, its first DLLP shows that it reached L0 too.
+                with m.Elif(~status.link.speed & partner_gen2 & self.gen2 & ~speed_change_failed & partner_in_l0):
+                    m.d.rx += directed_speed_change.eq(1)
+                    reset_ts_count_and_jump(State.Recovery)
+
+
+            # L1, page 209 in PCIe 1.1. Stay in electrical idle for at least T_TX-IDLE-MIN before powering down the
+            # transmitter. The link partner needs to see the electrical idle, so this time doesn't get scaled.
+            with m.State(State.L1_Entry):
+                m.d.rx += debug_state.eq(State.L1_Entry)
+                m.d.comb += [
+                    tx.send_eios.eq(1),
+                    status.l1.eq(1),
+                ]
+                m.d.rx += [
+                    rx.ready.eq(0),
+                    tx.ready.eq(0),
+                ]
+                timeout(0.00002, State.L1_Idle, scaled=False)
+
+            # Leave L1 through Recovery when not directed to L1 anymore or when the link partner left it
+            with m.State(State.L1_Idle):
+                m.d.rx += debug_state.eq(State.L1_Idle)
+                m.d.comb += [
+                    tx.send_eios.eq(1),
+                    lane.power_down.eq(1),
+                    status.l1.eq(1),
+                ]
+                with m.If(~self.enter_l1 | rx.ts_received):
+                    reset_ts_count_and_jump(State.Recovery)
+
+
+            with m.State(State.Recovery_Speed):
+                m.d.rx += debug_state.eq(State.Recovery_Speed)
+
+                # Go to electrical idle
+                m.d.rx += [
+                    tx.ts.valid.eq(0),
+                    tx.idle.eq(0),
+                    tx.eidle.eq((1 << lane.ratio) - 1),
+                ]
+
+                # Once the receiver is in electrical idle too, stay there for 800 ns or for 6 us if the speed negotiation failed,
+                # then change the speed and go back to Recovery.RcvrLock. The link partner needs to see the electrical idle,
+                # so these times don't get scaled.
+                eidle_timer = Signal(range(cycles(2 * 0.006, scaled=False) + 1))
+                with m.If(~lane.rx_present | (eidle_timer > 0)):
+                    m.d.rx += eidle_timer.eq(eidle_timer + 1)
+                with m.If(eidle_timer == Mux(successful_speed_negotiation, clocks(0.0008, scaled=False),
+                    clocks(0.006, scaled=False))):
+                    m.d.rx += [
+                        eidle_timer.eq(0),
+                        status.link.speed.eq(successful_speed_negotiation & partner_gen2 & self.gen2),
+                        directed_speed_change.eq(0),
+                        changed_speed_recovery.eq(0),
+                        tx.eidle.eq(0),
+                    ]
+                    reset_ts_count_and_jump(State.Recovery_RcvrLock)
+
+                timeout(48, State.Detect)
+
+
+        # L0s, page 206 in PCIe 1.1. T_TX-IDLE-MIN is 20 ns, the link partner needs to see the electrical idle, so it
+        # doesn't get scaled.
+        tx_idle_min = clocks(0.00002, scaled=False)
+        l0s_idle_max = cycles((2 if self.gen2 else 1) * 0.00002, scaled=False)
+
+        # Transmitter L0s, it leaves L0s once it's not requested anymore or there is data to send
+        tx_l0s_timer = Signal(range(l0s_idle_max + 1))
+        fts_count = Signal(8)
+        with m.FSM(domain="rx", name="tx_l0s_fsm"):
+            with m.State("L0"):
+                with m.If(in_l0 & self.tx_l0s & ~tx.in_symbols.valid):
+                    m.d.rx += tx_l0s_timer.eq(0)
+                    m.next = "Tx_L0s.Entry"
+
+            # Send an EIOS and stay in electrical idle for at least T_TX-IDLE-MIN
+            with m.State("Tx_L0s.Entry"):
+                m.d.comb += tx.send_eios.eq(1)
+                m.d.rx += tx.ready.eq(0)
+                with m.If(tx.electrical_idle):
+                    m.d.rx += tx_l0s_timer.eq(tx_l0s_timer + 1)
+                with m.If(~in_l0):
+                    m.next = "L0"
+                with m.Elif(tx_l0s_timer == tx_idle_min):
+                    m.next = "Tx_L0s.Idle"
+
+            with m.State("Tx_L0s.Idle"):
+                m.d.comb += tx.send_eios.eq(1)
+                m.d.comb += status.tx_l0s.eq(1)
+                m.d.rx += tx.ready.eq(0)
+                with m.If(~in_l0):
+                    m.next = "L0"
+                with m.Elif(~self.tx_l0s | tx.in_symbols.valid):
+                    m.d.rx += fts_count.eq(0)
+                    m.next = "Tx_L0s.FTS"
+
+            # Send N_FTS FTSs and a SKP ordered set, then continue with data
+            with m.State("Tx_L0s.FTS"):
+                m.d.rx += tx.ready.eq(0)
+                with m.If(~in_l0):
+                    m.next = "L0"
+                with m.Elif(fts_count < partner_n_fts):
+                    m.d.comb += tx.send_fts.eq(1)
+                    with m.If(tx.fts_sent):
+                        m.d.rx += fts_count.eq(fts_count + 1)
+                with m.Else():
+                    m.d.comb += tx.send_skp.eq(1)
+                    m.next = "L0"
+
+        # Receiver L0s, entered with an EIOS and left with FTSs followed by a SKP ordered set. Waiting for the SKP
+        # ordered set times out after twice the time the n_fts FTSs and the SKP ordered set take.
+        rx_fts_timeout = 2 * (self.n_fts + 1) * 4 // lane.ratio
+        rx_l0s_timer = Signal(range(max(l0s_idle_max, rx_fts_timeout) + 1))
+        with m.FSM(domain="rx", name="rx_l0s_fsm"):
+            with m.State("L0"):
+                with m.If(in_l0 & rx.eios_received):
+                    m.d.rx += rx_l0s_timer.eq(0)
+                    m.next = "Rx_L0s.Entry"
+
+            with m.State("Rx_L0s.Entry"):
+                m.d.rx += rx.ready.eq(0)
+                m.d.rx += rx_l0s_timer.eq(rx_l0s_timer + 1)
+                with m.If(~in_l0):
+                    m.next = "L0"
+                with m.Elif(rx_l0s_timer == tx_idle_min):
+                    m.next = "Rx_L0s.Idle"
+
+            with m.State("Rx_L0s.Idle"):
+                m.d.rx += rx.ready.eq(0)
+                m.d.comb += status.rx_l0s.eq(1)
+                with m.If(~in_l0):
+                    m.next = "L0"
+                with m.Elif(rx.fts_received):
+                    m.d.rx += rx_l0s_timer.eq(0)
+                    m.next = "Rx_L0s.FTS"
+
+            with m.State("Rx_L0s.FTS"):
+                m.d.rx += rx.ready.eq(0)
+                m.d.comb += status.rx_l0s.eq(1)
+                m.d.rx += rx_l0s_timer.eq(rx_l0s_timer + 1)
+                with m.If(~in_l0 | rx.skp_received):
+                    m.next = "L0"
+                with m.Elif(rx_l0s_timer == rx_fts_timeout):
+                    m.d.comb += rx_l0s_timeout.eq(1)
+                    m.next = "L0"
+
 
         return m
\ No newline at end of file
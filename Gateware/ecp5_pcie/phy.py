@@ -5,20 +5,67 @@ from .phy_rx import PCIePhyRX
 from .phy_tx import PCIePhyTX
 from .ltssm import PCIeLTSSM
 from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver
+from .tlp import PCIeTLPTransmitter, PCIeTLPReceiver, receive_credits
+from .framing import PCIeTXArbiter
 from .dll import PCIeDLL
 
 class PCIePhy(Elaboratable):
     """
     A PCIe Phy
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        PCIe lane
+    gen2 : bool
+        Whether to support 5 GT/s, the SERDES needs to support changing the speed
+    skp_interval : int
+        Symbol times between SKP ordered sets, see PCIePhyTX
+    n_fts : int
+        Number of FTSs needed to leave L0s, see PCIeLTSSM
+    clk_freq : float
+        Frequency of the "rx" clock at 2.5 GT/s in Hz, 250 MHz divided by the gearing ratio by default
+    time_scale : float
+        Factor the timeouts of the LTSSM get multiplied with, to shorten them in simulation
+    dll_time_scale : float
+        Factor the UpdateFC interval of the data link layer gets multiplied with, see PCIeDLL. Scaling it together with
+        the LTSSM timeouts would send UpdateFCs every few clock cycles.
+    upstream : bool
+        Whether this is the upstream component of the link, see PCIeLTSSM
+    max_payload_size : int
+        Max_Payload_Size in bytes, see PCIeTLPTransmitter
+    replay_buffer_size : int
+        Size of the replay buffer in symbols, see PCIeTLPTransmitter
+    rx_buffer_size : int
+        Size of the TLP receive buffer in bytes, see PCIeTLPReceiver
+    credits : dict
+        Credits advertised for each type of dll_layout, like {"PH": 4, "PD": 16}, types which aren't in it get infinite
+        credits. They need to fit into the receive buffer, by default they get derived from rx_buffer_size with
+        receive_credits.
+    ack_count : int
+        Number of received TLPs after which an Ack gets sent at the latest, see PCIeDLL
+    update_header_threshold : int
+        Number of freed header credits after which an UpdateFC gets sent right away, see PCIeDLL
+    update_data_threshold : int
+        Number of freed data credits after which an UpdateFC gets sent right away, see PCIeDLL
     """
-    def __init__(self, lane):
+    def __init__(self, lane, gen2 = False, skp_interval = 1300, n_fts = 255, clk_freq = None, time_scale = 1,
+                 dll_time_scale = 1, upstream = False, max_payload_size = 128, replay_buffer_size = 1024,
+                 rx_buffer_size = 1024, credits = None, ack_count = 8, update_header_threshold = 2,
+                 update_data_threshold = 16):
         self.descrambled_lane = PCIeScrambler(lane)
-        self.rx = PCIePhyRX(lane, self.descrambled_lane, 16)
-        self.tx = PCIePhyTX(self.descrambled_lane, 16)
-        self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
-        self.dllp_rx = PCIeDLLPReceiver(self.descrambled_lane)
-        self.dllp_tx = PCIeDLLPTransmitter(self.tx.in_symbols)
-        self.dll = PCIeDLL(self.ltssm, self.dllp_tx, self.dllp_rx)
+        self.rx = PCIePhyRX(lane, self.descrambled_lane)
+        self.tx = PCIePhyTX(self.descrambled_lane, 16, skp_interval)
+        self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx, gen2, n_fts, clk_freq, time_scale, upstream) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
+        self.dllp_rx = PCIeDLLPReceiver(self.rx.packets)
+        self.tx_arbiter = PCIeTXArbiter(self.tx.in_symbols)
+        self.dllp_tx = PCIeDLLPTransmitter(self.tx_arbiter.inputs[0])
+        self.tlp_rx = PCIeTLPReceiver(self.rx.packets, rx_buffer_size)
+        self.tlp_tx = PCIeTLPTransmitter(self.tx_arbiter.inputs[1], replay_buffer_size, max_payload_size=max_payload_size)
+        self.dll = PCIeDLL(self.ltssm, self.dllp_tx, self.dllp_rx, self.tlp_tx, self.tlp_rx, clk_freq,
+            dll_time_scale, max_payload_size, ack_count=ack_count, update_header_threshold=update_header_threshold,
+            update_data_threshold=update_data_threshold)
+        self.credits = receive_credits(rx_buffer_size, max_payload_size) if credits is None else credits
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
@@ -32,7 +79,9 @@ class PCIePhy(Elaboratable):
         m.submodules.dlrx=    self.dllp_rx
         m.submodules.dltx=    self.dllp_tx
         m.submodules.dll =    self.dll
-        m.d.comb        +=    self.dllp_tx.enable.eq(self.tx.enable_higher_layers)
+        m.submodules.tlrx=    self.tlp_rx
+        m.submodules.tltx=    self.tlp_tx
+        m.submodules.txarb=   self.tx_arbiter
         #    self.dllp_tx,
 
 
@@ -52,7 +101,13 @@ class PCIePhy(Elaboratable):
 
         m.d.rx += self.descrambled_lane.rx_align.eq(1)
 
-        m.d.rx += self.descrambled_lane.enable.eq(
+        m.d.comb += [self.dll.credits_tx[name].eq(value) for name, value in self.credits.items()]
+
+        # sending_ts changes together with the transmitted word, so the word after an ordered set gets scrambled again
+        m.d.comb += self.descrambled_lane.enable.eq(
             self.ltssm.status.link.scrambling & ~self.tx.sending_ts)
 
+        # The link partner can request to disable scrambling in its training sequences
+        m.d.comb += self.descrambled_lane.disable.eq(self.rx.ts.ctrl.disable_scrambling)
+
         return m
\ No newline at end of file
@@ -3,10 +3,15 @@ from nmigen.build import *
 from nmigen.lib.fifo import SyncFIFOBuffered
 from .serdes import K, D, Ctrl, PCIeSERDESInterface, PCIeScrambler
 from .layouts import ts_layout
+from .framing import PCIeRXFramer
 
 class PCIePhyRX(Elaboratable):
     """
-    PCIe Receiver for 1:2 gearing
+    PCIe Receiver for 1:2 or 1:4 gearing
+
+    Training sequences are found in a window of the last 16 + ratio received symbols. Every symbol slot of the oldest word
+    is checked for a COM starting a TS in parallel and all fields of the TS are extracted at once, so the comma doesn't need
+    to be aligned to the first symbol. Received DLLPs and TLPs are framed by PCIeRXFramer, they can start in any slot too.
 
     Parameters
     ----------
@@ -19,14 +24,22 @@ class PCIePhyRX(Elaboratable):
     vlane : Signal
         Last valid lane # received
     fifo_depth : int
-        How deep the FIFO to store received data is
+        How deep the FIFO to store received packets is, 0 for no FIFO
     ready : Signal()
         Asserted by LTSSM to enable data reception
-    fifo : SyncFIFOBuffered()
-        Received data gets stored in here
+    packets : Record(packet_stream_layout(lane.ratio))
+        Received DLLPs and TLPs
+    fifo : SyncFIFOBuffered() or None
+        Received packets get stored in here, one word of the packet stream per entry
+    skp_received : Signal()
+        Asserted for one clock cycle when a SKP ordered set got received
+    eios_received : Signal()
+        Asserted for one clock cycle when an electrical idle ordered set got received
+    fts_received : Signal()
+        Asserted for one clock cycle when a fast training sequence got received
     """
-    def __init__(self, raw_lane : PCIeSERDESInterface, decoded_lane : PCIeScrambler, fifo_depth = 256):
-        assert raw_lane.ratio == 2
+    def __init__(self, raw_lane : PCIeSERDESInterface, decoded_lane : PCIeScrambler, fifo_depth = 0):
+        assert raw_lane.ratio in [2, 4]
         self.raw_lane = raw_lane
         self.decoded_lane = decoded_lane
         self.ts = Record(ts_layout)
@@ -35,7 +48,12 @@ class PCIePhyRX(Elaboratable):
         self.consecutive = Signal()
         self.inverted = Signal()
         self.ready = Signal()
-        self.fifo = DomainRenamer("rx")(SyncFIFOBuffered(width=18, depth=fifo_depth))
+        self.skp_received = Signal()
+        self.eios_received = Signal()
+        self.fts_received = Signal()
+        self.framer = PCIeRXFramer(decoded_lane)
+        self.packets = self.framer.packets
+        self.fifo = DomainRenamer("rx")(SyncFIFOBuffered(width=len(self.packets), depth=fifo_depth)) if fifo_depth else None
     
     """
     Whether the symbol is in the current RX data
@@ -51,25 +69,27 @@ class PCIePhyRX(Elaboratable):
 
         raw_lane = self.raw_lane
         decoded_lane = self.decoded_lane
+        ratio = raw_lane.ratio
         ts = self.ts
         vlink = self.vlink
         vlane = self.vlane
         ts_last = Record(ts_layout)
-        ts_current = Record(ts_layout)
 
         self.idle = decoded_lane.rx_symbol == 0
 
-        # The two received symbols
-        symbol1 = raw_lane.rx_symbol[0: 9]
-        symbol2 = raw_lane.rx_symbol[9:18]
-        decoded_symbol1 = decoded_lane.rx_symbol[0: 9]
-        decoded_symbol2 = raw_lane.rx_symbol[9:18]
+        # Frame received data, only in L0
+        m.submodules.framer = framer = self.framer
+        m.d.comb += framer.enable.eq(self.ready)
 
-        # Store received data
-        m.submodules.fifo = fifo = self.fifo
-        m.d.rx += fifo.w_en.eq(0)
+        # Buffer received packets if there is a FIFO
+        if self.fifo is not None:
+            m.submodules.fifo = fifo = self.fifo
+            m.d.comb += [
+                fifo.w_data.eq(self.packets),
+                fifo.w_en.eq(self.packets.valid),
+            ]
 
-        # Whether a TS is being received
+        # Whether a TS is being received, reset by SKP ordered sets
         self.recv_tsn = recv_tsn = Signal()
 
         # Beginning to receive a TS
@@ -81,9 +101,6 @@ class PCIePhyRX(Elaboratable):
         # Whether the TS is inverted
         inverted = self.inverted # Signal()
 
-        # Whether currently a DLLP or TLP is being received
-        receiving_data = Signal()
-
         # Limit inversion rate, because inverting takes a while to propagate.
         # Otherwise it will oscillate and return garbage.
         # (And the moment when the inversion happens, the symbol will be garbled, since it isn't aligned to symbol boundaries.)
@@ -92,112 +109,103 @@ class PCIePhyRX(Elaboratable):
             m.d.rx += last_invert.eq(last_invert - 1)
 
 
+        # The last 16 / ratio words and the current one, oldest symbol first. A TS starting in any slot of the oldest word
+        # is completely in the window.
+        history = [Signal(9 * ratio, name="history_%d" % i) for i in range(16 // ratio)]
+        m.d.rx += history[0].eq(raw_lane.rx_symbol)
+        for i in range(1, len(history)):
+            m.d.rx += history[i].eq(history[i - 1])
+        window = [word.word_select(i, 9) for word in history[::-1] + [raw_lane.rx_symbol] for i in range(ratio)]
+
         # Structure of a TS:
         # COM Link Lane n_FTS Rate Ctrl ID ID ID ID ID ID ID ID ID ID
         # Link / Lane is invalid when PAD is being received.
         # In that case, the 9th bit is true.
         # Otherwise its valid and the link number gets stored.
+        # The ID symbols are D10.2 for TS1 and D5.2 for TS2, or D21.5 and D26.5 when the lane is inverted.
         # There is also a SKP ordered set composed of COM SKP SKP SKP
-        # A comma aligner before the RX causes the comma to be aligned to symbol1.
-        with m.FSM(domain="rx"):
-            with m.State("IDLE"):
-                m.d.rx += self.ts_received.eq(0)
-
-                with m.If(symbol1 == Ctrl.COM):
-                    with m.If(symbol2 == Ctrl.PAD):
-                        m.d.rx += ts_current.link.valid.eq(0)
-                        m.next = "TSn-LANE-FTS"
-                        m.d.rx += recv_tsn.eq(1)
-                        
-                    with m.If(symbol2 == Ctrl.SKP):
-                        m.d.rx += recv_tsn.eq(0)
-                        m.next = "SKP"
-
-                    with m.If(symbol2[8] == 0):
-                        m.d.rx += ts_current.link.number.eq(symbol2[:8])
-                        m.d.rx += ts_current.link.valid.eq(1)
-                        m.next = "TSn-LANE-FTS"
-                        m.d.rx += recv_tsn.eq(1)
-                     # Ignore the comma otherwise, could be a different ordered set
-                with m.Elif(self.ready): # Might overflow
-                    with m.If((decoded_symbol1 == Ctrl.SDP) | (decoded_symbol1 == Ctrl.STP) | receiving_data):
-                        with m.If((decoded_symbol1 == Ctrl.COM) | (decoded_symbol2 == Ctrl.SKP)):
-                            m.d.rx += fifo.w_en.eq(0)
-                        with m.Else():
-                            m.d.rx += [
-                                receiving_data.eq(1),
-                                fifo.w_data.eq(Cat(decoded_symbol1, decoded_symbol2)),
-                                fifo.w_en.eq(1),
-                            ]
-                    with m.If((decoded_symbol2 == Ctrl.END) | (decoded_symbol2 == Ctrl.EDB)):
-                        m.d.rx += receiving_data.eq(0)
-
-                #9with m.Else():
-                #    m.d.rx += recv_tsn.eq(0)
-
-            # SKP ordered set, in COMMA there is 'COM SKP' and here is 'SKP SKP' in rx_symbol, after which it goes back to COMMA.
-            with m.State("SKP"):
-                m.next = "IDLE"
-
-            # Lane and Fast Training Sequence count
-            with m.State("TSn-LANE-FTS"):
-                m.next = "TSn-DATA"
-                m.d.rx += ts_current.valid.eq(1)
-                m.d.rx += self.start_receive_ts.eq(1)
-                with m.If(symbol2[8] == 0):
-                    m.d.rx += ts_current.n_fts.eq(symbol2[:8])
-                with m.If(symbol1 == Ctrl.PAD):
-                    m.d.rx += ts_current.lane.valid.eq(0)
-                with m.If(symbol1[8] == 0):
-                    m.d.rx += ts_current.lane.valid.eq(1)
-                    m.d.rx += ts_current.lane.number.eq(symbol1[:5])
-            
-            # Rate and Ctrl bytes
-            with m.State("TSn-DATA"):
-                m.next = "TSn-ID0"
-                m.d.rx += self.start_receive_ts.eq(0)
-                with m.If(symbol1[8] == 0):
-                    m.d.rx += Cat(ts_current.rate).eq(symbol1[:8])
-                with m.If(symbol2[8] == 0):
-                    m.d.rx += Cat(ts_current.ctrl).eq(symbol2[:5])
-                m.d.rx += ts_current.valid.eq(1)
-
-            # Find out whether its a TS1, a TS2 or inverted
-            for i in range(4):
-                with m.State("TSn-ID%d" % i):
-                    m.next = "TSn-ID%d" % (i + 1)
-                    with m.If(symbol1 == D(10,2)):
-                        m.d.rx += ts_current.ts_id.eq(0)
-                    with m.If(symbol1 == D(5,2)):
-                        m.d.rx += ts_current.ts_id.eq(1)
-                    with m.If(symbol1 == D(21,5)):
-                        m.d.rx += ts_current.ts_id.eq(0)
-                        m.d.rx += inverted.eq(1)
-                    with m.If(symbol1 == D(26,5)):
-                        m.d.rx += ts_current.ts_id.eq(1)
-                        m.d.rx += inverted.eq(1)
-
-            # When its not inverted, accept it.
-            # Additionally it can be checked whether two consecutive TSs are valid by uncommenting the if statement
-            with m.State("TSn-ID4"):
-                m.next = "IDLE"
-                with m.If(inverted):
-                    m.d.rx += ts.valid.eq(0)
-                    m.d.rx += inverted.eq(0)
-                    with m.If(last_invert == 0):
-                        m.d.rx += raw_lane.rx_invert.eq(~raw_lane.rx_invert) # Maybe it should change the disparity instead?
-                        m.d.rx += last_invert.eq(200)
-                
-                # If its not inverted, then a valid TS was received.
-                with m.Else():
-                    #with m.If((ts_last == ts_current)):
-                    m.d.rx += ts.eq(ts_current)
-                    m.d.rx += ts_last.eq(ts_current)
-                    m.d.rx += self.ts_received.eq(1)
-
-                    # Consecutive TS sensing
-                    m.d.rx += self.consecutive.eq(ts_last == ts_current)
-        
+        def parse(symbols, parsed):
+            def all_ids(symbol):
+                return Cat(id == symbol for id in symbols[6:16]).all()
+
+            ts1 = all_ids(D(10,2))
+            ts2 = all_ids(D(5,2))
+            inverted_ts1 = all_ids(D(21,5))
+            inverted_ts2 = all_ids(D(26,5))
+
+            link_valid = symbols[1][8] == 0
+            lane_valid = symbols[2][8] == 0
+            found = ((symbols[0] == Ctrl.COM) &
+                (link_valid | (symbols[1] == Ctrl.PAD)) &
+                (lane_valid | (symbols[2] == Ctrl.PAD)) &
+                Cat(symbol[8] == 0 for symbol in symbols[3:6]).all() &
+                (ts1 | ts2 | inverted_ts1 | inverted_ts2))
+
+            m.d.comb += [
+                parsed.valid.eq(1),
+                parsed.link.valid.eq(link_valid),
+                parsed.link.number.eq(Mux(link_valid, symbols[1][:8], 0)),
+                parsed.lane.valid.eq(lane_valid),
+                parsed.lane.number.eq(Mux(lane_valid, symbols[2][:5], 0)),
+                parsed.n_fts.eq(symbols[3][:8]),
+                Cat(parsed.rate).eq(symbols[4][:8]),
+                Cat(parsed.ctrl).eq(symbols[5][:5]),
+                parsed.ts_id.eq(ts2 | inverted_ts2),
+            ]
+            return found, inverted_ts1 | inverted_ts2
+
+        # Check every slot of the oldest word, there can only be one COM of a TS in it.
+        # Later assignments take precedence, so going backwards the first slot wins.
+        ts_found = Signal()
+        ts_inverted = Signal()
+        ts_current = Record(ts_layout)
+        for i in reversed(range(ratio)):
+            parsed = Record(ts_layout, name="parsed_%d" % i)
+            found, parsed_inverted = parse(window[i:i + 16], parsed)
+            with m.If(found):
+                m.d.comb += [
+                    ts_found.eq(1),
+                    ts_inverted.eq(parsed_inverted),
+                    ts_current.eq(parsed),
+                ]
+
+        # When its not inverted, accept it and check whether it is the same as the last one.
+        m.d.rx += self.ts_received.eq(0)
+        m.d.rx += inverted.eq(0)
+        with m.If(ts_found):
+            m.d.rx += recv_tsn.eq(1)
+            with m.If(ts_inverted):
+                m.d.rx += ts.valid.eq(0)
+                m.d.rx += inverted.eq(1)
+                with m.If(last_invert == 0):
+                    m.d.rx += raw_lane.rx_invert.eq(~raw_lane.rx_invert) # Maybe it should change the disparity instead?
+                    m.d.rx += last_invert.eq(200)
+
+            # If its not inverted, then a valid TS was received.
+            with m.Else():
+                m.d.rx += ts.eq(ts_current)
+                m.d.rx += ts_last.eq(ts_current)
+                m.d.rx += self.ts_received.eq(1)
+
+                # Consecutive TS sensing
+                m.d.rx += self.consecutive.eq(ts_last == ts_current)
+
+        # COM symbols entering the window, followed by a SKP for a SKP ordered set or by a link number or PAD for a TS.
+        # EIOS and FTS are COM IDL IDL IDL and COM FTS FTS FTS.
+        newest = window[-2 * ratio:]
+        com = [newest[i] == Ctrl.COM for i in range(ratio)]
+        def ordered_set(symbol):
+            return Cat(com[i] & (newest[i + 1] == symbol) for i in range(ratio)).any()
+        skp_ordered_set = ordered_set(Ctrl.SKP)
+        m.d.rx += self.start_receive_ts.eq(Cat(com[i] & ((newest[i + 1] == Ctrl.PAD) | (newest[i + 1][8] == 0)) for i in range(ratio)).any())
+        m.d.rx += [
+            self.skp_received.eq(skp_ordered_set),
+            self.eios_received.eq(ordered_set(Ctrl.IDL)),
+            self.fts_received.eq(ordered_set(Ctrl.FTS)),
+        ]
+        with m.If(skp_ordered_set):
+            m.d.rx += recv_tsn.eq(0)
+
         with m.If(ts.link.valid):
             m.d.rx += vlink.eq(ts.link.number)
         with m.If(ts.lane.valid):
@@ -2,12 +2,11 @@ from nmigen import *
 from nmigen.build import *
 from nmigen.lib.fifo import SyncFIFOBuffered
 from .serdes import K, D, Ctrl, PCIeSERDESInterface
-from .layouts import ts_layout
+from .layouts import ts_layout, symbol_stream_layout
 
-# TODO: When TS data changes during TS sending, the sent TS changes. For example when it changes from TS1 to TS2, itll send ...D10.2 D10.2 D5.2 D5.2 which is kinda suboptimal. TS should be buffered.
 class PCIePhyTX(Elaboratable):
     """
-    PCIe Transmitter for 1:2 gearing
+    PCIe Transmitter for 1:2 or 1:4 gearing
 
     Parameters
     ----------
@@ -17,113 +16,190 @@ class PCIePhyTX(Elaboratable):
         Data to send
     fifo_depth : int
         How deep the FIFO to store data to transmit is
+    skp_interval : int
+        Symbol times between scheduled SKP ordered sets, between 1180 and 1538. SKP ordered sets scheduled during a DLLP
+        or TLP are deferred to the end of the packet and then sent back to back.
     ready : Signal()
         Asserted by LTSSM to enable data transmission
-    in_symbols : Signal(18)
-        Symbols to send from higher layers
+    in_symbols : Record(symbol_stream_layout(lane.ratio))
+        Symbols to send from higher layers. in_symbols.ready only gets deasserted between packets, for SKP ordered sets,
+        or when the LTSSM stops data transmission. Once a packet started, valid needs to stay asserted until its last word.
     fifo : SyncFIFOBuffered()
         Data to transmit goes in here
+    skp_sent : Signal(32)
+        Number of SKP ordered sets sent
+    skp_deferred : Signal(32)
+        Number of SKP ordered sets which got scheduled while a packet was being sent
+    skp_max_deferral : Signal(16)
+        Longest time in clock cycles a SKP ordered set had to wait after it got scheduled, saturating
+    send_skp : Signal()
+        Schedule an additional SKP ordered set, like after the FTSs when leaving L0s
+    send_eios : Signal()
+        While asserted, an electrical idle ordered set gets sent after the current packet and afterwards the
+        transmitter stays in electrical idle
+    electrical_idle : Signal()
+        Asserted while the transmitter is in electrical idle after an electrical idle ordered set
+    send_fts : Signal()
+        While asserted, fast training sequences get sent
+    fts_sent : Signal()
+        Asserted for one clock cycle when a fast training sequence starts getting sent
     """
-    def __init__(self, lane : PCIeSERDESInterface, fifo_depth = 256):
-        assert lane.ratio == 2
+    def __init__(self, lane : PCIeSERDESInterface, fifo_depth = 256, skp_interval = 1300):
+        assert lane.ratio in [2, 4]
+        assert 1180 <= skp_interval <= 1538
         self.lane = lane
+        self.skp_interval = skp_interval
         self.ts = Record(ts_layout)
         self.idle = Signal()
         self.sending_ts = Signal()
         self.ready = Signal()
-        self.in_symbols = Signal(18)
-        self.enable_higher_layers = Signal()
+        self.in_symbols = Record(symbol_stream_layout(lane.ratio))
+        self.skp_sent = Signal(32)
+        self.skp_deferred = Signal(32)
+        self.skp_max_deferral = Signal(16)
+        self.send_skp = Signal()
+        self.send_eios = Signal()
+        self.electrical_idle = Signal()
+        self.send_fts = Signal()
+        self.fts_sent = Signal()
         #self.fifo = DomainRenamer("rx")(SyncFIFOBuffered(width=18, depth=fifo_depth))
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
         lane = self.lane
+        ratio = lane.ratio
         ts = self.ts # ts to transmit
         self.start_send_ts = Signal()
         self.idle = Signal()
-        self.eidle = Signal(2)
-        symbol1 = lane.tx_symbol[0: 9]
-        symbol2 = lane.tx_symbol[9:18]
+        self.eidle = Signal(ratio)
+        symbols = [lane.tx_symbol.word_select(i, 9) for i in range(ratio)]
 
         # Store data to be sent
         #m.submodules.fifo = fifo = self.fifo
         #m.d.rx += fifo.r_en.eq(0)
 
-        skp_counter = Signal(range(769))
+        skp_counter = Signal(range(self.skp_interval // ratio))
         skp_accumulator = Signal(4)
-        
-        # Increase SKP accumulator once counter reaches 650 (SKP between 1180 and 1538 symbol times, here 1300)
+        skp_scheduled = Signal()
+        skp_send = Signal()
+
+        # Whether higher levels are sending a DLLP or TLP, which can't be interrupted by SKP ordered sets
+        in_packet = Signal()
+        with m.If(~self.ready):
+            m.d.rx += in_packet.eq(0)
+
+        # Increase SKP accumulator every skp_interval symbol times (SKP between 1180 and 1538 symbol times)
         m.d.rx += skp_counter.eq(skp_counter + 1)
-        with m.If(skp_counter == 650):
+        with m.If(skp_counter == self.skp_interval // ratio - 1):
             m.d.rx += skp_counter.eq(0)
-            with m.If(skp_accumulator < 15):
-                m.d.rx += skp_accumulator.eq(skp_accumulator + 1)
+            m.d.comb += skp_scheduled.eq(1)
+        with m.If(self.send_skp):
+            m.d.comb += skp_scheduled.eq(1)
+
+        with m.If(skp_scheduled & ~skp_send & (skp_accumulator < 15)):
+            m.d.rx += skp_accumulator.eq(skp_accumulator + 1)
+        with m.Elif(~skp_scheduled & skp_send):
+            m.d.rx += skp_accumulator.eq(skp_accumulator - 1)
+
+        # Statistics about the SKP ordered sets, to see how long they get deferred by packets
+        skp_waiting = Signal(16)
+        with m.If(skp_scheduled & in_packet):
+            m.d.rx += self.skp_deferred.eq(self.skp_deferred + 1)
+        with m.If(skp_send):
+            m.d.rx += self.skp_sent.eq(self.skp_sent + 1)
+            m.d.rx += skp_waiting.eq(0)
+            with m.If(skp_waiting > self.skp_max_deferral):
+                m.d.rx += self.skp_max_deferral.eq(skp_waiting)
+        with m.Elif(((skp_accumulator > 0) | skp_scheduled) & (skp_waiting != 2**16 - 1)):
+            m.d.rx += skp_waiting.eq(skp_waiting + 1)
 
         # Structure of a TS:
         # COM Link Lane n_FTS Rate Ctrl ID ID ID ID ID ID ID ID ID ID
+        # Link and Lane are PAD symbols if they are invalid.
+        def ts_symbol(n):
+            if n == 0:
+                return Const(Ctrl.COM, 9)
+            if n == 1:
+                return Mux(ts.link.valid, Cat(ts.link.number, Const(0, 1)), Const(Ctrl.PAD, 9))
+            if n == 2:
+                return Mux(ts.lane.valid, Cat(ts.lane.number, Const(0, 4)), Const(Ctrl.PAD, 9))
+            if n == 3:
+                return Cat(ts.n_fts, Const(0, 1))
+            if n == 4:
+                return Cat(ts.rate, Const(0, 1))
+            if n == 5:
+                return Cat(ts.ctrl, Const(0, 4))
+            return Mux(ts.ts_id == 0, Const(D(10,2), 9), Const(D(5,2), 9))
+
+        # A TS takes 16 symbols and other ordered sets 4 symbols, split into words of ratio symbols
+        ts_words = 16 // ratio
+        os_words = 4 // ratio
+
+        # Ordered sets other than TSs are a COM followed by 3 times the same symbol
+        os_symbol = Signal(9)
+
+        def send_ordered_set(symbol, next_state):
+            m.d.rx += [
+                symbols[0].eq(Ctrl.COM),
+                os_symbol.eq(symbol),
+                self.sending_ts.eq(1),
+            ]
+            m.d.rx += [s.eq(symbol) for s in symbols[1:]]
+            m.next = "%s-ORDERED-SET1" % next_state if os_words > 1 else next_state
+
+        # The symbols of the TS which are still to be sent. They are taken from ts when the COM gets sent,
+        # so changes to ts during a TS only affect the next one.
+        ts_symbols = Signal(9 * (16 - ratio))
+        ts_word = Signal(range(ts_words))
+
         with m.FSM(domain="rx"):
 
             with m.State("IDLE"):
 
                 m.d.rx += self.sending_ts.eq(0)
 
-                # Whether higher levels are sending DLLPs or TLPs
-                sending_old = Signal()
-                # When a TLP starts, set sending_data to 1 and reset it when it ends.
-                # (self.in_symbols[0:9] == Ctrl.SDP) | 
-                sending_data = ((self.in_symbols[0:9] == Ctrl.STP)
-                | sending_old) & ~((symbol2 == Ctrl.END) | (symbol2 == Ctrl.EDB))
-
-                m.d.rx += sending_old.eq(sending_data)
-                m.d.rx += self.enable_higher_layers.eq(1)
+                # Send SKP ordered sets when the accumulator is above 0, but not between FTSs
+                with m.If((skp_accumulator > 0) & ~in_packet & ~self.send_fts):
+                    m.d.comb += skp_send.eq(1)
+                    send_ordered_set(Ctrl.SKP, "IDLE")
 
-                # Send SKP ordered sets when the accumulator is above 0
-                with m.If((skp_accumulator > 0) & ~sending_data):
-                    m.d.rx += [
-                        self.enable_higher_layers.eq(0),
-                        symbol1.eq(Ctrl.COM),
-                        symbol2.eq(Ctrl.SKP),
-                        skp_accumulator.eq(skp_accumulator - 1),
-                        self.sending_ts.eq(1),
-                    ]
-                    m.next = "SKP-ORDERED-SET"
+                # Electrical idle ordered set, COM IDL IDL IDL, and go to electrical idle
+                with m.Elif(self.send_eios & ~in_packet):
+                    send_ordered_set(Ctrl.IDL, "EIDLE")
 
                 with m.Elif(ts.valid):
                     m.d.rx += self.sending_ts.eq(1)
                     m.d.rx += lane.tx_e_idle.eq(0b0)
-                    m.next = "TSn-LANE-FTS"
+                    m.next = "TSn"
                     m.d.rx += [
-                        symbol1.eq(Ctrl.COM),
                         #lane.tx_set_disp[0].eq(1), If the FSM is in the TX domain it works with this, in the RX domain it should be commented out, not sure why that is
                         #lane.tx_disp[0].eq(0),
                         self.start_send_ts.eq(1)
                     ]
-
-                    # Send PAD symbols if the link is invalid, otherwise send the link number.
-                    with m.If(ts.link.valid):
-                        m.d.rx += symbol2.eq(Cat(ts.link.number, Signal())) # Hopefully the right order?
+                    m.d.rx += Cat(lane.tx_symbol, ts_symbols).eq(Cat(ts_symbol(n) for n in range(16)))
+                    m.d.rx += ts_word.eq(1)
+
+                # Fast training sequence, COM FTS FTS FTS
+                with m.Elif(self.send_fts):
+                    m.d.comb += self.fts_sent.eq(1)
+                    send_ordered_set(Ctrl.FTS, "IDLE")
+
+                # Transmit data from higher layers, or idle data if there is none
+                with m.Elif(self.ready):
+                    m.d.comb += self.in_symbols.ready.eq(1)
+                    with m.If(self.in_symbols.valid):
+                        m.d.rx += lane.tx_symbol.eq(self.in_symbols.data)
+                        with m.If(self.in_symbols.first):
+                            m.d.rx += in_packet.eq(1)
+                        with m.If(self.in_symbols.last):
+                            m.d.rx += in_packet.eq(0)
                     with m.Else():
-                        m.d.rx += symbol2.eq(Ctrl.PAD)
-
-                # Transmit data from higher layers
-                with m.Elif(self.ready): # TODO: If things dont get fully transmitted, then maybe r_rdy goes to not ready 1 clock cycle too soon.
-                    m.d.rx += symbol1.eq(self.in_symbols[0:9])
-                    m.d.rx += symbol2.eq(self.in_symbols[9:18])
-                    #with m.If(fifo.r_rdy):
-                    #    m.d.rx += fifo.r_en.eq(1)
-                    #    cnt = Signal(8)
-                    #    m.d.rx += cnt.eq(cnt + 1)
-                    #    m.d.rx += symbol1.eq(fifo.r_data[0:9])
-                    #    m.d.rx += symbol2.eq(fifo.r_data[9:18])
-                    #with m.Else():
-                    #    m.d.rx += symbol1.eq(0)
-                    #    m.d.rx += symbol2.eq(0)
+                        m.d.rx += lane.tx_symbol.eq(0)
 
                 # Transmit idle data
                 with m.Elif(self.idle):
-                    m.d.rx += symbol1.eq(0)#(Ctrl.IDL)
-                    m.d.rx += symbol2.eq(0)#(Ctrl.IDL)
+                    m.d.rx += lane.tx_symbol.eq(0)#(Ctrl.IDL)
 
                 # Otherwise go to electrical idle, if told so
                 with m.Else():
@@ -132,44 +208,34 @@ class PCIePhyTX(Elaboratable):
                 #    m.d.rx += lane.tx_e_idle.eq(0b11)
 
 
-            with m.State("SKP-ORDERED-SET"):
+            # The remaining symbols of ordered sets, with 1:4 gearing they fit into one word
+            for next_state in ["IDLE", "EIDLE"]:
+                for i in range(1, os_words):
+                    with m.State("%s-ORDERED-SET%d" % (next_state, i)):
+                        m.d.rx += [symbol.eq(os_symbol) for symbol in symbols]
+                        m.next = next_state if i == os_words - 1 else "%s-ORDERED-SET%d" % (next_state, i + 1)
+
+
+            # Electrical idle after an EIOS, until send_eios gets deasserted. No SKP ordered sets are needed meanwhile.
+            with m.State("EIDLE"):
+                m.d.comb += self.electrical_idle.eq(1)
                 m.d.rx += [
-                    symbol1.eq(Ctrl.SKP),
-                    symbol2.eq(Ctrl.SKP),
+                    self.sending_ts.eq(0),
+                    lane.tx_symbol.eq(0),
+                    lane.tx_e_idle.eq((1 << ratio) - 1),
+                    skp_accumulator.eq(0),
                 ]
-                m.next = "IDLE"
+                with m.If(~self.send_eios):
+                    m.d.rx += lane.tx_e_idle.eq(0)
+                    m.next = "IDLE"
 
 
-            with m.State("TSn-LANE-FTS"):
+            # The remaining words of the TS, shifted out of the snapshot
+            with m.State("TSn"):
                 m.d.rx += lane.tx_set_disp[0].eq(0)
                 m.d.rx += self.start_send_ts.eq(0)
-
-                # Send PAD symbols if the lane is invalid, otherwise send the lane number.
-                with m.If(ts.lane.valid):
-                    m.d.rx += symbol1.eq(Cat(ts.lane.number, Signal()))
-                with m.Else():
-                    m.d.rx += symbol1.eq(Ctrl.PAD)
-                m.d.rx += symbol2.eq(Cat(ts.n_fts, Signal()))
-                m.next = "TSn-DATA"
-
-
-            with m.State("TSn-DATA"):
-                m.d.rx += symbol1.eq(Cat(ts.rate, Signal()))
-                m.d.rx += symbol2.eq(Cat(ts.ctrl, Signal(4)))
-                m.next = "TSn-ID0"
-
-
-            for i in range(5):
-                with m.State("TSn-ID%d" % i):
-                    m.next = "IDLE" if i == 4 else "TSn-ID%d" % (i + 1)
-                    with m.If(ts.ts_id == 0):
-                        m.d.rx += [
-                            symbol1.eq(D(10,2)),
-                            symbol2.eq(D(10,2))
-                        ]
-                    with m.Else():
-                        m.d.rx += [
-                            symbol1.eq(D(5,2)),
-                            symbol2.eq(D(5,2))
-                        ]
+                m.d.rx += Cat(lane.tx_symbol, ts_symbols).eq(ts_symbols)
+                m.d.rx += ts_word.eq(ts_word + 1)
+                with m.If(ts_word == ts_words - 1):
+                    m.next = "IDLE"
         return m
\ No newline at end of file
@@ -0,0 +1,157 @@
+import numpy as np
+from functools import lru_cache
+from .serdes import Ctrl
+
+
+__all__ = ["dllp_crc", "lcrc", "lfsr_keystream", "scramble", "descramble"]
+
+# Host side reference implementations of the PCIe CRCs and the scrambler, working on NumPy arrays of many packets at once.
+# They are meant to check simulation results and captured data, not to be synthesized.
+
+
+def _bit_reverse(value, bits):
+    return int("{:0{}b}".format(value, bits)[::-1], 2)
+
+
+@lru_cache()
+def _crc_tables(polynomial, crc_size, slices):
+    """
+    Tables for a reflected, table driven CRC, processing 8 * slices bits per step (slicing-by-N)
+    """
+    dtype = np.uint16 if crc_size == 16 else np.uint32
+    reflected = _bit_reverse(polynomial, crc_size)
+    tables = np.zeros((slices, 256), dtype=dtype)
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (reflected if crc & 1 else 0)
+        tables[0, byte] = crc
+    for i in range(1, slices):
+        tables[i] = (tables[i - 1] >> 8) ^ tables[0][tables[i - 1] & 0xFF]
+    return tables
+
+
+def dllp_crc(dllps):
+    """
+    Calculates the 16 bit CRC of DLLPs (PCIe 1.1 page 167)
+
+    Parameters
+    ----------
+    dllps : array of shape (N, 4)
+        DLLP contents without the CRC, one DLLP per row, byte 0 first
+
+    Returns: array of shape (N,) and type uint16, the lower byte gets transmitted first. Same as the PCIeDLLPTransmitter output.
+    """
+    dllps = np.asarray(dllps, dtype=np.uint8).reshape(-1, 4)
+    table = _crc_tables(0x100B, 16, 1)[0]
+    crc = np.full(len(dllps), 0xFFFF, dtype=np.uint16)
+    for i in range(4):
+        crc = table[(crc ^ dllps[:, i]) & 0xFF] ^ (crc >> 8)
+    return crc ^ np.uint16(0xFFFF)
+
+
+def lcrc(tlps, lengths = None):
+    """
+    Calculates the 32 bit LCRC of TLPs, using slicing-by-4
+
+    Parameters
+    ----------
+    tlps : array of shape (N, L)
+        TLP contents including the sequence number, one TLP per row, byte 0 first
+    lengths : array of shape (N,)
+        Number of valid bytes in each row, all L bytes are valid if None
+
+    Returns: array of shape (N,) and type uint32, the lowest byte gets transmitted first. Same as zlib.crc32.
+    """
+    tlps = np.atleast_2d(np.asarray(tlps, dtype=np.uint8))
+    count, size = tlps.shape
+    lengths = np.full(count, size) if lengths is None else np.asarray(lengths)
+
+    # Pad to a multiple of 4 bytes, so rows can be read as little endian words
+    padded = np.zeros((count, (size + 3) // 4 * 4), dtype=np.uint8)
+    padded[:, :size] = tlps
+    words = padded.view("<u4").astype(np.uint32)
+
+    tables = _crc_tables(0x04C11DB7, 32, 4)
+    crc = np.full(count, 0xFFFFFFFF, dtype=np.uint32)
+
+    # Four bytes at a time, as long as a row has four bytes left
+    full_words = lengths // 4
+    for i in range(full_words.max(initial=0)):
+        value = crc ^ words[:, i]
+        new = tables[3][value & 0xFF] ^ tables[2][(value >> 8) & 0xFF] ^ tables[1][(value >> 16) & 0xFF] ^ tables[0][value >> 24]
+        crc = np.where(full_words > i, new, crc)
+
+    # Remaining bytes one at a time
+    for position in range(full_words.min(initial=0) * 4, lengths.max(initial=0)):
+        new = tables[0][(crc ^ padded[:, position]) & 0xFF] ^ (crc >> 8)
+        crc = np.where((position >= full_words * 4) & (position < lengths), new, crc)
+
+    return crc ^ np.uint32(0xFFFFFFFF)
+
+
+@lru_cache()
+def _keystream():
+    state = 0xFFFF
+    keys = np.zeros(2 ** 16 - 1, dtype=np.uint16)
+    for i in range(len(keys)):
+        keys[i] = _bit_reverse(state >> 8, 8)
+        state = ((state >> 8) | ((state & 0xFF) << 8)) ^ ((state & 0xFF00) >> 5) ^ ((state & 0xFF00) >> 4) ^ ((state & 0xFF00) >> 3)
+    keys.setflags(write=False)
+    return keys
+
+
+def lfsr_keystream():
+    """
+    Scrambling bytes of the PCIe LFSR, index k being the byte for the kth advance after a COM. The LFSR repeats after 65535 advances.
+
+    Returns: read-only array of shape (65535,) and type uint16
+    """
+    return _keystream()
+
+
+def scramble(symbols, training_sets = True):
+    """
+    Scrambles a stream of 9 bit symbols like PCIeScrambler, bit 8 being set for control symbols.
+    COM resets the LFSR, SKP doesn't advance it, control symbols aren't scrambled.
+    The LFSR is assumed to be reset before the first symbol.
+
+    Parameters
+    ----------
+    symbols : array of shape (N,)
+        Symbols in the order they are transmitted
+    training_sets : bool
+        Whether TS1 and TS2 ordered sets should be left unscrambled, like the specification requires
+
+    Returns: array of shape (N,) and type uint16
+    """
+    symbols = np.asarray(symbols, dtype=np.uint16)
+    indices = np.arange(len(symbols))
+    is_com = symbols == Ctrl.COM
+
+    # Index of the last COM at or before each symbol, -1 if there is none
+    last_com = np.maximum.accumulate(np.where(is_com, indices, -1))
+
+    # Number of LFSR advances since the last COM
+    advances = np.cumsum((symbols != Ctrl.SKP) & ~is_com)
+    advances_at_com = np.concatenate(([0], advances))[last_com + 1]
+    position = advances - ((symbols != Ctrl.SKP) & ~is_com) - advances_at_com
+
+    scrambled = (symbols & 0x100) == 0
+
+    if training_sets:
+        # The TS identifier is symbol 6 of the ordered set. COM needs to be followed by 15 symbols for this.
+        identifier = np.full(len(symbols), -1, dtype=np.int32)
+        ordered_sets = (last_com >= 0) & (last_com + 6 < len(symbols))
+        identifier[ordered_sets] = symbols[last_com[ordered_sets] + 6]
+        in_ts = ((identifier == 0x4A) | (identifier == 0x45)) & (indices - last_com < 16)
+        scrambled &= ~in_ts
+
+    return np.where(scrambled, symbols ^ lfsr_keystream()[position % len(lfsr_keystream())], symbols)
+
+
+def descramble(symbols, training_sets = True):
+    """
+    Descrambles a stream of 9 bit symbols, see scramble
+    """
+    return scramble(symbols, training_sets)
@@ -3,14 +3,15 @@ from nmigen.build import *
 from nmigen.hdl.ast import Part
 from nmigen.lib.fifo import AsyncFIFOBuffered
 from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.coding import GrayEncoder, GrayDecoder
 
 from enum import IntEnum
 
 from .align import SymbolSlip
-from .lfsr import PCIeLFSR
+from .lfsr import PCIeParallelLFSR, PCIeKeystreamTable
 
 
-__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeScrambler"]
+__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeElasticBuffer", "PCIeScrambler", "PCIeRXDescrambler", "PCIeTXScrambler"]
 
 
 def K(x, y): return (1 << 8) | (y << 5) | x
@@ -51,6 +52,8 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
         Asserted if the receiver has recovered a valid clock.
     rx_aligned : Signal
         Asserted if the receiver has aligned to the comma symbol.
+    speed : Signal
+        Lane speed, 0 for 2.5 GT/s and 1 for 5 GT/s. Ignored by SERDESes which only support 2.5 GT/s.
 
     rx_symbol : Signal(9 * ratio)
         Two 8b10b-decoded received symbols, with 9th bit indicating a control symbol.
@@ -82,6 +85,10 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
     det_status : Signal
         Valid when ``det_valid`` is asserted. Indicates whether a receiver has been detected
         on this lane.
+
+    power_down : Signal
+        Assert to power down the transmitter, like in L1. The receiver stays powered, such that ``rx_present``
+        can still detect the link partner leaving electrical idle. Ignored by SERDESes without power management.
     """
     def __init__(self, ratio=1):
         self.ratio        = ratio
@@ -91,6 +98,7 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
         self.rx_present   = Signal()
         self.rx_locked    = Signal()
         self.rx_aligned   = Signal()
+        self.speed        = Signal()
 
         self.rx_symbol    = Signal(ratio * 9)
         self.rx_valid     = Signal(ratio)
@@ -105,11 +113,193 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
         self.det_valid    = Signal()
         self.det_status   = Signal()
 
+        self.power_down   = Signal()
+
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
         return m
 
 
+class PCIeElasticBuffer(Elaboratable):
+    """
+    Elastic buffer for crossing PCIe symbols between two clock domains with slightly different frequencies (PCIe 1.1 page 200).
+    Compensates for the difference by dropping or repeating words which only contain SKP symbols in SKP ordered sets,
+    keeping the fill level around a target depth. Each SKP ordered set gets at most one word dropped or repeated,
+    so it keeps 1 to 5 SKP symbols. Words with COM in the first symbol and SKP in the others can also be repeated.
+    With 4 or more symbols per word, a SKP ordered set fits in a single word, which can't be dropped without dropping COM,
+    so then the buffer can only compensate for a faster read side.
+    Pointers are crossed with Gray code like in nMigen's AsyncFIFO.
+
+    Parameters
+    ----------
+    ratio : int
+        Number of symbols per word
+    width : int
+        Word width, at least 9 * ratio. The lowest 9 * ratio bits are the symbols, the rest gets passed through.
+    depth : int
+        Buffer depth in words, needs to be a power of 2
+    target : int
+        Fill level to aim for, a low target gives a low latency
+    w_domain : str
+        Clock domain of the write side
+    r_domain : str
+        Clock domain of the read side
+
+    w_data : Signal(width)
+        Word to write
+    w_en : Signal()
+        Write w_data in this clock cycle
+    w_level : Signal(range(depth + 1))
+        Fill level as seen by the write side
+    r_data : Signal(width)
+        Current word, valid when r_rdy is asserted
+    r_en : Signal()
+        Advance to the next word
+    r_rdy : Signal()
+        Asserted once the buffer has filled up to the target, and as long as it doesn't run empty
+    r_level : Signal(range(depth + 1))
+        Fill level as seen by the read side
+    dropped : Signal()
+        Strobed in the write domain when a word got dropped
+    inserted : Signal()
+        Strobed in the read domain when a word got repeated
+    """
+    def __init__(self, ratio, width, depth = 16, target = 4, w_domain = "rx", r_domain = "tx"):
+        assert width >= 9 * ratio
+        assert depth & (depth - 1) == 0
+        assert 0 < target < depth
+        self.ratio    = ratio
+        self.width    = width
+        self.depth    = depth
+        self.target   = target
+        self.w_domain = w_domain
+        self.r_domain = r_domain
+
+        self.w_data   = Signal(width)
+        self.w_en     = Signal()
+        self.w_level  = Signal(range(depth + 1))
+        self.r_data   = Signal(width)
+        self.r_en     = Signal()
+        self.r_rdy    = Signal()
+        self.r_level  = Signal(range(depth + 1))
+        self.dropped  = Signal()
+        self.inserted = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        ratio = self.ratio
+        depth = self.depth
+        target = self.target
+        w_domain = self.w_domain
+        r_domain = self.r_domain
+
+        def symbols(word):
+            return [word.word_select(i, 9) for i in range(ratio)]
+
+        def only_skp(word):
+            return Cat(symbol == Ctrl.SKP for symbol in symbols(word)).all()
+
+        def has_com(word):
+            return Cat(symbol == Ctrl.COM for symbol in symbols(word)).any()
+
+        # Pointers have one more bit than needed for addressing, to distinguish full from empty
+        pointer_bits = depth.bit_length()
+
+        storage = Memory(width=self.width, depth=depth)
+        m.submodules.w_port = w_port = storage.write_port(domain=w_domain)
+        m.submodules.r_port = r_port = storage.read_port(domain=r_domain, transparent=False)
+
+        # Write side
+        produce_w_bin = Signal(pointer_bits)
+        produce_w_gray = Signal(pointer_bits)
+        consume_w_gray = Signal(pointer_bits)
+        consume_w_bin = Signal(pointer_bits)
+        dropped_in_set = Signal()
+
+        m.submodules.produce_enc = produce_enc = GrayEncoder(pointer_bits)
+        m.submodules.consume_dec = consume_dec = GrayDecoder(pointer_bits)
+        m.d.comb += [
+            produce_enc.i.eq(produce_w_bin),
+            consume_dec.i.eq(consume_w_gray),
+            consume_w_bin.eq(consume_dec.o),
+            self.w_level.eq(produce_w_bin - consume_w_bin),
+        ]
+        m.d[w_domain] += produce_w_gray.eq(produce_enc.o)
+
+        # Each side sees the other pointer a few clock cycles late, so the write side sees a higher and the read side
+        # a lower fill level than the actual one. The margin keeps both sides from compensating at the same time.
+        drop = Signal()
+        m.d.comb += drop.eq(self.w_en & only_skp(self.w_data) & (self.w_level > target + 4) & ~dropped_in_set)
+        m.d.comb += self.dropped.eq(drop)
+
+        m.d.comb += [
+            w_port.addr.eq(produce_w_bin[:-1]),
+            w_port.data.eq(self.w_data),
+            w_port.en.eq(self.w_en & ~drop & (self.w_level != depth)),
+        ]
+        with m.If(w_port.en):
+            m.d[w_domain] += produce_w_bin.eq(produce_w_bin + 1)
+
+        with m.If(drop):
+            m.d[w_domain] += dropped_in_set.eq(1)
+        with m.Elif(self.w_en & has_com(self.w_data)):
+            m.d[w_domain] += dropped_in_set.eq(0)
+
+        # Read side
+        consume_r_bin = Signal(pointer_bits)
+        consume_r_gray = Signal(pointer_bits)
+        produce_r_gray = Signal(pointer_bits)
+        produce_r_bin = Signal(pointer_bits)
+        inserted_in_set = Signal()
+        started = Signal()
+
+        m.submodules.consume_enc = consume_enc = GrayEncoder(pointer_bits)
+        m.submodules.produce_dec = produce_dec = GrayDecoder(pointer_bits)
+        m.d.comb += [
+            consume_enc.i.eq(consume_r_bin),
+            produce_dec.i.eq(produce_r_gray),
+            produce_r_bin.eq(produce_dec.o),
+            self.r_level.eq(produce_r_bin - consume_r_bin),
+        ]
+        m.d[r_domain] += consume_r_gray.eq(consume_enc.o)
+
+        m.submodules.produce_cdc = FFSynchronizer(produce_w_gray, produce_r_gray, o_domain=r_domain)
+        m.submodules.consume_cdc = FFSynchronizer(consume_r_gray, consume_w_gray, o_domain=w_domain)
+
+        # Wait until the target is reached before reading
+        with m.If(self.r_level >= target):
+            m.d[r_domain] += started.eq(1)
+        with m.Elif(self.r_level == 0):
+            m.d[r_domain] += started.eq(0)
+        m.d.comb += self.r_rdy.eq(started & (self.r_level != 0))
+
+        insert = Signal()
+        repeatable = only_skp(self.r_data)
+        if ratio > 1:
+            repeatable |= (symbols(self.r_data)[0] == Ctrl.COM) & Cat(symbol == Ctrl.SKP for symbol in symbols(self.r_data)[1:]).all()
+        m.d.comb += insert.eq(self.r_en & self.r_rdy & repeatable & (self.r_level < target - 2) & ~inserted_in_set)
+        m.d.comb += self.inserted.eq(insert)
+
+        advance = Signal()
+        m.d.comb += advance.eq(self.r_en & self.r_rdy & ~insert)
+        with m.If(advance):
+            m.d[r_domain] += consume_r_bin.eq(consume_r_bin + 1)
+
+        with m.If(insert):
+            m.d[r_domain] += inserted_in_set.eq(1)
+        with m.Elif(advance & has_com(self.r_data)):
+            m.d[r_domain] += inserted_in_set.eq(0)
+
+        # The read port is one clock cycle late, so give it the pointer of the next clock cycle
+        m.d.comb += [
+            r_port.addr.eq((consume_r_bin + advance)[:pointer_bits - 1]),
+            self.r_data.eq(r_port.data),
+        ]
+
+        return m
+
+
 class PCIeSERDESAligner(PCIeSERDESInterface):
     """
     A multiplexer that aligns commas to the first symbol of the word, for SERDESes that only
@@ -123,6 +313,7 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
         self.rx_present   = lane.rx_present
         self.rx_locked    = lane.rx_locked
         self.rx_aligned   = lane.rx_aligned
+        self.speed        = lane.speed
 
         self.rx_symbol    = Signal(lane.ratio * 9)
         self.rx_valid     = Signal(lane.ratio)
@@ -136,6 +327,10 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
         self.det_valid    = lane.det_valid
         self.det_status   = lane.det_status
 
+        self.power_down   = lane.power_down
+
+        self.tx_buffer    = PCIeElasticBuffer(lane.ratio, 12 * lane.ratio, w_domain="rx", r_domain="tx")
+
         self.__lane = lane
 
     def elaborate(self, platform: Platform) -> Module:
@@ -152,13 +347,21 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
                 Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
 
         # AsyncFIFOBuffered
-        if True:
+        if False:
             tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=24, depth=10, r_domain="tx", w_domain="rx")
             m.d.comb += tx_fifo.w_data.eq(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
             m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(tx_fifo.r_data)
             m.d.comb += tx_fifo.r_en.eq(1)
             m.d.comb += tx_fifo.w_en.eq(1)
 
+        # Elastic buffer, compensates for the clock difference with SKP ordered sets
+        if True:
+            tx_buffer = m.submodules.tx_buffer = self.tx_buffer
+            m.d.comb += tx_buffer.w_data.eq(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
+            m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(tx_buffer.r_data)
+            m.d.comb += tx_buffer.r_en.eq(1)
+            m.d.comb += tx_buffer.w_en.eq(1)
+
         # Testing symbols
         if False:
             m.d.comb += self.__lane.tx_symbol.eq(Cat(Ctrl.COM, D(10, 2)))
@@ -185,11 +388,140 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
         return m
 
 
+def _delay(m, signal, cycles):
+    """
+    Returns the signal delayed by a number of clock cycles in the rx domain
+    """
+    for _ in range(cycles):
+        delayed = Signal.like(signal)
+        m.d.rx += delayed.eq(signal)
+        signal = delayed
+    return signal
+
+
+class _PCIeScramblerDirection(Elaboratable):
+    """
+    Scrambles or descrambles the symbols of one direction, skips on SKP, resets on COM. Control symbols are not scrambled.
+    """
+    def __init__(self, ratio, input, enable, disable, table):
+        self.ratio   = ratio
+        self.input   = input
+        self.enable  = Signal(reset=1) if enable is None else enable
+        self.disable = Signal() if disable is None else disable
+        self.output  = Signal(ratio * 9)
+
+        symbols = [input.word_select(i, 9) for i in range(ratio)]
+        self.lfsr = (PCIeKeystreamTable if table else PCIeParallelLFSR)(ratio,
+            Cat(symbol == Ctrl.COM for symbol in symbols), Cat(symbol != Ctrl.SKP for symbol in symbols))
+
+        # The output is registered
+        self.latency = self.lfsr.latency + 1
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.lfsr = lfsr = self.lfsr
+
+        enable = _delay(m, self.enable & ~self.disable, lfsr.latency)
+
+        for i in range(self.ratio):
+            symbol = _delay(m, self.input.word_select(i, 9), lfsr.latency)
+            with m.If(enable & (symbol[8] == 0)):
+                m.d.rx += self.output.word_select(i, 9).eq(lfsr.output.word_select(i, 9) ^ symbol)
+            with m.Else():
+                m.d.rx += self.output.word_select(i, 9).eq(symbol)
+
+        return m
+
+
+class PCIeRXDescrambler(_PCIeScramblerDirection):
+    """
+    Descrambler for received PCIe data, with its own LFSR
+
+    Parameters
+    ----------
+    ratio : int
+        Gearbox ratio
+    rx_symbol : Signal(9 * ratio)
+        Received symbols, needs to be aligned
+    rx_valid : Signal(ratio)
+        Whether the received symbols have no coding errors
+    enable : Signal
+        Enable descrambling, enabled if not specified
+    disable : Signal
+        Disable descrambling, for the disable scrambling bit of received training sequences
+    table : bool
+        Read the scrambling data from a table in block RAM instead of calculating it with an LFSR, see PCIeKeystreamTable
+
+    rx_symbol_out : Signal(9 * ratio)
+        Descrambled symbols
+    rx_valid_out : Signal(ratio)
+        rx_valid delayed to match rx_symbol_out
+    latency : int
+        Clock cycles from rx_symbol to rx_symbol_out
+    """
+    def __init__(self, ratio, rx_symbol, rx_valid, enable = None, disable = None, table = False):
+        super().__init__(ratio, rx_symbol, enable, disable, table)
+        self.rx_symbol     = rx_symbol
+        self.rx_valid      = rx_valid
+        self.rx_symbol_out = self.output
+        self.rx_valid_out  = Signal(ratio)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = super().elaborate(platform)
+
+        m.d.comb += self.rx_valid_out.eq(_delay(m, self.rx_valid, self.latency))
+
+        return m
+
+
+class PCIeTXScrambler(_PCIeScramblerDirection):
+    """
+    Scrambler for transmitted PCIe data, with its own LFSR
+
+    Parameters
+    ----------
+    ratio : int
+        Gearbox ratio
+    tx_symbol : Signal(9 * ratio)
+        Symbols to transmit
+    enable : Signal
+        Enable scrambling, enabled if not specified
+    disable : Signal
+        Disable scrambling, for the disable scrambling bit of transmitted training sequences
+    table : bool
+        Read the scrambling data from a table in block RAM instead of calculating it with an LFSR, see PCIeKeystreamTable
+
+    tx_symbol_out : Signal(9 * ratio)
+        Scrambled symbols
+    latency : int
+        Clock cycles from tx_symbol to tx_symbol_out
+    """
+    def __init__(self, ratio, tx_symbol = None, enable = None, disable = None, table = False):
+        tx_symbol = Signal(ratio * 9) if tx_symbol is None else tx_symbol
+        super().__init__(ratio, tx_symbol, enable, disable, table)
+        self.tx_symbol     = tx_symbol
+        self.tx_symbol_out = self.output
+
+
 class PCIeScrambler(PCIeSERDESInterface):
     """
     Scrambler and Descrambler for PCIe, needs to be after an aligner
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        Lane to scramble and descramble
+    enable : Signal
+        Enable scrambling of transmitted data
+    table : bool
+        Read the scrambling data from a table in block RAM instead of calculating it with an LFSR, see PCIeKeystreamTable
+    rx_enable : Signal
+        Enable descrambling of received data, enabled if not specified
+    disable : Signal
+        Disable scrambling in both directions, for the disable scrambling bit of received training sequences
     """
-    def __init__(self, lane : PCIeSERDESInterface, enable = Signal()):
+    def __init__(self, lane : PCIeSERDESInterface, enable = None, table = False, rx_enable = None, disable = None):
         self.ratio        = lane.ratio
 
         self.rx_invert    = lane.rx_invert
@@ -197,11 +529,8 @@ class PCIeScrambler(PCIeSERDESInterface):
         self.rx_present   = lane.rx_present
         self.rx_locked    = lane.rx_locked
         self.rx_aligned   = lane.rx_aligned
+        self.speed        = lane.speed
 
-        self.rx_symbol    = Signal(lane.ratio * 9)
-        self.rx_valid     = Signal(lane.ratio)
-
-        self.tx_symbol    = Signal(lane.ratio * 9)
         self.tx_set_disp  = Signal(lane.ratio)
         self.tx_disp      = Signal(lane.ratio)
         self.tx_e_idle    = Signal(lane.ratio)
@@ -210,57 +539,32 @@ class PCIeScrambler(PCIeSERDESInterface):
         self.det_valid    = lane.det_valid
         self.det_status   = lane.det_status
 
-        self.enable      = enable
+        self.power_down   = lane.power_down
+
+        self.enable       = Signal() if enable is None else enable
+        self.rx_enable    = Signal(reset=1) if rx_enable is None else rx_enable
+        self.disable      = Signal() if disable is None else disable
+
+        self.descrambler  = PCIeRXDescrambler(lane.ratio, lane.rx_symbol, lane.rx_valid, self.rx_enable, self.disable, table)
+        self.scrambler    = PCIeTXScrambler(lane.ratio, enable = self.enable, disable = self.disable, table = table)
+
+        self.rx_symbol    = self.descrambler.rx_symbol_out
+        self.rx_valid     = self.descrambler.rx_valid_out
+        self.tx_symbol    = self.scrambler.tx_symbol
 
         self.__lane = lane
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        # Scramble transmitted and received data, skip on SKP, reset on COM
-        # TODO: Add case for when only one SKP character is received
+        m.submodules.descrambler = self.descrambler
+        m.submodules.scrambler = scrambler = self.scrambler
 
-        def scramble(input, output, enable):
-            lfsr = PCIeLFSR(self.ratio, input[0:9] == Ctrl.COM, input[9:18] != Ctrl.SKP)
-            m.submodules += lfsr 
-            with m.If(enable & (input[8] == 0)):
-                m.d.rx += output[0:9].eq(lfsr.output[0:9] ^ input[0:9])
-            with m.Else():
-                m.d.rx += output[0:9].eq(input[0:9])
-                
-            with m.If(enable & (input[17] == 0)):
-                with m.If(input[0:9] == Ctrl.COM): # TODO: This is a hack. Please fix.
-                    m.d.rx += output[9:18].eq(0xFF ^ input[9:18])
-                with m.Else():
-                    m.d.rx += output[9:18].eq(lfsr.output[9:18] ^ input[9:18])
-            with m.Else():
-                m.d.rx += output[9:18].eq(input[9:18])
-            
-
-        #with m.If(self.enable & (self.__lane.rx_symbol[8] == 0)):
-        #    with m.If(self.__lane.rx_symbol[0:9] == Ctrl.COM):
-        #        m.d.rx += self.rx_symbol.eq(0x1FE00 ^ self.__lane.rx_symbol)
-        #    with m.Else():
-        #        m.d.rx += self.rx_symbol.eq(rx_lfsr.output ^ self.__lane.rx_symbol)
-        #with m.Else():
-        #    m.d.rx += self.rx_symbol.eq(self.__lane.rx_symbol)
-
-        scramble(self.__lane.rx_symbol, self.rx_symbol, 1)
-        scramble(self.tx_symbol, self.__lane.tx_symbol, self.enable)
-
-        # This is necessary because the scrambling already takes one clock cycle
-        m.d.rx += self.rx_valid.eq(self.__lane.rx_valid)
-
-        #with m.If(self.enable & (self.tx_symbol[8] == 0)):
-        #    with m.If(self.tx_symbol[0:9] == Ctrl.COM):
-        #        m.d.rx += self.__lane.tx_symbol.eq(0x1FE00 ^ self.tx_symbol)
-        #    with m.Else():
-        #        m.d.rx += self.__lane.tx_symbol.eq(tx_lfsr.output ^ self.tx_symbol)
-        #with m.Else():
-        #    m.d.rx += self.__lane.tx_symbol.eq(self.tx_symbol)
-
-        m.d.rx += self.__lane.tx_set_disp.eq(self.tx_set_disp)
-        m.d.rx += self.__lane.tx_disp    .eq(self.tx_disp)
-        m.d.rx += self.__lane.tx_e_idle  .eq(self.tx_e_idle)
-
-        return m
\ No newline at end of file
+        m.d.comb += self.__lane.tx_symbol.eq(scrambler.tx_symbol_out)
+
+        # Delay the other TX signals to match the scrambled symbols
+        m.d.comb += self.__lane.tx_set_disp.eq(_delay(m, self.tx_set_disp, scrambler.latency))
+        m.d.comb += self.__lane.tx_disp    .eq(_delay(m, self.tx_disp, scrambler.latency))
+        m.d.comb += self.__lane.tx_e_idle  .eq(_delay(m, self.tx_e_idle, scrambler.latency))
+
+        return m
@@ -0,0 +1,583 @@
+from nmigen import *
+from nmigen.build import *
+from enum import IntEnum
+
+from .layouts import symbol_stream_layout, packet_stream_layout, tlp_stream_layout, acknak_layout
+from .serdes import Ctrl
+from .crc import LCRC
+
+
+__all__ = ["FCClass", "ack_nak_latency", "replay_timer_limit", "tlp_credits", "receive_credits", "PCIeTLPTransmitter",
+    "PCIeTLPReceiver"]
+
+
+# Flow control types, like in the lowest two bits of the FC DLLP types
+class FCClass(IntEnum):
+    P   = 0
+    NP  = 1
+    Cpl = 2
+
+
+def ack_nak_latency(max_payload_size, lanes = 1):
+    """
+    Maximum time between receiving a TLP and sending the Ack for it at 2.5 GT/s in symbol times,
+    (Max_Payload_Size + TLPOverhead) * AckFactor / LinkWidth + InternalDelay (PCIe 1.1 page 156)
+
+    Parameters
+    ----------
+    max_payload_size : int
+        Max_Payload_Size in bytes
+    lanes : int
+        Link width, up to 4 lanes
+    """
+    assert max_payload_size in [128, 256, 512, 1024, 2048, 4096]
+    assert lanes in [1, 2, 4]
+    ack_factor = 1.4 if max_payload_size <= 256 else 1.0
+    return int((max_payload_size + 28) * ack_factor / lanes + 19)
+
+
+def replay_timer_limit(max_payload_size, lanes = 1):
+    """
+    REPLAY_TIMER limit at 2.5 GT/s in symbol times, three times the Ack latency (PCIe 1.1 page 149)
+    """
+    return 3 * ack_nak_latency(max_payload_size, lanes)
+
+
+def tlp_credits(header):
+    """
+    Returns the flow control type and the number of data credits of a TLP from the first DW of its header (PCIe 1.1
+    page 55). Memory writes and messages are posted, completions use completion credits and all other TLPs are
+    non-posted. A data credit is 4 DWs.
+
+    Parameters
+    ----------
+    header : Signal(32)
+        First DW of the TLP, byte 0 in the lowest bits
+    """
+    fmt = header[5:7]
+    type = header[0:5]
+    length = Cat(header[24:32], header[16:18])
+    posted = (fmt[1] & (type == 0b00000)) | (type[3:5] == 0b10)
+    completion = type[1:5] == 0b0101
+    fc_type = Mux(posted, FCClass.P, Mux(completion, FCClass.Cpl, FCClass.NP))
+
+    # A length of 0 means 1024 DWs
+    dws = Mux(length == 0, 1024, length)
+    return fc_type, Mux(fmt[1], (dws + 3) >> 2, 0)
+
+
+def receive_credits(buffer_size, max_payload_size):
+    """
+    Returns the credits to advertise for each type, like in dll_layout, so that the TLPs sent within them always fit
+    into a receive buffer of buffer_size bytes. The buffer holds the TLPs without sequence number and LCRC, a header
+    credit takes up to 20 bytes with a 4 DW header and a TLP digest and a data credit 16 bytes.
+    One non-posted request with up to 4 DWs of data, like a configuration write, gets reserved and the rest is split
+    into posted requests with Max_Payload_Size of data. Completions get infinite credits (0), endpoints and root
+    complexes need to advertise them and only receive completions for their own requests.
+
+    Parameters
+    ----------
+    buffer_size : int
+        Size of the receive buffer in bytes
+    max_payload_size : int
+        Max_Payload_Size in bytes
+    """
+    header_bytes = 20
+    data_bytes = 16
+    posted = min(127, (buffer_size - header_bytes - data_bytes) // (header_bytes + max_payload_size))
+    assert posted >= 1, "The receive buffer needs to hold a TLP with Max_Payload_Size and a non-posted request"
+    return {
+        "PH": posted,
+        "PD": min(2047, posted * max_payload_size // data_bytes),
+        "NPH": 1,
+        "NPD": 1,
+        "CPLH": 0,
+        "CPLD": 0,
+    }
+
+
+def data_symbols(data):
+    """
+    Returns the bytes of data as 9 bit data symbols
+    """
+    return Cat(Cat(data.word_select(i, 8), Const(0, 1)) for i in range(len(data) // 8))
+
+
+class PCIeTLPTransmitter(Elaboratable):
+    """
+    PCIe TLP transmitter with a replay buffer for 1:2 or 1:4 gearing
+
+    TLPs get a sequence number and the LCRC and are framed into [STP seq seq TLP LCRC END] in the replay buffer, which
+    is a block RAM. Once a TLP is completely in it, it gets sent from there. TLPs stay in the buffer until the link
+    partner acknowledges them with an Ack or Nak. A Nak or a REPLAY_TIMER timeout replays all unacknowledged TLPs
+    starting with the oldest one, after the TLP currently being sent. A scheduled replay gets cancelled if all TLPs get
+    acknowledged before it starts. When a replay gets started for the fourth time in
+    a row without an Ack or Nak acknowledging new TLPs, REPLAY_NUM rolls over and the link gets retrained.
+
+    Parameters
+    ----------
+    out_symbols : Record(symbol_stream_layout(2)) or Record(symbol_stream_layout(4))
+        Symbol stream to TX Phy, every TLP is a packet
+    tlp : Record(tlp_stream_layout(ratio))
+        TLPs from the transaction layer, without sequence number and LCRC
+    buffer_size : int
+        Size of the replay buffer in symbols, a power of 2. It needs to hold at least one framed TLP of the maximum size.
+    max_outstanding : int
+        Maximum number of unacknowledged TLPs, a power of 2
+    max_payload_size : int
+        Max_Payload_Size in bytes, the REPLAY_TIMER limit depends on it
+    lanes : int
+        Link width
+    enable : Signal()
+        TLPs only get accepted while asserted, deasserting it purges the replay buffer and resets the sequence numbers
+    hold : Signal()
+        REPLAY_TIMER holds while asserted, like while the link is retrained
+    block : Signal()
+        No new TLPs get accepted while asserted, like during a power management handshake. A TLP which already started
+        gets finished.
+    acknak : Record(acknak_layout)
+        Received Ack and Nak DLLPs
+    next_transmit_seq : Signal(12)
+        NEXT_TRANSMIT_SEQ, sequence number of the next TLP
+    acked_seq : Signal(12)
+        ACKD_SEQ, sequence number of the last acknowledged TLP
+    outstanding : Signal(12)
+        Number of TLPs which got a sequence number and weren't acknowledged yet, including one which is being framed
+    replay_num : Signal(2)
+        REPLAY_NUM, number of replays since the link partner last acknowledged new TLPs
+    replays : Signal(32)
+        Number of replays
+    retrain : Signal()
+        Asserted for one clock cycle when REPLAY_NUM rolls over
+    """
+    def __init__(self, out_symbols : Record, buffer_size = 1024, max_outstanding = 32, max_payload_size = 128,
+                 lanes = 1):
+        self.ratio = len(out_symbols.data) // 9
+        assert self.ratio in [2, 4]
+        assert buffer_size & (buffer_size - 1) == 0
+        assert buffer_size >= max_payload_size + 28
+        assert max_outstanding & (max_outstanding - 1) == 0
+        assert 2 <= max_outstanding <= 2048
+        self.out_symbols = out_symbols
+        self.tlp = Record(tlp_stream_layout(self.ratio))
+        self.buffer_depth = buffer_size // self.ratio
+        self.max_outstanding = max_outstanding
+
+        # Symbol times are 1 / ratio clock cycles at both speeds
+        self.replay_timeout = -(-replay_timer_limit(max_payload_size, lanes) // self.ratio)
+
+        self.enable = Signal()
+        self.hold = Signal()
+        self.block = Signal()
+        self.acknak = Record(acknak_layout)
+        self.next_transmit_seq = Signal(12)
+        self.acked_seq = Signal(12, reset=4095)
+        self.outstanding = Signal(12)
+        self.replay_num = Signal(2)
+        self.replays = Signal(32)
+        self.retrain = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        ratio = self.ratio
+        depth = self.buffer_depth
+        tlp = self.tlp
+        out = self.out_symbols
+        next_seq = self.next_transmit_seq
+        acked_seq = self.acked_seq
+
+        # Pointers have one more bit than needed for addressing, to distinguish full from empty
+        pointer_bits = depth.bit_length()
+        write_ptr = Signal(pointer_bits)  # Next word to frame
+        commit_ptr = Signal(pointer_bits) # End of the last completely framed TLP
+        send_ptr = Signal(pointer_bits)   # Next word to send
+        ack_ptr = Signal(pointer_bits)    # Start of the oldest unacknowledged TLP
+
+        # Replay buffer words are Cat(symbols, first, last)
+        buffer = Memory(width=9 * ratio + 2, depth=depth)
+        m.submodules.write = write = buffer.write_port(domain="rx")
+        m.submodules.read = read = buffer.read_port(domain="rx", transparent=False)
+
+        # End of every unacknowledged TLP in the replay buffer, indexed by its sequence number
+        ends = Memory(width=pointer_bits, depth=self.max_outstanding)
+        m.submodules.ends_write = ends_write = ends.write_port(domain="rx")
+        m.submodules.ends_read = ends_read = ends.read_port(domain="comb")
+
+        # Number of TLPs which got a sequence number and weren't acknowledged yet
+        outstanding = self.outstanding
+        m.d.comb += outstanding.eq(next_seq - 1 - acked_seq)
+
+        # Words which can't be overwritten, the ones from the oldest unacknowledged TLP onwards. During a replay the
+        # link partner can acknowledge TLPs which haven't been sent again yet, then the ones from send_ptr onwards.
+        used_acked = Signal(pointer_bits)
+        used_sending = Signal(pointer_bits)
+        m.d.comb += [
+            used_acked.eq(write_ptr - ack_ptr),
+            used_sending.eq(write_ptr - send_ptr),
+        ]
+        room = Mux(used_sending > used_acked, used_sending, used_acked) != depth
+
+        # Framing, [STP seq0 seq1 TLP... LCRC0 LCRC1 LCRC2 LCRC3 END] is 4n + 8 symbols long, so it fits into whole words.
+        # The three symbols which don't fit into the current word get held for the next one.
+        word = Signal(9 * ratio)
+        word_first = Signal()
+        word_last = Signal()
+        held = Signal(27)
+        seq = Signal(12) # Sequence number of the TLP being framed
+        m.d.comb += [
+            write.addr.eq(write_ptr[:-1]),
+            write.data.eq(Cat(word, word_first, word_last)),
+            ends_write.addr.eq(seq),
+            ends_write.data.eq(write_ptr + 1),
+        ]
+        with m.If(write.en):
+            m.d.rx += write_ptr.eq(write_ptr + 1)
+
+        # The LCRC covers the sequence number and the TLP, which is ratio + 2 bytes in the first word
+        seq_bytes = Cat(next_seq[8:12], Const(0, 4), next_seq[0:8])
+        lcrc_input = Signal(8 * (ratio + 2))
+        lcrc_valid = Signal(ratio + 2)
+        lcrc_start = Signal()
+        m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(lcrc_input, lcrc_valid, lcrc_start))
+        tail = Cat(held, data_symbols(lcrc.lcrc), Const(Ctrl.END, 9))
+        tail_words = 8 // ratio
+
+        with m.FSM(domain="rx", name="framing"):
+            with m.State("Idle"):
+                m.d.comb += tlp.ready.eq(self.enable & ~self.block & room & (outstanding < self.max_outstanding))
+
+                # Words without first outside of a TLP get dropped
+                with m.If(tlp.valid & tlp.ready & tlp.first):
+                    framed = Cat(Const(Ctrl.STP, 9), data_symbols(seq_bytes), data_symbols(tlp.data))
+                    m.d.comb += [
+                        word.eq(framed[:9 * ratio]),
+                        word_first.eq(1),
+                        write.en.eq(1),
+                        lcrc_input.eq(Cat(seq_bytes, tlp.data)),
+                        lcrc_valid.eq((1 << (ratio + 2)) - 1),
+                        lcrc_start.eq(1),
+                    ]
+                    m.d.rx += [
+                        held.eq(framed[9 * ratio:]),
+                        seq.eq(next_seq),
+                        next_seq.eq(next_seq + 1),
+                    ]
+                    with m.If(tlp.last):
+                        m.next = "Tail-0"
+                    with m.Else():
+                        m.next = "Data"
+
+            with m.State("Data"):
+                m.d.comb += tlp.ready.eq(room)
+                with m.If(tlp.valid & room):
+                    framed = Cat(held, data_symbols(tlp.data))
+                    m.d.comb += [
+                        word.eq(framed[:9 * ratio]),
+                        write.en.eq(1),
+                        lcrc_input.eq(tlp.data),
+                        lcrc_valid.eq((1 << ratio) - 1),
+                    ]
+                    m.d.rx += held.eq(framed[9 * ratio:])
+                    with m.If(tlp.last):
+                        m.next = "Tail-0"
+                with m.If(~self.enable):
+                    m.next = "Idle"
+
+            # The LCRC is ready in the clock cycle after the last data word
+            for i in range(tail_words):
+                with m.State("Tail-%d" % i):
+                    with m.If(room):
+                        m.d.comb += [
+                            word.eq(tail.word_select(i, 9 * ratio)),
+                            write.en.eq(1),
+                        ]
+                        if i < tail_words - 1:
+                            m.next = "Tail-%d" % (i + 1)
+                        else:
+                            m.d.comb += [
+                                word_last.eq(1),
+                                ends_write.en.eq(1),
+                            ]
+                            m.d.rx += commit_ptr.eq(write_ptr + 1)
+                            m.next = "Idle"
+                    with m.If(~self.enable):
+                        m.next = "Idle"
+
+        # Sending, the read port has one clock cycle of latency
+        out_valid = Signal()
+        m.d.comb += [
+            out.data.eq(read.data[:9 * ratio]),
+            out.first.eq(read.data[9 * ratio]),
+            out.last.eq(read.data[9 * ratio + 1]),
+            out.valid.eq(out_valid),
+            read.addr.eq(send_ptr[:-1]),
+            read.en.eq(~out_valid | out.ready),
+        ]
+
+        replay = Signal() # A replay is scheduled
+        replay_timer = Signal(range(self.replay_timeout + 1))
+        replay_timer_running = Signal()
+
+        # Replays and skipping acknowledged TLPs only start between TLPs, the next word then gets read one cycle later
+        boundary = read.en & (~out_valid | out.last)
+        with m.If(boundary & (replay | (used_sending > used_acked))):
+            m.d.rx += [
+                send_ptr.eq(ack_ptr),
+                out_valid.eq(0),
+            ]
+            with m.If(replay):
+                m.d.rx += [
+                    replay.eq(0),
+                    replay_timer.eq(0),
+                    self.replay_num.eq(self.replay_num + 1),
+                    self.replays.eq(self.replays + 1),
+                ]
+                m.d.comb += self.retrain.eq(self.replay_num == 3)
+        with m.Elif(read.en):
+            m.d.rx += out_valid.eq(send_ptr != commit_ptr)
+            with m.If(send_ptr != commit_ptr):
+                m.d.rx += send_ptr.eq(send_ptr + 1)
+
+        # REPLAY_TIMER runs from sending a TLP until all TLPs are acknowledged
+        with m.If(out.valid & out.ready & out.last):
+            m.d.rx += replay_timer_running.eq(1)
+        with m.If(replay_timer_running & ~self.hold & (replay_timer < self.replay_timeout)):
+            m.d.rx += replay_timer.eq(replay_timer + 1)
+        with m.If(replay_timer == self.replay_timeout):
+            m.d.rx += [
+                replay.eq(1),
+                replay_timer.eq(0),
+                replay_timer_running.eq(0),
+            ]
+
+        # An Ack or Nak is valid if its sequence number is between ACKD_SEQ and NEXT_TRANSMIT_SEQ - 1,
+        # acknowledging all TLPs up to it. Otherwise it gets ignored.
+        distance = Signal(12)
+        m.d.comb += [
+            distance.eq(next_seq - 1 - self.acknak.seq),
+            ends_read.addr.eq(self.acknak.seq),
+        ]
+        with m.If(self.acknak.valid & (distance <= outstanding)):
+            with m.If(distance < outstanding):
+                m.d.rx += [
+                    acked_seq.eq(self.acknak.seq),
+                    ack_ptr.eq(ends_read.data),
+                    self.replay_num.eq(0),
+                    replay_timer.eq(0),
+                    replay_timer_running.eq(distance != 0),
+                ]
+            # Once all TLPs are acknowledged, there is nothing left to replay
+            with m.If(distance == 0):
+                m.d.rx += replay.eq(0)
+            with m.Elif(self.acknak.nak):
+                m.d.rx += replay.eq(1)
+
+        # Purge the replay buffer
+        with m.If(~self.enable):
+            m.d.rx += [
+                write_ptr.eq(0),
+                commit_ptr.eq(0),
+                send_ptr.eq(0),
+                ack_ptr.eq(0),
+                out_valid.eq(0),
+                next_seq.eq(0),
+                acked_seq.eq(4095),
+                self.replay_num.eq(0),
+                replay.eq(0),
+                replay_timer.eq(0),
+                replay_timer_running.eq(0),
+            ]
+
+        return m
+
+
+class PCIeTLPReceiver(Elaboratable):
+    """
+    PCIe TLP receiver with a receive buffer for 1:2 or 1:4 gearing
+
+    Received TLPs get written into the receive buffer without sequence number and LCRC, which is a block RAM. Once the
+    LCRC checked out and the sequence number was NEXT_RCV_SEQ, the TLP gets committed and passed on to the transaction
+    layer, otherwise it gets dropped again. Duplicate TLPs, which got sent again by a replay, need to be acknowledged
+    again. TLPs with a bad LCRC, TLPs which didn't fit into the buffer and TLPs with a later sequence number need a Nak.
+    Nullified TLPs, which end with EDB and the inverted LCRC, get dropped silently.
+
+    Parameters
+    ----------
+    packets : Record(packet_stream_layout(2)) or Record(packet_stream_layout(4))
+        Received packets from the RX Phy, DLLPs get ignored
+    tlp : Record(tlp_stream_layout(ratio))
+        Received TLPs to the transaction layer
+    buffer_size : int
+        Size of the receive buffer in bytes, a power of 2
+    enable : Signal()
+        TLPs only get received while asserted, deasserting it clears the buffer and resets NEXT_RCV_SEQ
+    next_rcv_seq : Signal(12)
+        NEXT_RCV_SEQ, sequence number of the next expected TLP
+    ack : Signal()
+        Asserted for one clock cycle when a TLP got received and committed
+    duplicate : Signal()
+        Asserted for one clock cycle when a duplicate TLP got received
+    nak : Signal()
+        Asserted for one clock cycle when a TLP got dropped and a Nak is needed
+    """
+    def __init__(self, packets : Record, buffer_size = 1024):
+        self.ratio = len(packets.data) // 8
+        assert self.ratio in [2, 4]
+        assert buffer_size & (buffer_size - 1) == 0
+        self.packets = packets
+        self.tlp = Record(tlp_stream_layout(self.ratio))
+        self.buffer_depth = buffer_size // self.ratio
+        self.enable = Signal()
+        self.next_rcv_seq = Signal(12)
+        self.ack = Signal()
+        self.duplicate = Signal()
+        self.nak = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        ratio = self.ratio
+        depth = self.buffer_depth
+        packets = self.packets
+        next_seq = self.next_rcv_seq
+
+        # Pointers have one more bit than needed for addressing, to distinguish full from empty
+        pointer_bits = depth.bit_length()
+        write_ptr = Signal(pointer_bits)  # Next word of the TLP being received
+        commit_ptr = Signal(pointer_bits) # End of the last committed TLP
+        read_ptr = Signal(pointer_bits)   # Next word to pass on
+
+        # Receive buffer words are Cat(data, first, last)
+        buffer = Memory(width=8 * ratio + 2, depth=depth)
+        m.submodules.write = write = buffer.write_port(domain="rx")
+        m.submodules.read = read = buffer.read_port(domain="rx", transparent=False)
+
+        # The LCRC covers the whole packet, including the received LCRC
+        tlp_bytes = Signal(ratio)
+        m.d.comb += tlp_bytes.eq(Mux(packets.valid & ~packets.dllp, Cat(j < packets.count for j in range(ratio)), 0))
+        m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(packets.data, tlp_bytes, packets.first))
+
+        # The packet is [seq0 seq1 TLP... LCRC0 LCRC1 LCRC2 LCRC3], 4n + 6 bytes. Without the sequence number, every
+        # word of the TLP consists of the upper ratio - 2 bytes of the previous received word and the lower 2 bytes of
+        # the current one. The words formed with the last 4 // ratio received words contain the LCRC.
+        last_word = Signal(8 * ratio)
+        word = Cat(last_word[16:], packets.data[0:16])
+        lcrc_words = 4 // ratio
+
+        # Last words written to the buffer, the last word of the TLP gets written again with last set
+        written = [Signal(8 * ratio + 2, name="written_%d" % i) for i in range(lcrc_words)]
+        end_word = Signal(8 * ratio + 2)
+        end_ptr = Signal(pointer_bits)
+
+        receiving = Signal()
+        first = Signal()     # Next word written is the first one
+        expected = Signal()  # Sequence number is NEXT_RCV_SEQ
+        duplicate = Signal() # Sequence number is before NEXT_RCV_SEQ
+        bad = Signal()       # Packet ended badly or didn't fit into the buffer
+        edb = Signal()       # Packet ended with EDB
+        checking = Signal()  # LCRC gets checked
+
+        # The next TLP can start while the last one gets committed
+        commit = Signal()
+        m.d.comb += commit.eq(checking & lcrc.check & ~bad & expected)
+        expected_seq = Signal(12)
+        m.d.comb += expected_seq.eq(next_seq + commit)
+
+        seq = Cat(packets.data[8:16], packets.data[0:4])
+        earlier = Signal(12)
+        m.d.comb += earlier.eq(expected_seq - 1 - seq)
+
+        room = (write_ptr - read_ptr)[:pointer_bits] != depth
+
+        m.d.comb += [
+            write.addr.eq(write_ptr[:-1]),
+            write.data.eq(Cat(word, first, Const(0, 1))),
+        ]
+
+        m.d.rx += checking.eq(0)
+        with m.If(packets.valid & packets.first):
+            m.d.rx += [
+                receiving.eq(~packets.dllp & ~packets.last),
+                first.eq(1),
+                expected.eq(seq == expected_seq),
+                duplicate.eq(earlier < 2048),
+                bad.eq(0),
+                edb.eq(0),
+                last_word.eq(packets.data),
+            ]
+        with m.Elif(packets.valid & receiving):
+            with m.If(packets.last):
+                m.d.rx += [
+                    receiving.eq(0),
+                    checking.eq(1),
+                    end_word.eq(written[lcrc_words - 1] | (1 << (8 * ratio + 1))),
+                    end_ptr.eq(write_ptr - (lcrc_words - 1)),
+                ]
+                with m.If(packets.bad | (packets.count != 2)):
+                    m.d.rx += bad.eq(1)
+                with m.If(packets.edb & (packets.count == 2)):
+                    m.d.rx += edb.eq(1)
+            with m.Elif(expected & ~bad):
+                with m.If(room):
+                    m.d.comb += write.en.eq(1)
+                    m.d.rx += [
+                        write_ptr.eq(write_ptr + 1),
+                        first.eq(0),
+                        Cat(written).eq(Cat(write.data, Cat(written[:-1]))),
+                    ]
+                with m.Else():
+                    m.d.rx += bad.eq(1)
+            with m.If(~packets.last):
+                m.d.rx += last_word.eq(packets.data)
+
+        # Commit the TLP once the LCRC got checked, there is nothing to write in this cycle
+        with m.If(checking):
+            with m.If(commit):
+                m.d.comb += [
+                    write.addr.eq(end_ptr[:-1] - 1),
+                    write.data.eq(end_word),
+                    write.en.eq(1),
+                    self.ack.eq(1),
+                ]
+                m.d.rx += [
+                    write_ptr.eq(end_ptr),
+                    commit_ptr.eq(end_ptr),
+                    next_seq.eq(next_seq + 1),
+                ]
+            with m.Elif(lcrc.check & ~bad & duplicate):
+                m.d.comb += self.duplicate.eq(1)
+            with m.Elif(edb & lcrc.nullified):
+                m.d.rx += write_ptr.eq(commit_ptr)
+            with m.Else():
+                m.d.comb += self.nak.eq(1)
+                m.d.rx += write_ptr.eq(commit_ptr)
+
+        # Pass committed TLPs on, the read port has one clock cycle of latency
+        out_valid = Signal()
+        m.d.comb += [
+            self.tlp.data.eq(read.data[:8 * ratio]),
+            self.tlp.first.eq(read.data[8 * ratio]),
+            self.tlp.last.eq(read.data[8 * ratio + 1]),
+            self.tlp.valid.eq(out_valid),
+            read.addr.eq(read_ptr[:-1]),
+            read.en.eq(~out_valid | self.tlp.ready),
+        ]
+        with m.If(read.en):
+            m.d.rx += out_valid.eq(read_ptr != commit_ptr)
+            with m.If(read_ptr != commit_ptr):
+                m.d.rx += read_ptr.eq(read_ptr + 1)
+
+        # Clear the buffer
+        with m.If(~self.enable):
+            m.d.rx += [
+                write_ptr.eq(0),
+                commit_ptr.eq(0),
+                read_ptr.eq(0),
+                out_valid.eq(0),
+                next_seq.eq(0),
+                receiving.eq(0),
+                checking.eq(0),
+            ]
+
+        return m
@@ -0,0 +1,55 @@
+from nmigen import *
+from nmigen.back import rtlil
+from ecp5_pcie.crc import CRC, ParallelCRC
+import subprocess
+import os
+import re
+
+# Usage: python compare_crc.py
+#
+# Synthesizes the bit-serial CRC and the matrix based ParallelCRC with yosys, maps them to 4-input LUTs
+# like the ones in the ECP5 with FlowMap (which gives the minimal LUT depth) and prints the LUT count
+# and the logic depth (longest path in LUTs between flip flops) for each.
+# The yosys binary can be set with the YOSYS environment variable.
+
+YOSYS = os.environ.get("YOSYS", "yosys")
+
+# Input width, CRC polynomial, CRC size and initial value
+CONFIGURATIONS = [
+    (16, 0x100B,     16, 0xFFFF),       # DLLP CRC, 1:2 gearing
+    (32, 0x100B,     16, 0xFFFF),       # DLLP CRC, 1:4 gearing
+    (64, 0x100B,     16, 0xFFFF),       # DLLP CRC, 1:8 gearing
+    (16, 0x04C11DB7, 32, 0xFFFFFFFF),   # LCRC, 1:2 gearing
+    (32, 0x04C11DB7, 32, 0xFFFFFFFF),   # LCRC, 1:4 gearing
+    (64, 0x04C11DB7, 32, 0xFFFFFFFF),   # LCRC, 1:8 gearing
+]
+
+
+def synthesize(crc):
+    """
+    Returns the number of LUT4s and the logic depth of a CRC generator
+    """
+    m = Module()
+    m.submodules.crc = crc
+
+    # Register the input, otherwise the depth of the input path isn't counted
+    input = Signal(len(crc.input))
+    m.d.sync += crc.input.eq(input)
+
+    with open("compare_crc.il", "w") as design:
+        design.write(rtlil.convert(m, ports=[input, crc.output, crc.reset]))
+    result = subprocess.run([YOSYS, "-p", "read_rtlil compare_crc.il; synth -top top -flatten -noabc; flowmap -maxlut 4; ltp -noff; stat"],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    os.remove("compare_crc.il")
+
+    luts = int(re.search(r"\$lut\s+(\d+)", result).group(1))
+    depth = int(re.search(r"Longest topological path in \S+ \(length=(\d+)\)", result).group(1))
+    return luts, depth
+
+
+if __name__ == "__main__":
+    print("Input\tCRC\tSerial LUTs\tSerial depth\tMatrix LUTs\tMatrix depth")
+    for width, polynomial, crc_size, init in CONFIGURATIONS:
+        serial = synthesize(CRC(Signal(width), init, polynomial, crc_size, Signal()))
+        matrix = synthesize(ParallelCRC(Signal(width), init, polynomial, crc_size, Signal()))
+        print("{}\t{}\t{}\t\t{}\t\t{}\t\t{}".format(width, crc_size, *serial, *matrix))
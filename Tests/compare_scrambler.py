@@ -0,0 +1,54 @@
+from nmigen import *
+from nmigen.back import rtlil
+from ecp5_pcie.serdes import PCIeScrambler, PCIeSERDESInterface
+import subprocess
+import os
+import re
+
+# Usage: python compare_scrambler.py
+#
+# Synthesizes the PCIeScrambler with the LFSR and with the block RAM keystream table for several gearing ratios,
+# places and routes it with nextpnr and prints the LUT, flip flop and block RAM usage and the maximum frequency.
+# LUTs are mapped with FlowMap like in compare_crc.py.
+# The yosys and nextpnr binaries can be set with the YOSYS and NEXTPNR environment variables.
+
+YOSYS = os.environ.get("YOSYS", "yosys")
+NEXTPNR = os.environ.get("NEXTPNR", "nextpnr-ecp5")
+
+RATIOS = [2, 4, 8]
+
+
+def implement(ratio, table):
+    """
+    Returns the number of LUT4s, flip flops and DP16KDs and the maximum frequency in MHz of a scrambler
+    """
+    m = Module()
+    m.submodules.lane = lane = PCIeSERDESInterface(ratio)
+    m.submodules.scrambler = scrambler = PCIeScrambler(lane, Const(1), table)
+
+    # Register the input, otherwise the input path isn't counted
+    input = Signal(9 * ratio)
+    m.d.rx += scrambler.tx_symbol.eq(input)
+
+    with open("compare_scrambler.il", "w") as design:
+        design.write(rtlil.convert(m, ports=[input, lane.tx_symbol, ClockSignal("rx")]))
+    subprocess.run([YOSYS, "-q", "-p", "read_rtlil compare_scrambler.il; synth_ecp5 -top top -run begin:map_luts; flowmap -maxlut 4; "
+        "synth_ecp5 -top top -run map_cells: -json compare_scrambler.json"], check=True)
+    result = subprocess.run([NEXTPNR, "--45k", "--package", "CABGA381", "--json", "compare_scrambler.json", "--freq", "250", "--timing-allow-fail"],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, check=True).stdout
+    os.remove("compare_scrambler.il")
+    os.remove("compare_scrambler.json")
+
+    def used(cell):
+        match = re.search(r"{}:\s+(\d+)/".format(cell), result)
+        return int(match.group(1)) if match else 0
+
+    fmax = float(re.findall(r"Max frequency for clock .*: ([\d.]+) MHz", result)[-1])
+    return used("TRELLIS_COMB"), used("TRELLIS_FF"), used("DP16KD"), fmax
+
+
+if __name__ == "__main__":
+    print("Ratio\tMode\tLUTs\tFFs\tDP16KD\tFmax (MHz)")
+    for ratio in RATIOS:
+        for table in [False, True]:
+            print("{}\t{}\t{}\t{}\t{}\t{}".format(ratio, "table" if table else "LFSR", *implement(ratio, table)))
@@ -0,0 +1,74 @@
+from nmigen import *
+from nmigen.sim import Simulator, Settle
+from ecp5_pcie.dllp import PCIeDLLPTransmitter, PCIeDLLPQueue, DLLPType, PMType
+from ecp5_pcie.layouts import symbol_stream_layout
+from ecp5_pcie.reference import dllp_crc
+from ecp5_pcie.serdes import Ctrl
+
+# Posts a PM DLLP, an UpdateFC and an Ack to a PCIeDLLPQueue in the same clock cycle. Checks that they get sent by
+# priority, back to back without idle cycles between them, and with the correct CRCs, for 1:2 and 1:4 gearing.
+
+def dllp_bytes(type, type_meta, header, data):
+    return [type << 4 | type_meta, header >> 2, (header & 3) << 6 | data >> 8, data & 0xFF]
+
+
+if __name__ == "__main__":
+    for ratio in [2, 4]:
+        m = Module()
+        out = Record(symbol_stream_layout(ratio))
+        m.submodules.tx = tx = PCIeDLLPTransmitter(out)
+        m.submodules.queue = queue = PCIeDLLPQueue(tx, 3)
+        m.d.comb += out.ready.eq(1)
+
+        sim = Simulator(m)
+        sim.add_clock(1/125e6, domain="rx")
+
+        words = []
+
+        def producer(entry, fields):
+            def process():
+                for name, value in fields.items():
+                    yield entry[name].eq(value)
+                yield entry.valid.eq(1)
+                while True:
+                    yield Settle()
+                    if (yield entry.ready):
+                        break
+                    yield
+                yield
+                yield entry.valid.eq(0)
+            return process
+
+        def monitor():
+            for _ in range(40):
+                yield Settle()
+                words.append(((yield out.valid), (yield out.data)))
+                yield
+
+        ack = dict(type=DLLPType.Ack, data=100)
+        update = dict(type=DLLPType.UpdateFC_P, header=5, data=80)
+        pm = dict(type=DLLPType.PM, type_meta=PMType.Enter_L1)
+        sim.add_sync_process(producer(queue.inputs[0], ack), domain="rx")
+        sim.add_sync_process(producer(queue.inputs[1], update), domain="rx")
+        sim.add_sync_process(producer(queue.inputs[2], pm), domain="rx")
+        sim.add_sync_process(monitor, domain="rx")
+        sim.run()
+
+        # The symbols of the valid words from the first one on, an idle cycle in between shows up as None
+        start = next(i for i, (valid, data) in enumerate(words) if valid)
+        end = max(i for i, (valid, data) in enumerate(words) if valid)
+        symbols = []
+        for valid, data in words[start:end + 1]:
+            symbols += [(data >> (9 * i)) & 0x1FF for i in range(ratio)] if valid else [None]
+        while symbols and symbols[-1] != Ctrl.END:
+            symbols.pop()
+
+        expected = []
+        for fields in [ack, update, pm]:
+            content = dllp_bytes(fields["type"], fields.get("type_meta", 0), fields.get("header", 0),
+                fields.get("data", 0))
+            crc = int(dllp_crc(content)[0])
+            expected += [Ctrl.SDP] + content + [crc & 0xFF, crc >> 8, Ctrl.END]
+
+        print("1:{} gearing: {}, {} idle cycles".format(ratio, "correct" if symbols == expected else "WRONG",
+            symbols.count(None)))
@@ -0,0 +1,72 @@
+from nmigen import *
+from nmigen.sim import Simulator, Settle
+from ecp5_pcie.serdes import PCIeElasticBuffer, Ctrl
+
+# Sends a counter with SKP ordered sets through the elastic buffer with 1% different clocks in both directions
+# and checks that no data gets lost and that every SKP ordered set keeps 1 to 5 SKP symbols.
+
+WORDS = 3000
+SKP_INTERVAL = 40 # Words between SKP ordered sets
+
+
+def simulate(ratio, w_period, r_period):
+    m = Module()
+    m.submodules.buffer = buffer = PCIeElasticBuffer(ratio, 9 * ratio, w_domain="w", r_domain="r")
+
+    sim = Simulator(m)
+    sim.add_clock(w_period, domain="w")
+    sim.add_clock(r_period, domain="r")
+
+    symbols = []
+    counter = 0
+    while len(symbols) < WORDS * ratio:
+        if len(symbols) % (SKP_INTERVAL * ratio) == 0:
+            symbols += [Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]
+        else:
+            symbols.append(counter % 256)
+            counter += 1
+    symbols = symbols[:WORDS * ratio]
+
+    received = []
+    levels = []
+
+    def write():
+        yield buffer.w_en.eq(1)
+        for word in range(WORDS):
+            yield buffer.w_data.eq(Cat(Const(symbol, 9) for symbol in symbols[word * ratio : (word + 1) * ratio]))
+            yield
+        yield buffer.w_en.eq(0)
+
+    def read():
+        yield buffer.r_en.eq(1)
+        for _ in range(int(WORDS * w_period / r_period) - 20):
+            yield Settle()
+            if (yield buffer.r_rdy):
+                word = yield buffer.r_data
+                received.extend((word >> (9 * i)) & 0x1FF for i in range(ratio))
+                levels.append((yield buffer.r_level))
+            yield
+
+    sim.add_sync_process(write, domain="w")
+    sim.add_sync_process(read, domain="r")
+    sim.run()
+
+    data = [symbol for symbol in received if symbol not in [Ctrl.COM, Ctrl.SKP]]
+    data_ok = data == [i % 256 for i in range(len(data))]
+
+    skp_counts = []
+    for i, symbol in enumerate(received):
+        if symbol == Ctrl.COM:
+            count = 0
+            while i + count + 1 < len(received) and received[i + count + 1] == Ctrl.SKP:
+                count += 1
+            skp_counts.append(count)
+
+    print("Ratio {}, read clock {:+.0%}: data {}, SKPs per ordered set {}, read level {} to {}".format(
+        ratio, w_period / r_period - 1, "ok" if data_ok else "WRONG", sorted(set(skp_counts[:-1])), min(levels[100:]), max(levels[100:])))
+
+
+if __name__ == "__main__":
+    for ratio in [1, 2]:
+        simulate(ratio, 8e-9, 8.08e-9)
+        simulate(ratio, 8.08e-9, 8e-9)
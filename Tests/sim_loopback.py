@@ -0,0 +1,466 @@
+from nmigen import *
+from nmigen.sim import Simulator, Passive, Settle
+from ecp5_pcie.phy import PCIePhy
+from ecp5_pcie.ltssm import State
+from ecp5_pcie.dll import FCType
+from ecp5_pcie.reference import lfsr_keystream
+from ecp5_pcie.serdes import PCIeSERDESInterface, K, Ctrl
+import argparse
+import random
+
+# Trains two PCIePhy instances against each other, an upstream one like a root port and a downstream one like an
+# endpoint. The symbols go through a channel model which 8b10b encodes them, delays them, optionally inverts the
+# polarity and flips bits, and decodes them again. Reports when each side reached L0 and DL_Active. Optionally both
+# sides send random TLPs afterwards, which need to arrive in order and unchanged despite bit errors.
+# With --l1 the downstream side enters L1 while the TLPs are being sent and leaves it again, the link needs to get back
+# to L0 through Recovery without going through Detect. The TLPs wait during L1 and need to arrive afterwards. With --gen2 both sides support 5 GT/s and change the speed after
+# reaching L0. With --drop-acks the channel towards the upstream side corrupts all Acks until the upstream side
+# replayed its TLPs four times in a row, REPLAY_NUM rolls over and the link gets retrained through Recovery. With --l0s
+# the transmitter of the downstream side enters L0s twice. The first time it leaves L0s with FTSs, the second time the
+# channel corrupts the SKP ordered set after the FTSs, so the upstream side times out in Rx_L0s.FTS and goes to
+# Recovery. Neither may go through Detect.
+
+
+# 8b10b code groups for negative running disparity, abcdei and fghj with a transmitted first
+CODES_5B6B = [
+    0b100111, 0b011101, 0b101101, 0b110001, 0b110101, 0b101001, 0b011001, 0b111000,
+    0b111001, 0b100101, 0b010101, 0b110100, 0b001101, 0b101100, 0b011100, 0b010111,
+    0b011011, 0b100011, 0b010011, 0b110010, 0b001011, 0b101010, 0b011010, 0b111010,
+    0b110011, 0b100110, 0b010110, 0b110110, 0b001110, 0b101110, 0b011110, 0b101011,
+]
+CODES_3B4B = [0b1011, 0b1001, 0b0101, 0b1100, 0b1101, 0b1010, 0b0110, 0b1110]
+CODES_3B4B_K28 = [0b1011, 0b0110, 0b1010, 0b1100, 0b1101, 0b0101, 0b1001, 0b0111]
+K28_6B = 0b001111
+A7 = 0b0111
+
+CONTROL_SYMBOLS = [K(28, y) for y in range(8)] + [K(23, 7), K(27, 7), K(29, 7), K(30, 7)]
+
+
+def disparity(code, bits):
+    return 2 * bin(code).count("1") - bits
+
+
+def encode(symbol, rd):
+    """
+    Returns the 10 bit code group of a 9 bit symbol and the new running disparity, rd is -1 or 1
+    """
+    x = symbol & 0x1F
+    y = (symbol >> 5) & 0x7
+    control = symbol >> 8
+
+    # Code groups with nonzero disparity and the balanced 111000 and 1100 alternate with the running disparity
+    def sub_block(code, bits, rd):
+        if rd > 0 and (disparity(code, bits) != 0 or code in [0b111000, 0b1100]):
+            code ^= (1 << bits) - 1
+        return code, rd if disparity(code, bits) == 0 else -rd
+
+    if control and x == 28:
+        code6, rd = sub_block(K28_6B, 6, rd)
+        if rd > 0:
+            code4, rd = CODES_3B4B_K28[y] ^ 0xF, rd if disparity(CODES_3B4B_K28[y], 4) == 0 else -rd
+        else:
+            code4, rd = sub_block(CODES_3B4B_K28[y], 4, rd)
+    else:
+        code6, rd = sub_block(CODES_5B6B[x], 6, rd)
+        if y == 7 and (control or (rd < 0 and x in [17, 18, 20]) or (rd > 0 and x in [11, 13, 14])):
+            code4, rd = sub_block(A7, 4, rd)
+        else:
+            code4, rd = sub_block(CODES_3B4B[y], 4, rd)
+    return (code6 << 4) | code4, rd
+
+
+# Code groups of all symbols in both running disparities, disparity errors are ignored
+DECODE = {}
+for symbol in list(range(256)) + CONTROL_SYMBOLS:
+    for rd in [-1, 1]:
+        DECODE[encode(symbol, rd)[0]] = symbol
+
+
+class Channel:
+    """
+    One direction of the link, from the transmitter of one lane to the receiver of another
+
+    Parameters
+    ----------
+    tx_lane : PCIeSERDESInterface
+        Transmitting lane
+    rx_lane : PCIeSERDESInterface
+        Receiving lane
+    delay : int
+        Delay in symbols, in addition to one clock cycle
+    ber : float
+        Probability for each bit to get flipped
+    inverted : bool
+        Whether the polarity of the differential pair is inverted
+    drop_acks : bool
+        Corrupts the type of Ack DLLPs while set, so that the receiver discards them
+    drop_skps : bool
+        Corrupts SKP symbols while set, so that SKP ordered sets don't get received
+    """
+    def __init__(self, tx_lane, rx_lane, delay, ber, inverted):
+        self.tx_lane = tx_lane
+        self.rx_lane = rx_lane
+        self.ber = ber
+        self.inverted = inverted
+        self.rd = -1
+        self.bit_errors = 0
+        self.drop_acks = False
+        self.drop_skps = False
+        self.last_symbol = None
+        self.lfsr_position = 0 # LFSR advances since the last COM, to descramble the DLLP type
+        self.line = [None] * delay # Code groups on the line, None for electrical idle
+
+    def step(self):
+        ratio = self.tx_lane.ratio
+        tx_symbol = yield self.tx_lane.tx_symbol
+        tx_e_idle = yield self.tx_lane.tx_e_idle
+        for i in range(ratio):
+            if tx_e_idle & (1 << i):
+                self.line.append(None)
+                continue
+            symbol = (tx_symbol >> (9 * i)) & 0x1FF
+            key = int(lfsr_keystream()[self.lfsr_position % len(lfsr_keystream())])
+            if symbol == Ctrl.COM:
+                self.lfsr_position = 0
+            elif symbol != Ctrl.SKP:
+                self.lfsr_position += 1
+            last_symbol, self.last_symbol = self.last_symbol, symbol
+            # An Ack starts with SDP and a type byte of 0, the changed type doesn't match the CRC anymore
+            if self.drop_acks and last_symbol == Ctrl.SDP and symbol ^ key == 0:
+                symbol ^= 0x01
+            code, self.rd = encode(symbol, self.rd)
+            if self.drop_skps and symbol == Ctrl.SKP:
+                code = 0 # Not a valid code group
+            if self.inverted:
+                code ^= 0x3FF
+            for bit in range(10):
+                if random.random() < self.ber:
+                    code ^= 1 << bit
+                    self.bit_errors += 1
+            self.line.append(code)
+
+        # The receiver can undo the inversion
+        rx_invert = yield self.rx_lane.rx_invert
+        rx_symbol = 0
+        rx_valid = 0
+        received, self.line = self.line[:ratio], self.line[ratio:]
+        for i, code in enumerate(received):
+            if code is None:
+                continue
+            symbol = DECODE.get(code ^ (0x3FF if rx_invert else 0))
+            if symbol is not None:
+                rx_symbol |= symbol << (9 * i)
+                rx_valid |= 1 << i
+        yield self.rx_lane.rx_symbol.eq(rx_symbol)
+        yield self.rx_lane.rx_valid.eq(rx_valid)
+        yield self.rx_lane.rx_present.eq(any(code is not None for code in received))
+
+
+def receiver_detection(lane, cycles = 10):
+    """
+    Returns a process for the receiver detection on lane, which always finds a receiver after some clock cycles
+    """
+    def process():
+        yield Passive()
+        count = 0
+        while True:
+            if (yield lane.det_enable):
+                count += 1
+            else:
+                count = 0
+            yield lane.det_valid.eq(count > cycles)
+            yield lane.det_status.eq(1)
+            yield
+    return process
+
+
+def memory_write(dws):
+    """
+    Returns a memory write TLP with a 3 DW header, a random address and dws random payload DWs as a list of bytes
+    """
+    header = [0x40, 0, (dws >> 8) & 0x3, dws & 0xFF] + [random.randrange(256) for _ in range(8)]
+    return header + [random.randrange(256) for _ in range(4 * dws)]
+
+
+def tlp_source(phy, tlps, waits):
+    """
+    Returns a process which sends the posted TLPs, lists of bytes, once the data link layer is up. Each TLP waits until
+    the link partner has enough credits for it, the number of clock cycles it waited gets appended to waits.
+    """
+    def process():
+        yield Passive()
+        tlp = phy.tlp_tx.tlp
+        ratio = len(tlp.data) // 8
+        while not (yield phy.dll.up):
+            yield
+        for data in tlps:
+            # One data credit is 4 DWs of payload
+            payload = len(data) // 4 - 3
+            yield phy.dll.fc_request.type.eq(0)
+            yield phy.dll.fc_request.data.eq((payload + 3) // 4)
+            yield Settle()
+            waited = 0
+            while not (yield phy.dll.may_send):
+                yield
+                yield Settle()
+                waited += 1
+            waits.append(waited)
+
+            words = [data[i:i + ratio] for i in range(0, len(data), ratio)]
+            i = 0
+            while i < len(words):
+                yield tlp.data.eq(sum(byte << (8 * k) for k, byte in enumerate(words[i])))
+                yield tlp.first.eq(i == 0)
+                yield tlp.last.eq(i == len(words) - 1)
+                yield tlp.valid.eq(1)
+                yield Settle()
+                ready = yield tlp.ready
+                yield
+                if ready:
+                    i += 1
+            yield tlp.valid.eq(0)
+    return process
+
+
+def tlp_sink(phy, received):
+    """
+    Returns a process which appends the received TLPs to received
+    """
+    def process():
+        yield Passive()
+        tlp = phy.tlp_rx.tlp
+        ratio = len(tlp.data) // 8
+        yield tlp.ready.eq(1)
+        data = []
+        while True:
+            yield Settle()
+            if (yield tlp.valid):
+                word = yield tlp.data
+                data += [(word >> (8 * k)) & 0xFF for k in range(ratio)]
+                if (yield tlp.last):
+                    received.append(data)
+                    data = []
+            yield
+    return process
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ratio", type=int, default=2, help="Symbols per clock cycle, 2 or 4")
+    parser.add_argument("--delay", type=int, default=3, help="Channel delay in symbols")
+    parser.add_argument("--ber", type=float, default=0, help="Bit error rate")
+    parser.add_argument("--invert", action="store_true", help="Invert the polarity towards the downstream side")
+    parser.add_argument("--time-scale", type=float, default=0.005,
+        help="Factor for the LTSSM timeouts, Polling.Active needs 1024 TS1s within the 24 ms timeout")
+    parser.add_argument("--dll-time-scale", type=float, default=1,
+        help="Factor for the 30 us UpdateFC refresh interval of the DLL")
+    parser.add_argument("--cycles", type=int, default=100000, help="Maximum number of clock cycles to simulate")
+    parser.add_argument("--tlps", type=int, default=0, help="Number of random TLPs each side sends once DL_Active")
+    parser.add_argument("--ack-count", type=int, default=8, help="Received TLPs after which an Ack gets sent at the latest")
+    parser.add_argument("--credits", type=int, nargs=2,
+        help="Posted header and data credits each side advertises, 0 for infinite, other types get infinite credits. "
+        "By default they get derived from the size of the receive buffer.")
+    parser.add_argument("--update-threshold", type=int, nargs=2, default=[2, 16],
+        help="Freed header and data credits after which an UpdateFC gets sent right away")
+    parser.add_argument("--gen2", action="store_true", help="Support 5 GT/s on both sides")
+    parser.add_argument("--l1", action="store_true", help="Enter and leave L1 after the first TLP")
+    parser.add_argument("--drop-acks", action="store_true",
+        help="Drop the Acks towards the upstream side until it retrains the link")
+    parser.add_argument("--l0s", action="store_true",
+        help="Let the downstream transmitter enter and leave L0s, once with a timeout in Rx_L0s.FTS")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--vcd", help="Write a waveform to this file")
+    parser.add_argument("--verbose", action="store_true", help="Print the LTSSM state changes")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    clk_freq = 250e6 / args.ratio
+
+    m = Module()
+    m.submodules.upstream_lane = upstream_lane = PCIeSERDESInterface(args.ratio)
+    m.submodules.downstream_lane = downstream_lane = PCIeSERDESInterface(args.ratio)
+    phy_args = dict(gen2=args.gen2, time_scale=args.time_scale, dll_time_scale=args.dll_time_scale,
+        credits=args.credits and {"PH": args.credits[0], "PD": args.credits[1]}, ack_count=args.ack_count,
+        update_header_threshold=args.update_threshold[0], update_data_threshold=args.update_threshold[1])
+    m.submodules.upstream = upstream = PCIePhy(upstream_lane, upstream=True, **phy_args)
+    m.submodules.downstream = downstream = PCIePhy(downstream_lane, **phy_args)
+
+    channels = [
+        Channel(upstream_lane, downstream_lane, args.delay, args.ber, args.invert),
+        Channel(downstream_lane, upstream_lane, args.delay, args.ber, False),
+    ]
+    sides = {"upstream": upstream, "downstream": downstream}
+    events = ["L0", "DL_Active"] + (["5 GT/s"] if args.gen2 else []) + (["L1", "L1 exit"] if args.l1 else []) + \
+        (["L0s", "L0s exit"] if args.l0s else []) + \
+        (["Recovery", "Recovery exit"] if args.drop_acks or args.l0s else [])
+    times = {(name, event): None for name in sides for event in events}
+    link_downs = {name: 0 for name in sides}
+
+    # Memory writes with 1 to 32 DWs of payload, sent by each side to the other one
+    sent = {name: [memory_write(random.randint(1, 32)) for _ in range(args.tlps)] for name in sides}
+    waits = {name: [] for name in sides}
+    received = {name: [] for name in sides}
+    replays = {name: 0 for name in sides}
+    unacked = {name: 0 for name in sides}
+    acks = {name: (0, 0) for name in sides}
+    updates = {name: [0, 0, 0] for name in sides}
+
+    sim = Simulator(m)
+    sim.add_clock(1 / clk_freq, domain="rx")
+
+    def channel_process():
+        yield Passive()
+        while True:
+            for channel in channels:
+                yield from channel.step()
+            yield
+
+    def monitor():
+        states = {name: None for name in sides}
+        for cycle in range(args.cycles):
+            yield
+            for name, phy in sides.items():
+                state = yield phy.ltssm.debug_state
+                if args.verbose and state != states[name]:
+                    print("%7d %-10s %s" % (cycle, name, State(state).name))
+                # The link must not go down once it is up
+                if state != states[name] and state in [State.Detect_Quiet, State.Detect_Active] and \
+                    times[name, "L0"] is not None:
+                    link_downs[name] += 1
+                states[name] = state
+                if times[name, "L0"] is None and state == State.L0:
+                    times[name, "L0"] = cycle
+                if times[name, "DL_Active"] is None and (yield phy.dll.up):
+                    times[name, "DL_Active"] = cycle
+                if args.gen2 and times[name, "5 GT/s"] is None and (yield phy.ltssm.status.link.speed):
+                    times[name, "5 GT/s"] = cycle
+                if args.l1:
+                    if times[name, "L1"] is None and (yield phy.dll.l1):
+                        times[name, "L1"] = cycle
+                    if times[name, "L1"] is not None and times[name, "L1 exit"] is None and state == State.L0 and \
+                        not (yield phy.dll.l1):
+                        times[name, "L1 exit"] = cycle
+                if args.l0s:
+                    in_l0s = (yield phy.ltssm.status.tx_l0s) or (yield phy.ltssm.status.rx_l0s)
+                    if times[name, "L0s"] is None and in_l0s:
+                        times[name, "L0s"] = cycle
+                    if times[name, "L0s"] is not None and times[name, "L0s exit"] is None and not in_l0s and \
+                        state == State.L0:
+                        times[name, "L0s exit"] = cycle
+                if (args.drop_acks or args.l0s) and times[name, "DL_Active"] is not None and \
+                    times[name, "Recovery"] is None and state == State.Recovery:
+                    times[name, "Recovery"] = cycle
+                if (args.drop_acks or args.l0s) and times[name, "Recovery"] is not None and \
+                    times[name, "Recovery exit"] is None and state == State.L0:
+                    times[name, "Recovery exit"] = cycle
+                replays[name] = yield phy.tlp_tx.replays
+                unacked[name] = ((yield phy.tlp_tx.next_transmit_seq) - 1 - (yield phy.tlp_tx.acked_seq)) % 4096
+                acks[name] = (yield phy.dll.acks_sent), (yield phy.dll.tlps_acked)
+                # UpdateFCs are counted by the receiving side, per type
+                if (yield phy.dllp_rx.dllp.valid) and (yield phy.dllp_rx.dllp.type[2:4]) == FCType.UpdateFC:
+                    updates[name][(yield phy.dllp_rx.dllp.type[0:2])] += 1
+            # Coalesced Acks for the last TLPs follow when the AckNak latency timer expires
+            if all(time is not None for time in times.values()) and \
+                all(len(received[name]) >= args.tlps and acks[name][1] >= args.tlps and not unacked[name]
+                for name in sides):
+                return
+
+    def drop_acks_process():
+        """
+        Drops the Acks for the TLPs of the upstream side until REPLAY_NUM rolled over and the link got retrained
+        """
+        yield Passive()
+        channels[1].drop_acks = True
+        while (yield upstream.tlp_tx.replays) < 4:
+            yield
+        while (yield upstream.ltssm.debug_state) != State.Recovery:
+            yield
+        channels[1].drop_acks = False
+
+    def l0s_process():
+        """
+        Puts the downstream transmitter into L0s twice once all TLPs have been acknowledged. The second time the SKP
+        ordered set after the FTSs gets corrupted.
+        """
+        yield Passive()
+        while not ((yield from all_sides(lambda phy: phy.dll.up)) and
+            all(len(received[name]) >= args.tlps and not unacked[name] for name in sides)):
+            yield
+        for drop_skps in [False, True]:
+            yield downstream.ltssm.tx_l0s.eq(1)
+            while not (yield upstream.ltssm.status.rx_l0s):
+                yield
+            for _ in range(100):
+                yield
+            channels[1].drop_skps = drop_skps
+            yield downstream.ltssm.tx_l0s.eq(0)
+            while (yield upstream.ltssm.status.rx_l0s):
+                yield
+            channels[1].drop_skps = False
+            while not (yield from all_sides(lambda phy: phy.ltssm.debug_state == State.L0)):
+                yield
+
+    def all_sides(signal):
+        """
+        Returns whether the signal selected by signal(phy) is asserted on both sides
+        """
+        values = []
+        for phy in sides.values():
+            values.append((yield signal(phy)))
+        return all(values)
+
+    def l1_process():
+        """
+        Directs the downstream side to L1 once the first TLP has arrived and lets it leave L1 again after a while
+        """
+        yield Passive()
+        while not ((yield from all_sides(lambda phy: phy.dll.up)) and (received["downstream"] or not args.tlps)):
+            yield
+        yield downstream.dll.enter_l1.eq(1)
+        while not (yield from all_sides(lambda phy: phy.dll.l1)):
+            yield
+        for _ in range(200):
+            yield
+        yield downstream.dll.enter_l1.eq(0)
+
+    sim.add_sync_process(channel_process, domain="rx")
+    sim.add_sync_process(receiver_detection(upstream_lane), domain="rx")
+    sim.add_sync_process(receiver_detection(downstream_lane), domain="rx")
+    sim.add_sync_process(monitor, domain="rx")
+    if args.l1:
+        sim.add_sync_process(l1_process, domain="rx")
+    if args.drop_acks:
+        sim.add_sync_process(drop_acks_process, domain="rx")
+    if args.l0s:
+        sim.add_sync_process(l0s_process, domain="rx")
+    sim.add_sync_process(tlp_source(upstream, sent["upstream"], waits["upstream"]), domain="rx")
+    sim.add_sync_process(tlp_source(downstream, sent["downstream"], waits["downstream"]), domain="rx")
+    sim.add_sync_process(tlp_sink(upstream, received["upstream"]), domain="rx")
+    sim.add_sync_process(tlp_sink(downstream, received["downstream"]), domain="rx")
+
+    if args.vcd:
+        with sim.write_vcd(args.vcd):
+            sim.run()
+    else:
+        sim.run()
+
+    for (name, event), cycle in times.items():
+        if cycle is None:
+            print("%-10s %-13s not reached" % (name, event))
+        else:
+            print("%-10s %-13s after %7d cycles, %9.2f us" % (name, event, cycle, cycle / clk_freq * 1e6))
+    print("Bit errors: %d" % sum(channel.bit_errors for channel in channels))
+    for name in sides:
+        print("%-10s went to Detect %d times after L0" % (name, link_downs[name]))
+
+    if args.tlps:
+        for name, other in [("upstream", "downstream"), ("downstream", "upstream")]:
+            print("%-10s received %d of %d TLPs, %s, %d replays by the %s side" % (name, len(received[name]),
+                args.tlps, "correct" if received[name] == sent[other][:len(received[name])] else "CORRUPTED",
+                replays[other], other))
+        for name in sides:
+            print("%-10s sent %d Acks for %d TLPs, %d own TLPs unacknowledged" % (name, *acks[name], unacked[name]))
+        for name in sides:
+            print("%-10s waited %d cycles for credits" % (name, sum(waits[name])))
+    for name in sides:
+        print("%-10s received %d P, %d NP and %d Cpl UpdateFCs" % (name, *updates[name]))
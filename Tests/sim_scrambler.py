@@ -0,0 +1,87 @@
+from nmigen import *
+from nmigen.sim import Simulator, Settle
+from ecp5_pcie.serdes import PCIeScrambler, PCIeSERDESInterface, Ctrl
+from ecp5_pcie.lfsr import PCIeKeystreamTable
+from ecp5_pcie.reference import scramble, lfsr_keystream
+import numpy as np
+import random
+
+# Scrambles random symbol streams with COM and SKP in any symbol position and compares them with the reference model.
+# Then checks the keys of PCIeKeystreamTable against the reference keystream. The table gets a shortened period, since
+# the simulator can't handle a memory with all 65535 keys, and the streams have long stretches without COM so that its
+# pointer wraps around.
+
+WORDS = 400
+TABLE_PERIOD = 61
+
+if __name__ == "__main__":
+    for ratio in [1, 2, 4, 8]:
+        m = Module()
+
+        m.submodules.lane = lane = PCIeSERDESInterface(ratio)
+        m.submodules.scrambler = scrambler = PCIeScrambler(lane, Const(1))
+
+        sim = Simulator(m)
+        sim.add_clock(1/125e6, domain="rx")
+
+        symbols = [Ctrl.COM]
+        while len(symbols) < WORDS * ratio:
+            symbols.append(random.choice([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.END] + list(range(0, 256, 4))))
+
+        scrambled = []
+
+        def process():
+            for word in range(WORDS):
+                yield scrambler.tx_symbol.eq(Cat(Const(symbol, 9) for symbol in symbols[word * ratio : (word + 1) * ratio]))
+                yield
+                yield Settle()
+                output = yield lane.tx_symbol
+                scrambled.extend((output >> (9 * i)) & 0x1FF for i in range(ratio))
+
+        sim.add_sync_process(process, domain="rx")
+        sim.run()
+
+        errors = np.count_nonzero(np.array(scrambled) != scramble(symbols, training_sets = False))
+        print("Ratio {}: {} of {} symbols wrong".format(ratio, errors, len(symbols)))
+
+    for ratio in [1, 2, 4, 8]:
+        m = Module()
+
+        m.submodules.table = table = PCIeKeystreamTable(ratio, period=TABLE_PERIOD)
+
+        sim = Simulator(m)
+        sim.add_clock(1/125e6, domain="rx")
+
+        symbols = [Ctrl.COM]
+        while len(symbols) < WORDS * ratio:
+            symbols.append(random.choice([Ctrl.COM, Ctrl.SKP, Ctrl.SKP] + list(range(256)) * 2))
+
+        keys = []
+
+        def process():
+            for word in range(WORDS + table.latency):
+                word_symbols = symbols[word * ratio : (word + 1) * ratio] if word < WORDS else [0] * ratio
+                yield table.reset.eq(Cat(Const(symbol == Ctrl.COM) for symbol in word_symbols))
+                yield table.advance.eq(Cat(Const(symbol != Ctrl.SKP) for symbol in word_symbols))
+                yield Settle()
+                if word >= table.latency:
+                    output = yield table.output
+                    keys.extend((output >> (9 * i)) & 0x1FF for i in range(ratio))
+                yield
+
+        sim.add_sync_process(process, domain="rx")
+        sim.run()
+
+        # The key of a data symbol is the one after as many advances since the last COM as there were symbols other
+        # than SKP in between
+        errors = 0
+        position = 0
+        for symbol, key in zip(symbols, keys):
+            if symbol < 0x100 and key != lfsr_keystream()[position % TABLE_PERIOD]:
+                errors += 1
+            if symbol == Ctrl.COM:
+                position = 0
+            elif symbol != Ctrl.SKP:
+                position += 1
+        print("Ratio {}, keystream table: {} of {} keys wrong".format(ratio, errors,
+            sum(symbol < 0x100 for symbol in symbols)))
@@ -0,0 +1,97 @@
+from nmigen import *
+from nmigen.sim import Simulator, Passive
+from ecp5_pcie.tlp import PCIeTLPReceiver
+from ecp5_pcie.layouts import packet_stream_layout
+from ecp5_pcie.reference import lcrc
+import random
+
+# Feeds TLPs ending in different ways into the TLP receiver and checks which ones get committed, acknowledged or
+# cause a Nak. Nullified TLPs, ending with EDB and the inverted LCRC, need to be dropped without a Nak.
+
+# (sequence number, how the TLP ends, expected response)
+CASES = [
+    (0, "good",      "ack"),
+    (1, "bad lcrc",  "nak"),
+    (1, "nullified", None),
+    (1, "good",      "ack"),
+    (2, "edb",       "nak"),
+    (2, "nullified", None),
+    (2, "good",      "ack"),
+    (1, "good",      "duplicate"),
+]
+
+if __name__ == "__main__":
+    for ratio in [2, 4]:
+        m = Module()
+
+        packets = Record(packet_stream_layout(ratio))
+        m.submodules.receiver = receiver = PCIeTLPReceiver(packets)
+
+        sim = Simulator(m)
+        sim.add_clock(1/125e6, domain="rx")
+
+        tlps = []
+        responses = []
+        received = []
+        next_rcv_seq = []
+
+        def packet_bytes(seq, end):
+            tlp = [random.randrange(256) for _ in range(4 * random.randint(3, 8))]
+            tlps.append(tlp)
+            data = [seq >> 8, seq & 0xFF] + tlp
+            crc = int(lcrc(data)[0])
+            if end == "bad lcrc":
+                crc ^= 1
+            elif end == "nullified":
+                crc ^= 0xFFFFFFFF
+            return data + [(crc >> (8 * i)) & 0xFF for i in range(4)]
+
+        def process():
+            yield receiver.enable.eq(1)
+            yield receiver.tlp.ready.eq(1)
+            yield
+            for seq, end, _ in CASES:
+                data = packet_bytes(seq, end)
+                words = [data[i : i + ratio] for i in range(0, len(data), ratio)]
+                for i, word in enumerate(words):
+                    last = i == len(words) - 1
+                    yield packets.data.eq(sum(byte << (8 * j) for j, byte in enumerate(word)))
+                    yield packets.count.eq(len(word))
+                    yield packets.valid.eq(1)
+                    yield packets.first.eq(i == 0)
+                    yield packets.last.eq(last)
+                    yield packets.bad.eq(last & (end in ["edb", "nullified"]))
+                    yield packets.edb.eq(last & (end in ["edb", "nullified"]))
+                    yield
+                yield packets.valid.eq(0)
+                for _ in range(4):
+                    yield
+            for _ in range(20):
+                yield
+            next_rcv_seq.append((yield receiver.next_rcv_seq))
+
+        def monitor():
+            yield Passive()
+            tlp = []
+            while True:
+                for name, signal in [("ack", receiver.ack), ("nak", receiver.nak), ("duplicate", receiver.duplicate)]:
+                    if (yield signal):
+                        responses.append(name)
+                if (yield receiver.tlp.valid):
+                    data = yield receiver.tlp.data
+                    tlp.extend((data >> (8 * j)) & 0xFF for j in range(ratio))
+                    if (yield receiver.tlp.last):
+                        received.append(tlp)
+                        tlp = []
+                yield
+
+        sim.add_sync_process(process, domain="rx")
+        sim.add_sync_process(monitor, domain="rx")
+        sim.run()
+
+        expected_responses = [response for _, _, response in CASES if response is not None]
+        expected_tlps = [tlp for tlp, (_, _, response) in zip(tlps, CASES) if response == "ack"]
+        print("Ratio {}: responses {}, {} of {} TLPs correct, NEXT_RCV_SEQ {} of {}".format(ratio,
+            "correct" if responses == expected_responses else "wrong: {}".format(responses),
+            sum(a == b for a, b in zip(received, expected_tlps)) if len(received) == len(expected_tlps) else 0,
+            len(expected_tlps), next_rcv_seq[0], len(expected_tlps)))
@@ -0,0 +1,70 @@
+from nmigen import *
+from nmigen.sim import Simulator, Settle
+from ecp5_pcie.tlp import PCIeTLPTransmitter
+from ecp5_pcie.layouts import symbol_stream_layout
+
+# Sends two TLPs and stalls the output in the middle of the second one, until REPLAY_TIMER runs out. The replay can
+# only start after that TLP, but an Ack acknowledging both TLPs comes first, so there must be no replay.
+
+if __name__ == "__main__":
+    for ratio in [2, 4]:
+        m = Module()
+
+        out = Record(symbol_stream_layout(ratio))
+        m.submodules.transmitter = transmitter = PCIeTLPTransmitter(out)
+
+        sim = Simulator(m)
+        sim.add_clock(1/125e6, domain="rx")
+
+        stalled = []
+        result = {}
+
+        def stall():
+            starts = 0
+            while True:
+                yield Settle()
+                if (yield out.valid) and (yield out.first):
+                    starts += 1
+                    if starts == 2:
+                        yield out.ready.eq(0)
+                        stalled.append(True)
+                        return
+                yield
+
+        def process():
+            yield transmitter.enable.eq(1)
+            yield out.ready.eq(1)
+            yield
+            words = 16 // ratio
+            for _ in range(2):
+                for i in range(words):
+                    yield transmitter.tlp.data.eq(i)
+                    yield transmitter.tlp.first.eq(i == 0)
+                    yield transmitter.tlp.last.eq(i == words - 1)
+                    yield transmitter.tlp.valid.eq(1)
+                    yield
+                    while not (yield transmitter.tlp.ready):
+                        yield
+            yield transmitter.tlp.valid.eq(0)
+
+            while not stalled:
+                yield
+            for _ in range(transmitter.replay_timeout + 10):
+                yield
+            yield transmitter.acknak.seq.eq(1)
+            yield transmitter.acknak.valid.eq(1)
+            yield
+            yield transmitter.acknak.valid.eq(0)
+            yield out.ready.eq(1)
+            for _ in range(50):
+                yield
+            result["replays"] = yield transmitter.replays
+            result["replay_num"] = yield transmitter.replay_num
+            result["outstanding"] = yield transmitter.outstanding
+
+        sim.add_sync_process(stall, domain="rx")
+        sim.add_sync_process(process, domain="rx")
+        sim.run()
+
+        print("Ratio {}: {} replays, REPLAY_NUM {}, {} TLPs outstanding".format(ratio, result["replays"],
+            result["replay_num"], result["outstanding"]))